@@ -7,7 +7,7 @@ import websockets
 import CoinbaseAPI as cbapi
 import KrakenAPI as kapi
 import ob as simpleob
-import pandas as pd
+from util import fastjson
 
 # 43bp.py
 
@@ -198,10 +198,10 @@ class EventFeed():
                 ]
             }))
             try:
-                ob = pd.Series()
+                ob = None
                 last_trade_id = None
                 while True:
-                    msg = json.loads(await ws.recv())
+                    msg = fastjson.loads(await fastjson.recv(ws))
                     msg_type = msg['type']
                     #print(msg_type)
 
@@ -215,12 +215,12 @@ class EventFeed():
                             'sell': { price: size for price, size in msg['asks'] }
                         }
                         '''
-                        ob = simpleob.convert_coinbase_ob(msg)
+                        ob = simpleob.Orderbook(simpleob.convert_coinbase_ob(msg))
 
                     if msg_type == 'l2update':
                         #print(msg['changes'])
                         #self.update_coinbase_ob(ob, msg)
-                        simpleob.apply_ob_update(ob, simpleob.convert_coinbase_update(msg))
+                        ob.update(simpleob.convert_coinbase_update(msg))
                         async with self.lock:
                             #best_bid = sorted(list(ob['buy'].keys()), key=lambda k: round(float(k),2), reverse=True)
                             #best_ask = sorted(list(ob['sell'].keys()), key=lambda k: round(float(k),2))
@@ -323,21 +323,35 @@ class EventFeed():
             }))
             try:
                 #ob = {}
-                ob = pd.Series()
+                ob = None
                 while True:
-                    data = json.loads(await ws.recv())
+                    data = fastjson.loads(await fastjson.recv(ws))
                     if 'book-10' in data:
                         #if ob == {}:
-                        if ob.empty:
-                            ob = simpleob.convert_kraken_ob(data)
+                        if ob is None:
+                            ob = simpleob.Orderbook(simpleob.convert_kraken_ob(data), max_depth=10, checksum_depth=10)
                         else:
                             #changes = list(filter(lambda k: type(k) == dict, data))
-                            simpleob.apply_ob_update(ob, simpleob.convert_kraken_update(data), max_depth=10)
+                            ob.update(simpleob.convert_kraken_update(data))
+                            checksum = simpleob.convert_kraken_checksum(data)
+                            if checksum is not None and not ob.verify_checksum(checksum):
+                                # Book has drifted; resubscribing makes kraken send a fresh snapshot
+                                print('kraken checksum mismatch, resubscribing to book')
+                                ob = None
+                                for event in ('unsubscribe', 'subscribe'):
+                                    await ws.send(json.dumps({
+                                        'event': event,
+                                        'pair': [KRAKEN_ID],
+                                        'subscription': {
+                                            'name': 'book',
+                                        }
+                                    }))
+                                continue
                             #self.update_kraken_ob(ob, changes)
                     elif data['event'] == 'heartbeat': continue
                     elif data['event'] == 'systemStatus': continue
 
-                    if not ob.empty:
+                    if ob is not None:
                         async with self.lock:
                             '''
                             self.queue.put_nowait({'exchange': 'kraken',
@@ -10,7 +10,7 @@ import websockets
 import CoinbaseAPI as cbapi
 import KrakenAPI as kapi
 import ob as simpleob
-import pandas as pd
+from util import fastjson
 from exchange import Exchange, UnknownOrderException
 from fp import FixedPrecision
 
@@ -763,10 +763,10 @@ class EventFeed():
                 ]
             }))
             try:
-                ob = pd.Series()
+                ob = None
                 last_trade_id = None
                 while True:
-                    msg = json.loads(await ws.recv())
+                    msg = fastjson.loads(await fastjson.recv(ws))
                     msg_type = msg['type']
                     #print(msg_type)
 
@@ -780,12 +780,12 @@ class EventFeed():
                             'sell': { price: size for price, size in msg['asks'] }
                         }
                         '''
-                        ob = simpleob.convert_coinbase_ob(msg)
+                        ob = simpleob.Orderbook(simpleob.convert_coinbase_ob(msg))
 
                     if msg_type == 'l2update':
                         #print(msg['changes'])
                         #self.update_coinbase_ob(ob, msg)
-                        simpleob.apply_ob_update(ob, simpleob.convert_coinbase_update(msg))
+                        ob.update(simpleob.convert_coinbase_update(msg))
                         async with self.lock:
                             #best_bid = sorted(list(ob['buy'].keys()), key=lambda k: round(float(k),2), reverse=True)
                             #best_ask = sorted(list(ob['sell'].keys()), key=lambda k: round(float(k),2))
@@ -823,7 +823,7 @@ class EventFeed():
                             print(f'[Dropped messages] last_trade_id: {last_trade_id} trade_id: {msg["trade_id"]}')
                         last_trade_id = msg['trade_id']
 
-                        if not ob.empty:
+                        if ob is not None:
                             async with self.lock:
                                 self.queue.put_nowait({'exchange': 'coinbase',
                                     'match': msg,
@@ -902,19 +902,33 @@ class EventFeed():
             }))
 
             try:
-                ob = pd.Series()
+                ob = None
                 while True:
-                    data = json.loads(await ws.recv())
+                    data = fastjson.loads(await fastjson.recv(ws))
                     #print(f'data: {data}')
                     if 'book-10' in data:
                         #if ob == {}:
-                        if ob.empty:
-                            ob = simpleob.convert_kraken_ob(data)
+                        if ob is None:
+                            ob = simpleob.Orderbook(simpleob.convert_kraken_ob(data), max_depth=10, checksum_depth=10)
                         else:
                             #changes = list(filter(lambda k: type(k) == dict, data))
-                            simpleob.apply_ob_update(ob, simpleob.convert_kraken_update(data), max_depth=10)
+                            ob.update(simpleob.convert_kraken_update(data))
+                            checksum = simpleob.convert_kraken_checksum(data)
+                            if checksum is not None and not ob.verify_checksum(checksum):
+                                # Book has drifted; resubscribing makes kraken send a fresh snapshot
+                                print('kraken checksum mismatch, resubscribing to book')
+                                ob = None
+                                for event in ('unsubscribe', 'subscribe'):
+                                    await ws.send(json.dumps({
+                                        'event': event,
+                                        'pair': [KRAKEN_ID],
+                                        'subscription': {
+                                            'name': 'book',
+                                        }
+                                    }))
+                                continue
                             #self.update_kraken_ob(ob, changes)
-                    elif 'trade' in data and not ob.empty:
+                    elif 'trade' in data and ob is not None:
                         async with self.lock:
                             self.queue.put_nowait({'exchange': 'kraken',
                                 'match': data[1],
@@ -926,7 +940,7 @@ class EventFeed():
                     #elif data['event'] == 'subscriptionStatus':
                     #    print(data)
 
-                    if not ob.empty:
+                    if ob is not None:
                         async with self.lock:
                             '''
                             self.queue.put_nowait({'exchange': 'kraken',
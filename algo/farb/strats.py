@@ -1,3 +1,5 @@
+from api import orders
+
 # More accurately ForwardArbStrat
 class ArbStrat():
     def __init__(self, api, swap, forward):
@@ -35,6 +37,9 @@ class StratOrder():
     STATE_CANCELLED = -3
     STATE_DONE = -4
 
+    # Times a failed hedge order is resent before flattening
+    HEDGE_RETRIES = 2
+
     def __init__(self):
         self.state = self.STATE_NEW
         self.ids = set()
@@ -113,8 +118,17 @@ class ArbSellMMSwap(ArbStrat):
                             print('Stopping..')
                             print(f'Placing market sell order for 1 call {self.strat.forward.call.id}')
                             print(f'Placing market buy order for 1 put {self.strat.forward.put.id}')
-                            await self.strat.api.market_sell(self.strat.forward.call.id, 1)
-                            await self.strat.api.market_buy(self.strat.forward.put.id, 1)
+                            call, put = self.strat.forward.call.id, self.strat.forward.put.id
+                            swap = self.strat.swap.id
+                            legs = await orders.dispatch_legs([
+                                orders.Leg('call', lambda: self.strat.api.market_sell(call, 1), lambda result: self.strat.api.market_buy(call, 1), retries=self.HEDGE_RETRIES),
+                                orders.Leg('put', lambda: self.strat.api.market_buy(put, 1), lambda result: self.strat.api.market_sell(put, 1), retries=self.HEDGE_RETRIES)
+                            ])
+                            print(f'Hedge legs: {", ".join(str(leg) for leg in legs)}')
+                            if not all(leg.ok for leg in legs):
+                                # Can't complete the hedge, so flatten it along with the swap fill
+                                print('Hedge failed, unwinding swap fill and hedges')
+                                await orders.unwind_legs([ orders.Leg('swap', unwind=lambda result: self.strat.api.market_sell(swap, 1)), *legs ])
                             self.state = self.STATE_DONE
                         elif msg['status_type'] == ledgerx.STATUS_CANCELLED:
                             print(f'Order cancelled.')
@@ -199,8 +213,17 @@ class ArbSellMMPut(ArbStrat):
                             print('Stopping..')
                             print(f'Placing market buy order for 1 swap {self.strat.swap.id}')
                             print(f'Placing market sell order for 1 call {self.strat.forward.call.id}')
-                            await self.strat.api.market_buy(self.strat.swap.id, 1)
-                            await self.strat.api.market_sell(self.strat.forward.call.id, 1)
+                            swap, call = self.strat.swap.id, self.strat.forward.call.id
+                            put = self.strat.forward.put.id
+                            legs = await orders.dispatch_legs([
+                                orders.Leg('swap', lambda: self.strat.api.market_buy(swap, 1), lambda result: self.strat.api.market_sell(swap, 1), retries=self.HEDGE_RETRIES),
+                                orders.Leg('call', lambda: self.strat.api.market_sell(call, 1), lambda result: self.strat.api.market_buy(call, 1), retries=self.HEDGE_RETRIES)
+                            ])
+                            print(f'Hedge legs: {", ".join(str(leg) for leg in legs)}')
+                            if not all(leg.ok for leg in legs):
+                                # Can't complete the hedge, so flatten it along with the put fill
+                                print('Hedge failed, unwinding put fill and hedges')
+                                await orders.unwind_legs([ orders.Leg('put', unwind=lambda result: self.strat.api.market_sell(put, 1)), *legs ])
                             self.state = self.STATE_DONE
                         if msg['status_type'] == ledgerx.STATUS_CANCELLED:
                             print('Order cancelled')
@@ -9,15 +9,13 @@ import signal
 import datetime
 import heapq
 
-import pandas as pd
-import aiostream
-
 from api import trade
 from api import ob as simpleob
 from api import CoinbaseAPI
 from api import BinanceAPI
 from api import PoloniexAPI
 from api import common
+from api import orders
 from util import util, async_util
 from util.util import RED, GREEN, CYAN, YELLOW, BLUE, BR_BLACK_BG, END
 
@@ -47,14 +45,15 @@ class ExchangeInfo():
         self.min_notional = min_notional
 
 _EXCHANGES = {
+    # Async order gateways, so orders in flight don't hold up the feeds
     'coinbase': {
-        'api': CoinbaseAPI.CoinbaseAPI
+        'api': CoinbaseAPI.CoinbaseAsyncAPI
     },
     'binance_us': {
-        'api': BinanceAPI.BinanceAPI
+        'api': BinanceAPI.BinanceAsyncAPI
     },
     'poloniex': {
-        'api': PoloniexAPI.PoloniexAPI
+        'api': PoloniexAPI.PoloniexAsyncAPI
     }
 }
 
@@ -70,6 +69,8 @@ class Strat():
 
         self.maker_fee = self.get_maker_fee()
         self.taker_fee = self.get_taker_fee()
+        # (book, side, price limit) the taker leg was last sized against, see _taker_depth
+        self.taker_depth = None
 
         self.update()
     
@@ -91,12 +92,45 @@ class Strat():
     def liquidate(self, market_price, quantity):
         raise NotImplementedError
 
+    # Both books are up to date, rather than frozen by a dropped feed
+    def valid(self):
+        return self.a.ob.valid and self.b.ob.valid
+
     def best_maker_price():
         raise NotImplementedError
 
     def _quantity(self):
         raise NotImplementedError
 
+    def _taker_depth(self, ob, side, limit, balance):
+        '''
+        Sizes the taker leg against the taker's book rather than just its touch: at least the touch, plus any
+        deeper levels up to the break even price limit. Sets taker_price to the worst price reached (the limit
+        for the FOK take) and taker_vwap to the average fill price. Returns the quantity.
+        '''
+        self.taker_depth = (ob, side, limit)
+        quantity = max(ob.size_to(side, limit), self.taker_quantity)
+        quantity = min(balance, quantity).quantize(max(self.a.base_precision, self.b.base_precision), rounding=ROUND_DOWN)
+
+        self.taker_vwap = self.taker_price
+        if quantity > 0 and ob.price_for_size(side, quantity) is not None:
+            self.taker_price = ob.price_for_size(side, quantity)
+            self.taker_vwap = ob.vwap(side, quantity)
+        return quantity
+
+    def depth_changed(self, ob, update):
+        ''' Whether an update to ob touches levels the taker leg is sized against, so sizing needs redoing '''
+        if self.taker_depth is None or self.taker_depth[0] is not ob:
+            return False
+
+        _, side, limit = self.taker_depth
+        for row_side, price, *_ in update:
+            if row_side == side:
+                price = ob.quotetype(price)
+                if (price >= limit if side == 'bids' else price <= limit):
+                    return True
+        return False
+
     def __lt__(self, other):
         return self.profit() < other.profit()
 
@@ -203,16 +237,16 @@ class Strat1(Strat):
         return self.b.api.market_sell_order(self.b.api.convert_pair(self.pair), self.quantity)
 
     def profit(self):
-        spread = self.taker_price * (1 - self.taker_fee) - self.maker_price * (1 + self.maker_fee)
+        spread = self.taker_vwap * (1 - self.taker_fee) - self.maker_price * (1 + self.maker_fee)
         if spread > 0 and (self.quantity * self.maker_price < self.maker.min_notional * Decimal(1.06) or self.quantity * self.taker_price < self.taker.min_notional * Decimal(1.06)):
             spread = -spread
         return spread * self.quantity
 
     def _quantity(self):
-        return min(self.b.balance, self.b.ob.best_bid()[1]).quantize(max(self.a.base_precision, self.b.base_precision), rounding=ROUND_DOWN)
+        return self._taker_depth(self.b.ob, 'bids', self.maker_price * (1 + self.maker_fee) / (1 - self.taker_fee), self.b.balance)
 
     def cancel_make(self, order_id):
-        self.a.api.cancel_order(order_id, pair=self.a_pair)
+        return self.a.api.cancel_order(order_id, pair=self.a_pair)
 
     def adjust_maker_balance(self, delta):
         self.a.balance += Decimal(delta)
@@ -278,16 +312,16 @@ class Strat2(Strat):
         return self.a.api.market_sell_order(self.a.api.convert_pair(self.pair), self.quantity)
 
     def profit(self):
-        spread = self.taker_price * (1 - self.taker_fee) - self.maker_price * (1 + self.maker_fee)
+        spread = self.taker_vwap * (1 - self.taker_fee) - self.maker_price * (1 + self.maker_fee)
         if spread > 0 and (self.quantity * self.maker_price < self.maker.min_notional * Decimal(1.06) or self.quantity * self.taker_price < self.taker.min_notional * Decimal(1.06)):
             spread = -spread
         return spread * self.quantity
 
     def _quantity(self):
-        return min(self.a.balance, self.a.ob.best_bid()[1]).quantize(max(self.a.base_precision, self.b.base_precision), rounding=ROUND_DOWN)
+        return self._taker_depth(self.a.ob, 'bids', self.maker_price * (1 + self.maker_fee) / (1 - self.taker_fee), self.a.balance)
 
     def cancel_make(self, order_id):
-        self.b.api.cancel_order(order_id, pair=self.b_pair)
+        return self.b.api.cancel_order(order_id, pair=self.b_pair)
 
     def adjust_maker_balance(self, delta):
         self.b.balance += Decimal(delta)
@@ -352,16 +386,16 @@ class Strat3(Strat):
         return self.b.api.market_buy_order(self.b.api.convert_pair(self.pair), self.quantity)
 
     def profit(self):
-        spread = self.maker_price * (1 - self.maker_fee) - self.taker_price * (1 + self.taker_fee)
+        spread = self.maker_price * (1 - self.maker_fee) - self.taker_vwap * (1 + self.taker_fee)
         if spread > 0 and (self.quantity * self.maker_price < self.maker.min_notional * Decimal(1.06) or self.quantity * self.taker_price < self.taker.min_notional * Decimal(1.06)):
             spread = -spread
         return spread * self.quantity
 
     def _quantity(self):
-        return min(self.a.balance, self.a.ob.best_ask()[1]).quantize(max(self.a.base_precision, self.b.base_precision), rounding=ROUND_DOWN)
+        return self._taker_depth(self.b.ob, 'asks', self.maker_price * (1 - self.maker_fee) / (1 + self.taker_fee), self.a.balance)
 
     def cancel_make(self, order_id):
-        self.a.api.cancel_order(order_id, pair=self.a_pair)
+        return self.a.api.cancel_order(order_id, pair=self.a_pair)
 
     def adjust_maker_balance(self, delta):
         self.a.balance -= Decimal(delta)
@@ -426,16 +460,16 @@ class Strat4(Strat):
         return self.a.api.market_buy_order(self.b.api.convert_pair(self.pair), self.quantity)
 
     def profit(self):
-        spread = self.maker_price * (1 - self.maker_fee) - self.taker_price * (1 + self.taker_fee)
+        spread = self.maker_price * (1 - self.maker_fee) - self.taker_vwap * (1 + self.taker_fee)
         if spread > 0 and (self.quantity * self.maker_price < self.maker.min_notional * Decimal(1.06) or self.quantity * self.taker_price < self.taker.min_notional * Decimal(1.06)):
             spread = -spread
         return spread * self.quantity
 
     def _quantity(self):
-        return min(self.b.balance, self.b.ob.best_ask()[1]).quantize(max(self.a.base_precision, self.b.base_precision), rounding=ROUND_DOWN)
+        return self._taker_depth(self.a.ob, 'asks', self.maker_price * (1 - self.maker_fee) / (1 + self.taker_fee), self.b.balance)
 
     def cancel_make(self, order_id):
-        self.b.api.cancel_order(order_id, pair=self.b_pair)
+        return self.b.api.cancel_order(order_id, pair=self.b_pair)
 
     def adjust_maker_balance(self, delta):
         self.b.balance -= Decimal(delta)
@@ -498,7 +532,7 @@ class Strat5(Strat):
     def __init__(self, a, b):
         super().__init__(a, b)
 
-    def liquidate(self, market_price, quantity):
+    async def liquidate(self, market_price, quantity):
         pass
 
     def make(self, price, quantity):
@@ -508,7 +542,7 @@ class Strat5(Strat):
         return self.liquidate(price, quantity)
 
     # No cancellations for takers
-    def cancel_make(self, order_id):
+    async def cancel_make(self, order_id):
         pass
 
     # TODO -- Modify these methods to call the correct method
@@ -586,8 +620,47 @@ def init_exchanges(exchanges):
 
     return info
 
-async def stop(websockets):
+# Resends of a rejected taker order, and of a cancel that got no answer, before giving up on them
+HEDGE_RETRIES = 2
+CANCEL_RETRIES = 2
+
+def cancel_leg(strat, order_id):
+    ''' Cancelling the rest of a maker order. Resending a cancel is harmless, so anything but a rejection is retried '''
+    return orders.Leg('cancel', lambda: strat.cancel_make(order_id), retries=CANCEL_RETRIES, retry_if=lambda e: not orders.rejected(e))
+
+async def hedge(strat, taker_price, price, quantity, taker_orders, legs=()):
+    '''
+    Takes a maker fill of quantity at price on the taker exchange, at once with any other legs (ex: cancel_leg). If
+    the taker order is still rejected after its retries, the fill is unwound instead, by liquidating it on the maker
+    exchange. Any other failure (ex: a timeout) may have filled, so it's only logged. Orders placed are added to
+    taker_orders. Returns the legs.
+    '''
+    async def unwind_fill(result):
+        order = await strat.liquidate_maker(price, quantity)
+        # As when a fill is too small for the taker exchange
+        strat.adjust_maker_balance(-quantity)
+        strat.adjust_taker_balance(-quantity)
+        taker_orders[order.order_id] = order
+
+    take = orders.Leg('liquidate', lambda: strat.liquidate(taker_price, quantity), retries=HEDGE_RETRIES)
+    legs = await orders.dispatch_legs([ take, *legs ])
+    if take.ok:
+        taker_orders[take.result.order_id] = take.result
+    elif orders.rejected(take.error):
+        _log.error(f'Taker order rejected, liquidating the maker fill instead: {take}')
+        await orders.unwind_legs([ orders.Leg('fill', unwind=unwind_fill) ])
+    else:
+        _log.error(f'Taker order failed and may still have filled, check the taker exchange: {take}')
+    return legs
+
+def _log_task_error(task):
+    if not task.cancelled() and task.exception():
+        _log.error(f'Task {task.get_name()} failed: {task.exception()!r}')
+
+async def stop(websockets, background=()):
     _log.info('Stopping mirror bot')
+    # Our own background tasks first, then whatever else is running
+    [task.cancel() for task in background]
     tasks = [ task for task in asyncio.all_tasks() if task is not asyncio.current_task() ]
     [task.cancel() for task in tasks]
     await asyncio.gather(*tasks)
@@ -607,6 +680,13 @@ async def main():
     #exchange_list = {'poloniex': 'BCHABC/USDC', 'binance_us': 'BCH/USD'}
     #exchange_list = {'poloniex': 'USDT/USDC', 'binance_us': 'USDT/USD'} # Promising
     exchanges = init_exchanges(exchange_list)
+    # Keeps the order connections open through quiet periods
+    # Held here, since the loop only keeps weak references to tasks
+    background = []
+    for info in exchanges.values():
+        task = asyncio.create_task(info.api.keep_warm(), name=f'keep_warm-{info.exchange}')
+        task.add_done_callback(_log_task_error)
+        background.append(task)
 
     feeds = await trade.create_feeds(exchange_list)
     for exchange in exchange_list:
@@ -618,7 +698,7 @@ async def main():
     strats = [ Strat(exchanges[a], exchanges[b]) for a, b in exchange_pairs for Strat in [ Strat1, Strat2, Strat3, Strat4 ] ]
     #strats = [ Strat(exchanges[a], exchanges[b]) for a, b in exchange_pairs for Strat in [ Strat5, Strat6 ] ]
 
-    asyncio.get_event_loop().add_signal_handler(signal.SIGINT, lambda: asyncio.create_task(stop([feeds[exchange]['ws'] for exchange in exchange_list])))
+    asyncio.get_event_loop().add_signal_handler(signal.SIGINT, lambda: asyncio.create_task(stop([feeds[exchange]['ws'] for exchange in exchange_list], background)))
     state = STATE_WAIT_FOR_ARB
     taker_price = 0
     liquidation_price = 0
@@ -636,10 +716,20 @@ async def main():
         STATE_DONE:           'DONE          '
     }
 
-    async for event in aiostream.stream.merge(*[ exchange['ws'] for exchange in feeds.values() ]):
+    # Books are kept up to date by the feeds. Strategies need recomputing when a BBO moves, or when the
+    # depth a taker leg is sized against changes. Order events jump ahead of queued market data
+    merged = async_util.merge(*[ trade.BookFeed(exchange['ws'], exchange['ob'], updates=True) for exchange in feeds.values() ], names=list(feeds))
+    async for event in merged:
         #_log.info(event.event_type)
+        if event.event_type == 'disconnected':
+            _log.warning(f'{state_name[state]} {color_exchange(event.exchange)} feed disconnected, not quoting until its book is rebuilt')
+
         if event.event_type == 'orderbook_update':
-            feeds[event.exchange]['ob'].update(event.update)
+            for strat in strats:
+                if strat.depth_changed(feeds[event.exchange]['ob'], event.update):
+                    strat.update()
+
+        if event.event_type == 'bbo':
             #if event.exchange == 'binance_us':
             #_log.info(f'BBO {feeds[event.exchange]["ob"].best_bid()}/{feeds[event.exchange]["ob"].best_ask()}')
 
@@ -655,19 +745,13 @@ async def main():
             else:
                 _log.info(f'{state_name[state]} {RED}(${current_strat.profit():2.10f}){END} - {current_strat}')
                 #current_strat = None
-        # Primarily needed in the case of poloniex, which occasionally dispatches a new orderbook snapshot
-        elif event.event_type == 'orderbook_snapshot':
-            _log.info(f'{state_name[state]} Initializing new orderbook for exchange: {event.exchange}')
-            feeds[event.exchange]['ob'] = simpleob.Orderbook(event.snapshot)
-            exchanges[event.exchange].ob = feeds[event.exchange]['ob']
-            continue
 
         # Run state machine here -- need to process order events.
         if state == STATE_WAIT_FOR_ARB:
-            if current_strat and current_strat.profitable():
+            if current_strat and current_strat.valid() and current_strat.profitable():
                 _log.info(f'{state_name[state]} Placing order: {current_strat}')
                 try:
-                    maker_order = current_strat.make(current_strat.maker_price, current_strat.quantity)
+                    maker_order = await current_strat.make(current_strat.maker_price, current_strat.quantity)
                     taker_price = current_strat.taker_price
                     state = STATE_WAIT_FOR_MATCH
                 except common.ExchangeException as e:
@@ -683,27 +767,30 @@ async def main():
 
                     current_strat.adjust_maker_balance(event.quantity)
                     maker_total += event.quantity * event.price
+                    legs = []
+                    if event.quantity < maker_order.size:
+                        # Attempt to cancel the remainder of the order
+                        _log.info(f'{state_name[state]} Attempting to cancel remaining maker order')
+                        legs.append(cancel_leg(current_strat, maker_order.order_id))
+
+                    # The taker order and the maker cancel are in flight at the same time
                     # May not post if the size is too small for the exchange
                     if event.price * event.quantity >= current_strat.taker.min_notional:
                         _log.info(f'{state_name[state]} Taker order: {taker_price}@{event.quantity} (original size: {maker_order.size})')
-                        order = current_strat.liquidate(taker_price, event.quantity)
-                        taker_orders[order.order_id] = order
-
-                    if event.quantity < maker_order.size:
-                        # Attempt to cancel the remainder of the order
-                        try:
-                            _log.info(f'{state_name[state]} Attempting to cancel remaining maker order')
-                            current_strat.cancel_make(maker_order.order_id)
-                        except common.ExchangeException as e:
-                            _log.error(f'{state_name[state]} Failed to cancel remaining maker order: {e.reason}')
+                        await hedge(current_strat, taker_price, event.price, event.quantity, taker_orders, legs)
+                    else:
+                        await orders.dispatch_legs(legs)
+                    for leg in legs:
+                        if not leg.ok:
+                            _log.error(f'{state_name[state]} Failed to cancel remaining maker order, it may still fill: {leg}')
 
                     if event.price * event.quantity < current_strat.taker.min_notional:
-                        if event.price * event.quantity() > current_strat.maker.min_notional * Decimal(1.06):
+                        if event.price * event.quantity > current_strat.maker.min_notional * Decimal(1.06):
                             _log.info(f'{state_name[state]} Notional amount {event.quantity} too small, liquidating on maker.')
                             # Cancel out the adjustment
                             current_strat.adjust_maker_balance(-event.quantity)
                             current_strat.adjust_taker_balance(-event.quantity)
-                            order = current_strat.liquidate_maker(event.price, event.quantity)
+                            order = await current_strat.liquidate_maker(event.price, event.quantity)
                             taker_orders[order.order_id] = order
                         else:
                             _log.info(f'{state_name[state]} Cannot liquidate notional amount {event.quantity} on maker; value is too small.')
@@ -744,12 +831,12 @@ async def main():
                 '''
 
             # Alternatively, if all have is some sort of OB update, then perform the following check
-            elif not current_strat.profitable() or current_strat.quantity < maker_order.size or not current_strat.best_maker_price(maker_order.price):
+            elif not current_strat.valid() or not current_strat.profitable() or current_strat.quantity < maker_order.size or not current_strat.best_maker_price(maker_order.price):
                 #current_strat.cancel_make(maker_order.order_id)
-                _log.info(f'{state_name[state]} Cancel order - Profitable: {current_strat.profitable()} Insufficient quantity: {current_strat.quantity < maker_order.size} Best price: {current_strat.best_maker_price(maker_order.price)}')
+                _log.info(f'{state_name[state]} Cancel order - Valid books: {current_strat.valid()} Profitable: {current_strat.profitable()} Insufficient quantity: {current_strat.quantity < maker_order.size} Best price: {current_strat.best_maker_price(maker_order.price)}')
 
                 try:
-                    current_strat.cancel_make(maker_order.order_id)
+                    await current_strat.cancel_make(maker_order.order_id)
                     state = STATE_CANCEL_MAKE
                 except common.ExchangeException as e:
                     _log.error(f'{state_name[state]} Failed to cancel unprofitable maker order: {e.reason}')
@@ -774,12 +861,11 @@ async def main():
                     maker_total += event.quantity * event.price
                     if event.quantity * taker_price >= current_strat.taker.min_notional:
                         _log.info(f'{state_name[state]} Liquidating')
-                        order = current_strat.liquidate(taker_price, event.quantity)
-                        taker_orders[order.order_id] = order
+                        await hedge(current_strat, taker_price, event.price, event.quantity, taker_orders)
                     else:
                         if event.quantity * event.price > current_strat.maker.min_notional * Decimal(1.06):
                             _log.info(f'{state_name[state]} Liquidating fill of size {event.quantity} on maker; notional value too small')
-                            order = current_strat.liquidate_maker(event.price, event.quantity)
+                            order = await current_strat.liquidate_maker(event.price, event.quantity)
                             taker_orders[order.order_id] = order
                             current_strat.adjust_maker_balance(-event.quantity)
                             current_strat.adjust_taker_balance(-event.quantity)
@@ -1,11 +1,11 @@
 import asyncio
 import logging
 from math import ceil, floor
-from decimal import Decimal as D
+from decimal import Decimal as D, ROUND_DOWN
 from collections import namedtuple
 from itertools import groupby
 
-from api import trade, common, BinanceAPI, CoinbaseAPI
+from api import trade, common, ingest, BinanceAPI, CoinbaseAPI
 from util import util
 
 #Balance = namedtuple('Balance', 'inventory quote')
@@ -331,17 +331,6 @@ class AskBot(MakerBot):
             self.log.debug(f'Finished order {event.id}. Remaining orders: {self.orders.items()}')
             #del self.orders[event.id]
 
-class FixedPrecision(int):
-    def __new__(cls, value, prec):
-        #value = int(value * 1/prec)
-        obj = int.__new__(cls, value)
-        obj.value = value
-        obj.prec = prec
-        return obj
-
-    def __str__(self):
-        return str(self.value * self.prec)
-
 class AskSide():
     def __init__(self, pair, api):
         self.exchange_api = api
@@ -377,12 +366,13 @@ class BidSide():
     def compare_price(self, p1, p2):
         return p1 - p2
 
+# Prices are in ticks
 def calculate_bbo(best_bid, best_ask, min_spread):
     spread = best_ask - best_bid
     ticks = min_spread - spread
 
     if ticks != 0:
-        return (FixedPrecision(best_bid - ceil(ticks/2), best_bid.prec), FixedPrecision(best_ask + floor(ticks/2), best_ask.prec))
+        return (best_bid - ceil(ticks/2), best_ask + floor(ticks/2))
 
     return (best_bid, best_ask)
 
@@ -395,14 +385,24 @@ async def main():
     pair = 'REP/USD'
 
     exchange_name = 'coinbase'
+    # Run the feed and its book in a worker process (see api.ingest), off this loop
+    use_ingest = False
     #exchange_api = BinanceAPI.BinanceAPI(util.read_auth_file('auth.json'))
     exchange_api = CoinbaseAPI.CoinbaseAPI(util.read_auth_file('auth.json'))
 
     pair_info = list(filter(lambda p: p.pair == exchange_api.convert_pair(pair), exchange_api.get_products()))[0]
     base, quote = pair.split('/')
 
-    exchange = await trade.create_feed(exchange_name, pair)
-    orderbook, ws = exchange[exchange_name]['ob'], exchange[exchange_name]['ws']
+    # Coinbase sends sizes with 8 decimals, finer than base_increment, and tick mode can't drop any of them
+    book_base_precision = D('0.00000001')
+    if use_ingest:
+        # Yields the same bbo (in ticks) and order events as a BookFeed
+        feed = ingest.start({ exchange_name: (pair, pair_info.quote_precision, book_base_precision) })
+        orderbook = feed.books[exchange_name]
+    else:
+        exchange = await trade.create_feed(exchange_name, pair, quote_precision=pair_info.quote_precision, base_precision=book_base_precision)
+        orderbook, ws = exchange[exchange_name]['ob'], exchange[exchange_name]['ws']
+        feed = trade.BookFeed(ws, orderbook)
     log.info(f'Connected to {exchange_name} trade feed.')
 
     quote_balance = exchange_api.get_wallet_balance(quote).balance
@@ -428,18 +428,13 @@ async def main():
     active_bid, active_ask = None, None
     orders = {}
 
-    qz_price = lambda p: D(p).quantize(pair_info.quote_precision)
-    qz_quantity = lambda q: D(q).quantize(pair_info.base_precision)
-
-    pticks = lambda price: int(price * (1/pair_info.quote_precision))
-    qticks = lambda quantity: int(quantity * (1/pair_info.base_precision))
-    tprice = lambda ticks: int(ticks * pair_info.quote_precision)
-    tquantity = lambda ticks: int(ticks * pair_info.base_precision)
+    # The orderbook runs in tick mode, so reuse its scales for order events
+    pticks, qticks = orderbook.quotetype, orderbook.basetype
 
     # Programmatically set
     min_notional = 10
     transacted = 0
-    inventory = int(wallet.inventory * (1/pair_info.base_precision))
+    inventory = qticks(D(wallet.inventory).quantize(book_base_precision, rounding=ROUND_DOWN))
     outstanding = 0
 
     log.debug(f'Starting inventory: {inventory}')
@@ -447,32 +442,25 @@ async def main():
     bid_price, bid_quantity = None, None
     ask_price, ask_quantity = None, None
 
-    async for event in ws:
-        if event.event_type == 'orderbook_update':
-            orderbook.update(event.update)
-            bid_price, bid_quantity = orderbook.best_bid()
-            ask_price, ask_quantity = orderbook.best_ask()
+    # Only wake up for quoting when the top of the book moves
+    async for event in feed:
+        if event.event_type == 'bbo':
+            # Already in ticks
+            bid_price, bid_quantity = event.bid_price, event.bid_quantity
+            ask_price, ask_quantity = event.ask_price, event.ask_quantity
+            if bid_price is None or ask_price is None:
+                log.debug('One side of the book is empty, not quoting')
+                continue
             #best_bid = common.BookEntry(*orderbook.best_bid())
             #best_ask = common.BookEntry(*orderbook.best_ask())
-            #spread = D(best_ask.price - best_bid.price)
-
-            # Normalize
-            #bid_price = int(bid_price * 1/pair_info.quote_precision)
-            #bid_quantity = int(bid_quantity * 1/pair_info.base_precision)
-            bid_price = FixedPrecision(bid_price * (1/pair_info.quote_precision), pair_info.quote_precision)
-            bid_quantity = FixedPrecision(bid_quantity * (1/pair_info.base_precision), pair_info.base_precision)
-
-            #ask_price = int(ask_price * 1/pair_info.quote_precision)
-            #ask_quantity = int(ask_quantity * 1/pair_info.base_precision)
-            ask_price = FixedPrecision(ask_price * (1/pair_info.quote_precision), pair_info.quote_precision)
-            ask_quantity = FixedPrecision(ask_quantity * (1/pair_info.base_precision), pair_info.base_precision)
 
             log.debug(f'Book BBO: {bid_price},{bid_quantity}/{ask_price},{ask_quantity} spread: {ask_price - bid_price}')
             our_bid, our_ask = calculate_bbo(bid_price, ask_price, 3)
             log.debug(f'Our BBO: {our_bid}/{our_ask}\n')
 
             # Initialize as named tuple
-            prices = { 'buy': (our_bid, '1.00'), 'sell': (our_ask, '1.00') }
+            # Only convert back to Decimal here, since these go out as REST orders
+            prices = { 'buy': (orderbook.decimal_price(our_bid), '1.00'), 'sell': (orderbook.decimal_price(our_ask), '1.00') }
             opposite_side = { 'buy': 'sell', 'sell': 'buy' }
 
             # Order logic here 
@@ -538,7 +526,7 @@ async def main():
 
             # If our outstanding price is negative, we sold more than we bought. So we'll have to buy back that inventory at the ask price
             # to close.
-            outstanding_price = pticks(ask_price) if outstanding <= 0 else pticks(bid_price)
+            outstanding_price = ask_price if outstanding <= 0 else bid_price
 
             # Subtract, as an ask is negative but results in a notional gain, whereas a bid is positive but is a notional loss
             log.debug(f'est profit: {transacted - outstanding_price * outstanding}')
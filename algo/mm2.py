@@ -20,15 +20,30 @@ async def main():
 
     await ws.subscribe('REP/USD', 'full')
     logger.debug('Subscribed to full feed')
+
+    # Full channel messages buffer on the websocket meanwhile; those already in the snapshot are skipped by the book
+    api = CoinbaseAPI.CoinbaseAPI(util.read_auth_file('auth.json'))
+    get_l3_book = lambda: asyncio.get_event_loop().run_in_executor(None, lambda: api.get_orderbook('REP/USD'))
+    l3 = CoinbaseAPI.CoinbaseFullOrderbook(await get_l3_book())
+    logger.debug('Built L3 book')
     
     buy_orders = []
     open_orders = {}
     # Track time on book until a match occurs?
     async for event in ws:
+        l3.update(event)
+        if l3.gap:
+            logger.debug(f'Missed full channel messages at sequence {l3.sequence}, rebuilding L3 book')
+            l3 = CoinbaseAPI.CoinbaseFullOrderbook(await get_l3_book())
+            open_orders = {}
+            continue
+
         if event.event_type == 'order_open' and event.side == 'buy':
             open_orders[event.id] = event.timestamp
-            logger.debug(f'Opened order {event.id} at {event.timestamp}')
+            orders_ahead, size_ahead = l3.queue_position(event.id)
+            logger.debug(f'Opened order {event.id} at {event.timestamp} behind {orders_ahead} orders ({size_ahead})')
 
+        # Matches are reported against the resting (maker) order
         elif event.event_type == 'order_match' and event.side == 'buy' and event.id in open_orders:
             logger.debug(f'Time till match: {event.timestamp - open_orders[event.id]}')
             del open_orders[event.id]
@@ -1,26 +1,29 @@
 import asyncio
 import json
+import logging
 import time
-import hmac
+from urllib.parse import urlencode
 from decimal import Decimal
 
 import websockets
 import requests
-import pandas as pd
 
 from api import ob as simpleob
 from api import common
 from api import exchange
 from api import wrappers
+from util import fastjson
+from util import timestamps
+
+_log = logging.getLogger(__name__)
 
 class BinanceAuth(requests.auth.AuthBase):
     def __init__(self, api_key, api_secret):
         self.api_key = api_key
-        self.api_secret = api_secret
+        self.signer = exchange.Signer(api_secret.encode(), 'sha256')
 
     def sign(self, msg):
-        sig = hmac.new(self.api_secret.encode(), msg.encode(), 'sha256')
-        return sig.hexdigest()
+        return self.signer.hexdigest(msg.encode())
 
     def __call__(self, request):
         request.headers.update({'X-MBX-APIKEY': self.api_key})
@@ -34,13 +37,18 @@ class BinanceAuth(requests.auth.AuthBase):
 
         return request
 
-class BinanceAPI():
+class BinanceAPI(exchange.ExchangeAPI):
     ENDPOINT = 'https://api.binance.us'
     EXCHANGE = 'binance_us'
+    PING_URL = f'{ENDPOINT}/api/v3/ping'
 
-    def __init__(self, auth_data):
+    def __init__(self, auth_data, pool_size=exchange.POOL_SIZE):
+        super().__init__(pool_size)
         self.api_key = auth_data['binance_us']['api_key']
         self.api_secret = auth_data['binance_us']['api_secret']
+        self.auth = BinanceAuth(self.api_key, self.api_secret)
+        # (pair, side, type, time in force) -> serialized invariant part of the order body
+        self.templates = {}
 
     def get_wallet_balance(self, asset):
         wallet = list(filter(lambda k: k['asset'] == asset, self.get_account_information()['balances']))[0]
@@ -51,7 +59,7 @@ class BinanceAPI():
             'timestamp': int(time.time()*1000)
         }
 
-        resp = requests.get(f'{BinanceAPI.ENDPOINT}/api/v3/account', params=params, auth=BinanceAuth(self.api_key, self.api_secret))
+        resp = self.session.get(f'{BinanceAPI.ENDPOINT}/api/v3/account', params=params, auth=self.auth)
         resp.raise_for_status()
         return resp.json()
 
@@ -60,61 +68,63 @@ class BinanceAPI():
         # Possible that this should be 'makerCommission' and 'takerCommission'
         return common.Fees(Decimal(info['buyerCommission']), Decimal(info['sellerCommission']))
 
-    def _order(self, pair, side, ordertype, quantity, **kwargs):
-        # Just add the timestamp here
-
+    def _order_template(self, pair, side, ordertype, time_in_force):
+        key = (pair, side, ordertype, time_in_force)
+        template = self.templates.get(key)
+        if template is None:
+            params = {
+                'symbol': self.convert_pair(pair).upper(),
+                'side': side,
+                'type': ordertype,
+                'newOrderRespType': 'FULL',
+                'recvWindow': 10000
+            }
+            if time_in_force:
+                params['timeInForce'] = time_in_force
+            template = self.templates[key] = urlencode(params)
+        return template
+
+    # The url encoded order body. Only price, quantity and timestamp are formatted per order
+    def _order_body(self, pair, side, ordertype, quantity, **kwargs):
         if 'post_only' in kwargs:
             ordertype = 'LIMIT_MAKER'
 
-        order = {
-            'symbol': self.convert_pair(pair).upper(),
-            'side': side,
-            'type': ordertype,
-            'quantity': quantity,
-            'newOrderRespType': 'FULL',
-            'timestamp': int(time.time()*1000),
-            'recvWindow': 10000
-        }
-
         if 'IOC' in kwargs:
-            order['timeInForce'] = 'IOC'
-        if 'FOK' in kwargs:
-            order['timeInForce'] = 'FOK'
-
-        if ordertype == 'LIMIT':
-            order['price'] = kwargs['price']
-            if 'timeInForce' not in order:
-                order['timeInForce'] = 'GTC'
-            #order['timeInForce'] = time_in_force
-        elif ordertype == 'LIMIT_MAKER':
-            order['price'] = kwargs['price']
-
-        '''
+            time_in_force = 'IOC'
+        elif 'FOK' in kwargs:
+            time_in_force = 'FOK'
+        else:
+            time_in_force = 'GTC' if ordertype == 'LIMIT' else None
+
+        body = f'{self._order_template(pair, side, ordertype, time_in_force)}&quantity={quantity}&timestamp={int(time.time()*1000)}'
         if ordertype == 'LIMIT' or ordertype == 'LIMIT_MAKER':
-            try:
-                order['price'] = kwargs['price']
-                #order['timeInForce'] = time_in_force
-            except KeyError as e:
-                raise ValueError(f'Missing required parameter for limit order: {e.args[0]}')
-        '''
-        
-        resp = requests.post(f'{BinanceAPI.ENDPOINT}/api/v3/order', data=order, auth=BinanceAuth(self.api_key, self.api_secret))
+            body += f'&price={kwargs["price"]}'
+        return body
+
+    @staticmethod
+    def _parse_order(resp):
+        return common.Order(resp['orderId'], resp['type'].lower(), resp['side'].lower(), Decimal(resp['origQty']), price=Decimal(resp['price']))
+
+    def _order(self, pair, side, ordertype, quantity, **kwargs):
+        body = self._order_body(pair, side, ordertype, quantity, **kwargs)
+        resp = self.session.post(f'{BinanceAPI.ENDPOINT}/api/v3/order', data=body, headers=exchange.FORM_HEADERS, auth=self.auth)
         try:
             resp.raise_for_status()
         except requests.HTTPError as e:
-            raise common.ExchangeException('binance_us', e.response.text)
-        resp = resp.json()
-        return common.Order(resp['orderId'], resp['type'].lower(), resp['side'].lower(), Decimal(resp['origQty']), price=Decimal(resp['price']))
+            raise common.ExchangeException('binance_us', e.response.text, e.response.status_code)
+        return self._parse_order(resp.json())
 
-    def cancel_order(self, order_id, **kwargs):
-        order = {
+    def _cancel_params(self, order_id, **kwargs):
+        return {
             'symbol': self.convert_pair(kwargs['pair']).upper(),
             'orderId': order_id,
             'timestamp': int(time.time()*1000),
             'recvWindow': 10000
         }
 
-        resp = requests.delete(f'{BinanceAPI.ENDPOINT}/api/v3/order', data=order, auth=BinanceAuth(self.api_key, self.api_secret))
+    def cancel_order(self, order_id, **kwargs):
+        order = self._cancel_params(order_id, **kwargs)
+        resp = self.session.delete(f'{BinanceAPI.ENDPOINT}/api/v3/order', data=order, auth=self.auth)
         resp.raise_for_status()
         return resp.json()
 
@@ -137,7 +147,7 @@ class BinanceAPI():
             'recvWindow': 5000,
             'timestamp': int(time.time()*1000) # Just move into auth
         }
-        resp = requests.post(f'{BinanceAPI.ENDPOINT}/api/v3/order/test', data=order, auth=BinanceAuth(self.api_key, self.api_secret))
+        resp = self.session.post(f'{BinanceAPI.ENDPOINT}/api/v3/order/test', data=order, auth=self.auth)
         resp.raise_for_status()
         return resp.json()
 
@@ -147,24 +157,24 @@ class BinanceAPI():
             'timestamp': int(time.time()*1000)
         }
 
-        resp = requests.get(f'{BinanceAPI.ENDPOINT}/api/v3/openOrders', params=data, auth=BinanceAuth(self.api_key, self.api_secret))
+        resp = self.session.get(f'{BinanceAPI.ENDPOINT}/api/v3/openOrders', params=data, auth=self.auth)
         resp.raise_for_status()
         return resp.json()
 
     def get_products(self):
-        resp = requests.get(f'{BinanceAPI.ENDPOINT}/api/v1/exchangeInfo')
+        resp = self.session.get(f'{BinanceAPI.ENDPOINT}/api/v1/exchangeInfo')
         resp.raise_for_status()
         return _parse_exchange_info(resp.json())
 
     def get_server_time(self):
-        return requests.get(f'{BinanceAPI.ENDPOINT}/api/v1/time').json()
+        return self.session.get(f'{BinanceAPI.ENDPOINT}/api/v1/time').json()
 
     def get_feed_key(self):
         headers = {
             'X-MBX-APIKEY': self.api_key
         }
 
-        resp = requests.post(f'{BinanceAPI.ENDPOINT}/api/v1/userDataStream', headers=headers)
+        resp = self.session.post(f'{BinanceAPI.ENDPOINT}/api/v1/userDataStream', headers=headers)
         resp.raise_for_status()
         return resp.json()['listenKey']
 
@@ -177,7 +187,7 @@ class BinanceAPI():
             'listenKey': key
         }
 
-        resp = requests.put(f'{BinanceAPI.ENDPOINT}/api/v1/userDataStream', headers=headers, params=params)
+        resp = self.session.put(f'{BinanceAPI.ENDPOINT}/api/v1/userDataStream', headers=headers, params=params)
         resp.raise_for_status()
 
     def delete_feed_key(self, key):
@@ -189,104 +199,195 @@ class BinanceAPI():
             'listenKey': key
         }
 
-        resp = requests.delete(f'{BinanceAPI.ENDPOINT}/api/v1/userDataStream', headers=headers, params=params)
+        resp = self.session.delete(f'{BinanceAPI.ENDPOINT}/api/v1/userDataStream', headers=headers, params=params)
         resp.raise_for_status()
 
+    # Depths accepted by the REST depth endpoint
+    DEPTH_LIMITS = [ 5, 10, 20, 50, 100, 500, 1000, 5000 ]
+
+    # limit is rounded up to the nearest depth the endpoint accepts
     def get_orderbook(self, pair, limit=None):
         params = { 
             'symbol': self.convert_pair(pair).upper()
         }
 
         if limit:
-            params['limit'] = limit
+            params['limit'] = next((depth for depth in BinanceAPI.DEPTH_LIMITS if depth >= limit), BinanceAPI.DEPTH_LIMITS[-1])
 
-        ob = requests.get(f'{BinanceAPI.ENDPOINT}/api/v1/depth', params=params).json()
+        ob = self.session.get(f'{BinanceAPI.ENDPOINT}/api/v1/depth', params=params).json()
         return _standardize_orderbook(ob)
 
     @staticmethod
     def convert_pair(pair):
         return pair.lower().replace('/', '')
 
-class BinanceWebsocket():
+class BinanceAsyncAPI(BinanceAPI, exchange.AsyncExchangeAPI):
+    ''' Async order gateway, see exchange.AsyncExchangeAPI. Everything but orders stays blocking '''
+
+    def _signed(self, body):
+        return body + f'&signature={self.auth.sign(body)}'
+
+    def _headers(self):
+        return { 'X-MBX-APIKEY': self.api_key, **exchange.FORM_HEADERS }
+
+    async def _order(self, pair, side, ordertype, quantity, **kwargs):
+        body = self._order_body(pair, side, ordertype, quantity, **kwargs)
+        resp = await self._request('POST', f'{BinanceAPI.ENDPOINT}/api/v3/order', data=self._signed(body), headers=self._headers())
+        return self._parse_order(resp)
+
+    async def cancel_order(self, order_id, **kwargs):
+        body = urlencode(self._cancel_params(order_id, **kwargs))
+        return await self._request('DELETE', f'{BinanceAPI.ENDPOINT}/api/v3/order', data=self._signed(body), headers=self._headers())
+
+class BinanceWebsocket(exchange.ExchangeWebsocket):
+    '''
+    A single combined stream connection. Channels (any number of pairs' depth streams, and the user
+    feed's listen key) are added and removed on the live socket with SUBSCRIBE/UNSUBSCRIBE requests,
+    rather than reconnecting to a new stream url.
+    '''
+
     WEBSOCKET = 'wss://stream.binance.us:9443'
     EXCHANGE = 'binance_us'
 
+    PARSERS = {
+        'depthUpdate': 'parse_orderbook_update',
+        'executionReport': 'parse_order',
+        'outboundAccountInfo': 'parse_account_info',
+        'outboundAccountPosition': 'parse_account_position',
+        'response': 'parse_response'
+    }
+
+    # Seconds to wait for a SUBSCRIBE/UNSUBSCRIBE to be acknowledged
+    REQUEST_TIMEOUT = 10
+    # Listen keys expire after an hour without a keep-alive
+    FEED_KEY_RENEW_INTERVAL = 30 * 60
+
     @staticmethod
     async def connect():
-        return BinanceWebsocket()
+        return BinanceWebsocket(await websockets.connect(BinanceWebsocket.stream_url()))
 
-    async def _queue_events(self):
-        while True:
-            try:
-                await self.subscribe_event.wait()
-                async for event in self.ws:
-                    if self.iterating:
-                        data = json.loads(event)
-                        data = data['data'] if 'stream' in data else data
-                        subevents = self.parse(data)
-                        if type(subevents) == list:
-                            for subevent in self.parse(data):
-                                self.queue.put_nowait(subevent)
-                        else:
-                            self.queue.put_nowait(subevents)
-                        #self.queue.put_nowait(wrappers.BinanceWebsocketWrapper.parse(data))
-                        #await asyncio.sleep(0)
-            except websockets.exceptions.ConnectionClosed:
-                print('binance connection closed')
-            except asyncio.CancelledError:
-                raise
-
-    async def subscribe_orderbook_feed(self, pair):
-        await self.subscribe(f'{BinanceAPI.convert_pair(pair)}@depth@100ms')
+    async def open(self):
+        # Already subscribed to everything through the url, so there's nothing to replay
+        return await websockets.connect(self.stream_url(self.channels))
+
+    @staticmethod
+    def stream_url(channels=()):
+        ''' Combined stream url, already subscribed to channels '''
+        return f'{BinanceWebsocket.WEBSOCKET}/stream' + (f'?streams={"/".join(channels)}' if channels else '')
+
+    def decode(self, frame):
+        data = fastjson.loads(frame)
+        # Combined streams wrap each message
+        return data['data'] if 'stream' in data else data
+
+    def message_type(self, data):
+        # Replies to our requests are the only messages with an id
+        return 'response' if 'id' in data else data.get('e')
+
+    # interval is the diff stream's update speed, either '100ms' or '1000ms'
+    async def subscribe_orderbook_feed(self, pair, interval='100ms'):
+        await self.subscribe(self.orderbook_channel(pair, interval))
+
+    async def subscribe_orderbook_feeds(self, pairs, interval='100ms'):
+        await self.subscribe(*[ self.orderbook_channel(pair, interval) for pair in pairs ])
+
+    async def unsubscribe_orderbook_feed(self, pair, interval='100ms'):
+        await self.unsubscribe(self.orderbook_channel(pair, interval))
+
+    # Depth updates carry the symbol as s
+    @staticmethod
+    def product_id(pair):
+        return BinanceAPI.convert_pair(pair)
+
+    @staticmethod
+    def orderbook_channel(pair, interval='100ms'):
+        channel = f'{BinanceAPI.convert_pair(pair)}@depth'
+        return channel if interval == '1000ms' else f'{channel}@{interval}'
 
     async def subscribe_user_feed(self, auth_data, **kwargs):
-        api = BinanceAPI(auth_data)
-        channel = api.get_feed_key()
-        await self.subscribe(channel)
+        ''' Subscribes to a new listen key, which is kept alive in the background until unsubscribed '''
+        if self.feed_key:
+            return
 
-    async def subscribe(self, channel):
-        self.channels.add(channel)
-        streams = list(self.channels)
+        api = BinanceAPI(auth_data)
+        self.feed_key = await asyncio.get_event_loop().run_in_executor(None, api.get_feed_key)
+        await self.subscribe(self.feed_key)
+        self.feed_key_task = asyncio.create_task(self._renew_feed_key(api))
 
-        if len(self.channels) == 1:
-            stream = f'{BinanceWebsocket.WEBSOCKET}/ws/{streams[0]}'
-        elif len(self.channels) > 1:
-            stream = f'{BinanceWebsocket.WEBSOCKET}/stream?streams={"/".join(streams)}'
+    async def unsubscribe_user_feed(self):
+        if not self.feed_key:
+            return
 
-        if self.ws:
-            self.subscribe_event.clear()
-            await self.ws.close()
+        self.feed_key_task.cancel()
+        key, self.feed_key, self.feed_key_task = self.feed_key, None, None
+        await self.unsubscribe(key)
 
-        self.ws = await websockets.connect(stream)
-        self.subscribe_event.set()
+    async def _renew_feed_key(self, api):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.FEED_KEY_RENEW_INTERVAL)
+            try:
+                await loop.run_in_executor(None, api.renew_feed_key, self.feed_key)
+            except Exception as e:
+                # Most likely expired, so switch the stream over to a new one
+                _log.error(f'Failed to renew binance listen key, replacing it: {e}')
+                try:
+                    key = await loop.run_in_executor(None, api.get_feed_key)
+                    if key != self.feed_key:
+                        await self.subscribe(key)
+                        key, self.feed_key = self.feed_key, key
+                        await self.unsubscribe(key)
+                except Exception as e:
+                    _log.error(f'Failed to replace binance listen key: {e}')
+
+    async def subscribe(self, *channels):
+        channels = [ channel for channel in channels if channel not in self.channels ]
+        if channels:
+            await self._request('SUBSCRIBE', channels)
+            self.channels.update(channels)
+
+    async def unsubscribe(self, *channels):
+        channels = [ channel for channel in channels if channel in self.channels ]
+        if channels:
+            await self._request('UNSUBSCRIBE', channels)
+            self.channels.difference_update(channels)
+
+    async def _request(self, method, params):
+        ''' Sends a request over the socket, returning its result once acknowledged '''
+        await self.connected.wait()
+        self.request_id += 1
+        request_id = self.request_id
+        response = self.requests[request_id] = asyncio.get_event_loop().create_future()
+        try:
+            await self.ws.send(json.dumps({ 'method': method, 'params': params, 'id': request_id }))
+            return await asyncio.wait_for(response, self.REQUEST_TIMEOUT)
+        finally:
+            del self.requests[request_id]
 
-    def __init__(self):
+    def __init__(self, ws=None):
+        super().__init__(ws)
         self.orders = {}
-        self.ws = None
-        self.queue_event_task = asyncio.create_task(self._queue_events())
-        self.queue = asyncio.Queue()
         self.channels = set()
-        self.max_queue_size = 10
-        self.subscribe_event = asyncio.Event()
-        self.iterating = True
-
-    def __aiter__(self):
-        # In the future, stop when iterating ends
-        #self.iterating = True
-        return self
-
-    def __anext__(self):
-        return self.queue.get()
-
-    def parse(self, data):
-        parsers = {
-            'depthUpdate': self.parse_orderbook_update,
-            'executionReport': self.parse_order,
-            'outboundAccountInfo': lambda e: common.Event('account_info', 'binance'),
-            'outboundAccountPosition': lambda e: common.Event('account_position', 'binance')
-        }
-
-        return parsers[data['e']](data)
+        self.feed_key = None
+        self.feed_key_task = None
+        # Request id -> future for its response
+        self.requests = {}
+        self.request_id = 0
+
+    def parse_response(self, data):
+        response = self.requests.get(data['id'])
+        if response is None or response.done():
+            _log.warning(f'Unexpected binance response: {data}')
+        elif 'error' in data:
+            response.set_exception(common.ExchangeException(self.EXCHANGE, data['error'].get('msg')))
+        else:
+            response.set_result(data.get('result'))
+
+    def parse_account_info(self, data):
+        return common.GenericEvent('account_info', 'binance')
+
+    def parse_account_position(self, data):
+        return common.GenericEvent('account_position', 'binance')
 
     def parse_orderbook_update(self, data):
         updates = []
@@ -294,16 +395,18 @@ class BinanceWebsocket():
         updates.extend(list(map(lambda bid: ['bids', *bid], data['b'])))
         updates.extend(list(map(lambda ask: ['asks', *ask], data['a'])))
 
-        return common.OrderbookEvent('binance_us', updates, data['U'])
+        return common.OrderbookEvent('binance_us', updates, data['u'], timestamp=timestamps.ms_to_ns(data['E']), first_sequence=data['U'],
+            product=data['s'].lower())
 
     def parse_order(self, data):
         # Would be nice to parse data into a named tuple
         #print(f'order: {data}')
         #print(f'order: {data["x"]}, {data["X"]}, {data["i"]}, {data["p"]}, {data["q"]}, {data["l"]}, {data["z"]}, {data["L"]}, {data["t"]}')
         print(f'Binance: {data["x"]}, {data["X"]}')
+        timestamp = timestamps.ms_to_ns(data['E'])
         if data['x'] == 'NEW':
             #self.orders[data['i']] = (Decimal(data['p']), Decimal(data['q']))
-            return common.OrderOpenEvent('binance_us', data['i'], data['p'], data['q'])
+            return common.OrderOpenEvent('binance_us', data['i'], data['p'], data['q'], timestamp=timestamp)
             '''
             if data['o'] == 'LIMIT':
                 return common.OrderOpenEvent('binance', data['i'], data['p'], data['q'])
@@ -315,7 +418,7 @@ class BinanceWebsocket():
             '''
         elif data['x'] == 'CANCELED' or data['x'] == 'REJECTED' or data['x'] == 'EXPIRED':
             #del self.orders[data['i']]
-            return common.OrderDoneEvent('binance', data['i'], 'cancelled', side=data['S'].lower(), price=Decimal(data['p']), quantity=Decimal(data['q']))
+            return common.OrderDoneEvent('binance', data['i'], 'cancelled', side=data['S'].lower(), price=Decimal(data['p']), quantity=Decimal(data['q']), timestamp=timestamp)
         elif data['x'] == 'TRADE':
             # Need to return a MatchEvent, and then DoneEvent, if the order filled (probably need to integrate into binance websocket to track this)
             # We need to output an order of the partial amount filled
@@ -323,9 +426,9 @@ class BinanceWebsocket():
             events = []
 
             #events.append(common.OrderMatchEvent('binance_us', data['i'], data['p'], data['q']))
-            events.append(common.OrderMatchEvent('binance_us', data['i'], data['L'], data['l'], side=data['S'].lower()))
+            events.append(common.OrderMatchEvent('binance_us', data['i'], data['L'], data['l'], side=data['S'].lower(), timestamp=timestamp))
             if data['X'] == 'FILLED':   # May also have to deal with cancels from IOC
-                events.append(common.OrderDoneEvent('binance_us', data['i'], 'filled', side=data['S'].lower(), price=Decimal(data['p']), quantity=Decimal(data['q'])))
+                events.append(common.OrderDoneEvent('binance_us', data['i'], 'filled', side=data['S'].lower(), price=Decimal(data['p']), quantity=Decimal(data['q']), timestamp=timestamp))
             '''
             print(f"order exists: {data['i'] in self.orders}")
             #print(f'{data["i"]} ({self.orders[data["i"]]}) cumulative filled: {data["z"]}')
@@ -353,12 +456,11 @@ def _parse_exchange_info(info):
     #return [ common.ProductInfo(prod['symbol'].lower(), prod['baseAsset'], prod['quoteAsset'], Decimal('10') ** -prod['baseAssetPrecision'], Decimal('10') ** -prod['quoteCommissionPrecision']) for prod in info['symbols'] ]
 
 def _standardize_orderbook(ob):
-    return pd.Series({
-        'bids': pd.DataFrame(ob['bids'], columns=['price', 'quantity']),
-        'asks': pd.DataFrame(ob['asks'], columns=['price', 'quantity']),
+    return {
+        'bids': ob['bids'],
+        'asks': ob['asks'],
         'sequence': ob['lastUpdateId']
-    })
-    return ob
+    }
 
 def _standardize_ob_update(update):
     updates = []
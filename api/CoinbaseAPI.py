@@ -5,9 +5,9 @@ import hashlib
 import json
 import uuid
 import asyncio
-import itertools
-import heapq
 import logging
+from bisect import bisect_left, insort
+from collections import OrderedDict
 
 from decimal import Decimal
 from requests.auth import AuthBase
@@ -17,134 +17,180 @@ import websockets
 from api import ob as simpleob
 from api import common
 from api import wrappers
+from api import exchange
 
 log = logging.getLogger(__name__)
 _handler = logging.StreamHandler()
 _handler.setFormatter(logging.Formatter('%(asctime)s %(module)s %(levelname)s %(funcName)s %(message)s'))
 log.addHandler(_handler)
 
-class PriceLevel():
-    def __init__(self, price, order_id, quantity, side):
-        self.price = price
-        self.quantity = quantity
-        self.orders = {}
-        self.orders[order_id] = quantity
-        self.side = side
-
-    def __init__(self, price, orders, side):
-        self.price = price
-        self.side = side
-        self.orders = orders
-        self.quantity = sum(self.orders.values())
-
-    def reduce(self, order_id, quantity):
-        ''' Subtracts quantity from order_id on the books, and deletes if 0. Used for match messages. '''
-        self.orders[order_id] -= quantity
-        self.quantity -= quantity
-
-        if self.quantity == 0:
-            del self.orders[order_id]
-
-    def add(self, order_id, quantity):
-        ''' Adds order_id to orders with given quantity. Used for open messages. '''
-        self.orders[order_id] = quantity
-        self.quantity += quantity
-
-    def dead(self):
-        ''' Return true if this price level is dead, and should be removed '''
-        return self.orders == {}
-
-    # Necessary for heap tuple comparison
-    # Maybe not? 
-    def __getitem__(self, key):
-        price = -price if side == 'bid' else price
-        return (price, self.quantity)[key]
-
-    def __lt__(self, other):
-        return self.price > other.price if self.side == 'bid' else self.price < other.price
-
-# Coinbase Non-aggregated OB for full stream
-# Updates on match and open messages
+# Coinbase Non-aggregated (L3) OB for the full stream
 class CoinbaseFullOrderbook():
-    def __init__(self, snapshot):
-        # Orderbook is indexed by side, and consists of a hashtable which stores
-        # order ids, and (price, quantity, time?) tuples
-        # best_bid() and best_ask() aggregates the book
-        # How can we construct this to use a heap..?
-        # Could index by price level, which then contains a hashtable of (order_id -> quantity)
-        # side -> level -> order_id -> quantity
-        # May need custom level objects for the heap?
-
-        # Create heap here, using price level. Easiest way to convert non-aggregated snapshot?
-        # Maybe this is a good case for using groups..? (Sort by price first)
-        # Basically, create a list of price levels from groups, and heapify.
-        # Entry is (price, quantity, order_id)
-        self.orderbook = {}
-        bids = sorted([ (entry.price, entry.quantity, entry.order_id) for entry in snapshot['bids'].itertuples() ], key=lambda entry: entry[0], reverse=True)
-        aggregated_bids = { Decimal(price_level): { order_id: Decimal(q) for _, q, order_id in list(bid_group) } for price_level, bid_group in itertools.groupby(bids, key=lambda key: key[0]) }
-
-        self.orderbook['buy'] = [ PriceLevel(price, orders, 'bid') for price, orders in aggregated_bids.items() ]
-        heapq.heapify(self.orderbook['buy'])
-
-        asks = sorted([ (entry.price, entry.quantity, entry.order_id) for entry in snapshot['asks'].itertuples() ], key=lambda entry: entry[0], reverse=True)
-        aggregated_asks = { Decimal(price_level): { order_id: Decimal(q) for _, q, order_id in list(ask_group) } for price_level, ask_group in itertools.groupby(asks, key=lambda key: key[0]) }
-
-        self.orderbook['sell'] = [ PriceLevel(price, orders, 'ask') for price, orders in aggregated_asks.items() ]
-        heapq.heapify(self.orderbook['sell'])
+    '''
+    Each price level holds a FIFO queue of resting orders (order_id -> remaining size, in arrival order), and
+    an order_id -> (side, price) index locates any order's queue directly, so open, match, done and change
+    messages are O(1), besides inserting or removing a level in the sorted price index when one appears or
+    empties. Keys are ordered as in ob.Orderbook, with the best level last (buys by price, sells by -price).
+    Aggregated (L2) views are derived on demand.
 
-    def best_bid(self):
-        level = self.orderbook['buy'][0]
-        return (level.price, level.quantity)
+    The snapshot is a get_orderbook() (level 3) result. Messages at or below the book's sequence are ignored;
+    if one is skipped, gap is set and the book should be rebuilt from a fresh snapshot.
+    '''
 
-    def best_ask(self):
-        level = self.orderbook['sell'][0]
-        return (level.price, level.quantity)
+    def __init__(self, snapshot):
+        self.sequence = snapshot['sequence']
+        self.gap = False
+        # order_id -> (side, price)
+        self.orders = {}
+        # side -> price -> OrderedDict(order_id -> remaining size)
+        self.queues = { 'buy': {}, 'sell': {} }
+        # side -> price -> aggregate size
+        self.sizes = { 'buy': {}, 'sell': {} }
+        # side -> sorted list of price keys, best level last
+        self.index = { 'buy': [], 'sell': [] }
+
+        # The price index is sorted once per side, rather than inserting each level into it
+        for side, rows in (('buy', snapshot['bids']), ('sell', snapshot['asks'])):
+            for price, size, order_id in rows:
+                self._queue(order_id, side, Decimal(price), Decimal(size))
+            self.index[side] = sorted(self._key(side, price) for price in self.queues[side])
+
+    @staticmethod
+    def _key(side, price):
+        return price if side == 'buy' else -price
+
+    def _open(self, order_id, side, price, size):
+        if price not in self.queues[side]:
+            insort(self.index[side], self._key(side, price))
+        self._queue(order_id, side, price, size)
+
+    def _queue(self, order_id, side, price, size):
+        queue = self.queues[side].get(price)
+        if queue is None:
+            queue = self.queues[side][price] = OrderedDict()
+            self.sizes[side][price] = 0
+
+        queue[order_id] = size
+        self.sizes[side][price] += size
+        self.orders[order_id] = (side, price)
+
+    def _resize(self, order_id, size):
+        side, price = self.orders[order_id]
+        queue = self.queues[side][price]
+        self.sizes[side][price] += size - queue[order_id]
+        queue[order_id] = size
+
+    def _done(self, order_id):
+        side, price = self.orders.pop(order_id)
+        queue = self.queues[side][price]
+        self.sizes[side][price] -= queue.pop(order_id)
+
+        if not queue:
+            del self.queues[side][price]
+            del self.sizes[side][price]
+            index = self.index[side]
+            del index[bisect_left(index, self._key(side, price))]
 
     def update(self, event):
+        ''' Applies a full channel order event. Other events are ignored. '''
+        sequence = getattr(event, 'sequence', None)
+        if sequence is not None:
+            if sequence <= self.sequence:
+                return
+            if sequence > self.sequence + 1:
+                self.gap = True
+            self.sequence = sequence
+
+        # Orders which never rest on the book (market orders, immediate fills) only appear as received/done
         if event.event_type == 'order_open':
-            # Update format: [ [side, price, quantity] ] 0 means delete
-            #ob.update([['bids' if event.side == 'buy' else 'asks', D(event.price), D(event.quantity)]])
-            # Worried about indexing by price, since strange prices can be set in limit orders
-            self.orderbook[event.side][event.price].add(event.order_id, event.quantity)
+            self._open(event.id, event.side, event.price, event.quantity)
         elif event.event_type == 'order_match':
-            #ob.update([['bids' if event.side == 'buy' else 'asks', D(event.price), D(event.size)]])
-            self.orderbook[event.side][event.price].reduce(event.order_id, event.quantity)
+            if event.id in self.orders:
+                side, price = self.orders[event.id]
+                self._resize(event.id, self.queues[side][price][event.id] - event.quantity)
+        elif event.event_type == 'order_done':
+            if event.id in self.orders:
+                self._done(event.id)
+        elif event.event_type == 'order_change':
+            if event.id in self.orders:
+                self._resize(event.id, event.quantity)
+
+    def best_bid(self):
+        price = self.index['buy'][-1]
+        return (price, self.sizes['buy'][price])
+
+    def best_ask(self):
+        price = -self.index['sell'][-1]
+        return (price, self.sizes['sell'][price])
+
+    def top_levels(self, side, n=None):
+        ''' Aggregated (price, size) levels for side ('buy' or 'sell'), from the touch outward '''
+        index = self.index[side] if n is None else self.index[side][-n:]
+        return [ (self._key(side, key), self.sizes[side][self._key(side, key)]) for key in reversed(index) ]
+
+    def aggregate(self, depth=None):
+        ''' L2 snapshot of the book, in the format ob.Orderbook is built from '''
+        return {
+            'bids': [ [price, size] for price, size in self.top_levels('buy', depth) ],
+            'asks': [ [price, size] for price, size in self.top_levels('sell', depth) ],
+            'sequence': self.sequence
+        }
+
+    def queue_position(self, order_id):
+        ''' (orders ahead, size ahead) of order_id in its level's queue, or None if it isn't on the book '''
+        if order_id not in self.orders:
+            return None
+
+        side, price = self.orders[order_id]
+        orders, size = 0, 0
+        for queued_id, queued_size in self.queues[side][price].items():
+            if queued_id == order_id:
+                break
+            orders += 1
+            size += queued_size
+        return (orders, size)
 
 class CoinbaseExchangeAuth(AuthBase):
     def __init__(self, api_key, secret_key, passphrase):
         self.api_key = api_key
-        self.secret_key = secret_key
+        self.signer = exchange.Signer(base64.b64decode(secret_key), hashlib.sha256)
         self.passphrase = passphrase
 
     # Don't we want the timestamp in milliseconds..?
-    def __call__(self, request):
+    def headers(self, method, path_url, body=''):
         timestamp = str(time.time())
-        message = timestamp + request.method + request.path_url + (request.body or '')
-        hmac_key = base64.b64decode(self.secret_key)
-        signature = hmac.new(hmac_key, message.encode('utf-8'), hashlib.sha256)
+        message = timestamp + method + path_url + body
         #signature_b64 = signature.digest().encode('base64').rstrip('\n')
-        signature_b64 = base64.b64encode(signature.digest())
+        signature_b64 = base64.b64encode(self.signer.digest(message.encode('utf-8')))
 
-        request.headers.update({
-            'CB-ACCESS-SIGN': signature_b64,
+        return {
+            'CB-ACCESS-SIGN': signature_b64.decode(),
             'CB-ACCESS-TIMESTAMP': timestamp,
             'CB-ACCESS-KEY': self.api_key,
             'CB-ACCESS-PASSPHRASE': self.passphrase,
             'Content-Type': 'application/json'
-        })
+        }
+
+    def __call__(self, request):
+        body = request.body or ''
+        request.headers.update(self.headers(request.method, request.path_url, body.decode() if type(body) == bytes else body))
         return request
 
-class CoinbaseAPI():
+class CoinbaseAPI(exchange.ExchangeAPI):
     WEBSOCKET = 'wss://ws-feed.pro.coinbase.com'
     EXCHANGE = 'coinbase'
+    PING_URL = 'https://api.pro.coinbase.com/time'
 
-    def __init__(self, auth_data):
+    def __init__(self, auth_data, pool_size=exchange.POOL_SIZE):
+        super().__init__(pool_size)
         self.auth = CoinbaseExchangeAuth(auth_data['coinbase']['api_key'], auth_data['coinbase']['api_secret'],
                 auth_data['coinbase']['passphrase'])
         self.sandbox_auth = CoinbaseExchangeAuth(auth_data['coinbase']['sandbox_api_key'], 
                 auth_data['coinbase']['sandbox_api_secret'],
                 auth_data['coinbase']['sandbox_passphrase'])
         self.auth_data = auth_data
+        # (product, side) -> serialized invariant part of a limit order body
+        self.templates = {}
 
     @staticmethod
     def convert_pair(pair):
@@ -160,9 +206,10 @@ class CoinbaseAPI():
         return base64.b64encode(hmac.digest(base64.b64decode(self.api_secret), 'f{timestamp}{method}{req_path}{body}'.encode(),
             'sha256')).decode()
 
+    # data may be pre-serialized
     def _auth_post(self, req_path, params={}, data={}, sandbox=False):
-        resp = requests.post(f'{self._get_api_endpoint(sandbox)}{req_path}', auth=self._get_auth(sandbox), params=params, 
-                data=json.dumps(data))
+        resp = self.session.post(f'{self._get_api_endpoint(sandbox)}{req_path}', auth=self._get_auth(sandbox), params=params, 
+                data=data if type(data) == str else json.dumps(data))
 
         try:
             resp.raise_for_status()
@@ -175,7 +222,7 @@ class CoinbaseAPI():
         return resp.json()
 
     def _auth_get(self, req_path, params={}, sandbox=False):
-        resp = requests.get(f'{self._get_api_endpoint(sandbox)}{req_path}', auth=self._get_auth(sandbox), params=params)
+        resp = self.session.get(f'{self._get_api_endpoint(sandbox)}{req_path}', auth=self._get_auth(sandbox), params=params)
         resp.raise_for_status()
         return resp.json()
 
@@ -193,7 +240,7 @@ class CoinbaseAPI():
         }
 
         ob = self._auth_get(f'/products/{CoinbaseAPI.convert_pair(pair)}/book', params=params, sandbox=sandbox)
-        return (ob['sequence'], wrappers.CoinbaseAPIWrapper.parse_get_orderbook(ob))
+        return wrappers.CoinbaseAPIWrapper.parse_get_orderbook(ob)
 
     def get_open_orders(self, status=['open','pending','active'], product_id=None, sandbox=False):
         params = {
@@ -204,15 +251,17 @@ class CoinbaseAPI():
 
         return self._auth_get('/orders', params=params, sandbox=sandbox)
 
-    def _market_order(self, side, product_id, size, sandbox=False):
-        order = {
+    @staticmethod
+    def _market_order_params(side, product_id, size):
+        return {
             'type': 'market',
             'side': side,
             'product_id': product_id,
             'size': size
         }
-        
-        resp = self._auth_post('/orders', data=order, sandbox=sandbox)
+
+    def _market_order(self, side, product_id, size, sandbox=False):
+        resp = self._auth_post('/orders', data=self._market_order_params(side, product_id, size), sandbox=sandbox)
         return common.Order(resp['id'], 'market', side, size, resp['executed_value'])
 
     def market_buy_order(self, product_id, size, sandbox=False):
@@ -221,19 +270,29 @@ class CoinbaseAPI():
     def market_sell_order(self, product_id, size, sandbox=False):
         return self._market_order('sell', product_id, size, sandbox=sandbox)
 
+    def _limit_order_template(self, side, product_id):
+        key = (product_id, side)
+        template = self.templates.get(key)
+        if template is None:
+            params = {
+                #'client_oid': str(uuid.uuid4()),
+                'type': 'limit',
+                'side': side,
+                'product_id': CoinbaseAPI.convert_pair(product_id),
+                'post_only': 'true', # this needs to be based off the variable!
+                'time_in_force': 'GTC'
+            }
+            # Left open for the price and size
+            template = self.templates[key] = json.dumps(params)[:-1]
+        return template
+
+    # The JSON order body. Only price and size are formatted per order
+    def _limit_order_body(self, side, product_id, price, size, post_only=False):
+        log.debug(f'pair: {product_id} price: {price} quantity: {size}')
+        return f'{self._limit_order_template(side, product_id)}, "price": "{price}", "size": "{size}"}}'
+
     def _limit_order(self, side, product_id, price, size, post_only=False, sandbox=False):
-        params = {
-            #'client_oid': str(uuid.uuid4()),
-            'type': 'limit',
-            'side': side,
-            'product_id': CoinbaseAPI.convert_pair(product_id),
-            'price': f'{price}',
-            'size': f'{size}',
-            'post_only': 'true', # this needs to be based off the variable!
-            'time_in_force': 'GTC'
-        }
-        log.debug(f'pair: {product_id} price: {params["price"]} quantity: {params["size"]}')
-        resp = self._auth_post('/orders', data=params, sandbox=sandbox)
+        resp = self._auth_post('/orders', data=self._limit_order_body(side, product_id, price, size, post_only=post_only), sandbox=sandbox)
         return common.Order(resp['id'], 'limit', side, size, price)
 
     def limit_buy_order(self, product_id, price, size, post_only=False, sandbox=False):
@@ -244,7 +303,7 @@ class CoinbaseAPI():
 
     # Eventually change API to just return true or false if it successfully cancelled
     def cancel_order(self, order_id, sandbox=False):
-        resp = requests.delete(f'{self._get_api_endpoint(sandbox)}/orders/{order_id}', auth=self._get_auth(sandbox))
+        resp = self.session.delete(f'{self._get_api_endpoint(sandbox)}/orders/{order_id}', auth=self._get_auth(sandbox))
         try:
             resp.raise_for_status()
         except requests.HTTPError as e:
@@ -261,12 +320,12 @@ class CoinbaseAPI():
         return self._auth_get('/accounts', sandbox=sandbox)
 
     def get_products(self, sandbox=False):
-        resp = requests.get(f'{self._get_api_endpoint(sandbox)}/products')
+        resp = self.session.get(f'{self._get_api_endpoint(sandbox)}/products')
         resp.raise_for_status()
         return self._parse_products(resp.json())
 
     def get_currencies(self, sandbox=False):
-        resp = requests.get(f'{self._get_api_endpoint(sandbox)}/currencies')
+        resp = self.session.get(f'{self._get_api_endpoint(sandbox)}/currencies')
         resp.raise_for_status()
         return [ common.CurrencyInfo(c['name'], 
             c['id'], 
@@ -320,34 +379,90 @@ class CoinbaseAPI():
 
         return None
 
-class CoinbaseWebsocket():
+class CoinbaseAsyncAPI(CoinbaseAPI, exchange.AsyncExchangeAPI):
+    ''' Async order gateway, see exchange.AsyncExchangeAPI. Everything but orders stays blocking '''
+
+    # data may be pre-serialized
+    async def _auth_request(self, method, req_path, data=None, sandbox=False):
+        body = '' if data is None else data if type(data) == str else json.dumps(data)
+        headers = self._get_auth(sandbox).headers(method, req_path, body)
+        return await self._request(method, f'{self._get_api_endpoint(sandbox)}{req_path}', data=body or None, headers=headers)
+
+    async def _market_order(self, side, product_id, size, sandbox=False):
+        resp = await self._auth_request('POST', '/orders', self._market_order_params(side, product_id, size), sandbox=sandbox)
+        return common.Order(resp['id'], 'market', side, size, resp['executed_value'])
+
+    async def _limit_order(self, side, product_id, price, size, post_only=False, sandbox=False):
+        resp = await self._auth_request('POST', '/orders', self._limit_order_body(side, product_id, price, size, post_only=post_only), sandbox=sandbox)
+        return common.Order(resp['id'], 'limit', side, size, price)
+
+    async def cancel_order(self, order_id, sandbox=False, **kwargs):
+        return await self._auth_request('DELETE', f'/orders/{order_id}', sandbox=sandbox)
+
+class CoinbaseWebsocket(exchange.ExchangeWebsocket):
     WEBSOCKET = 'wss://ws-feed.pro.coinbase.com'
     EXCHANGE = 'coinbase'
 
+    PARSERS = {
+        'received': 'parse_order',   # New order event
+        'open': 'parse_order',   # Remaining are order update events
+        'done': 'parse_order',
+        'match': 'parse_order',
+        'change': 'parse_order',
+        'heartbeat': 'parse_heartbeat',
+        'subscriptions': 'parse_subscriptions',
+        'l2update': 'parse_orderbook_update',
+        'snapshot': 'parse_orderbook_snapshot'
+    }
+
+    parse_order = staticmethod(wrappers.CoinbaseWebsocketWrapper.parse_order)
+    parse_heartbeat = staticmethod(wrappers.CoinbaseWebsocketWrapper.parse_heartbeat)
+    parse_subscriptions = staticmethod(wrappers.CoinbaseWebsocketWrapper.parse_subscriptions)
+    parse_orderbook_update = staticmethod(wrappers.CoinbaseWebsocketWrapper.parse_orderbook_update)
+    parse_orderbook_snapshot = staticmethod(wrappers.CoinbaseWebsocketWrapper.parse_orderbook_snapshot)
+
+    def message_type(self, data):
+        return data['type']
+
     @staticmethod
     async def connect():
         ws = await websockets.connect(CoinbaseWebsocket.WEBSOCKET)
         return CoinbaseWebsocket(ws)
 
-    async def subscribe(self, pair, *channels):
-        await self.ws.send(json.dumps({
+    # pairs is a single pair or a list of them, all subscribed in the one message
+    async def subscribe(self, pairs, *channels):
+        pairs = [ pairs ] if isinstance(pairs, str) else list(pairs)
+        await self._subscribe(('subscribe', tuple(pairs), channels), lambda: self.ws.send(json.dumps({
             'type': 'subscribe',
             'product_ids': [
-                CoinbaseAPI.convert_pair(pair)
+                CoinbaseAPI.convert_pair(pair) for pair in pairs
             ],
             'channels': [
                 *channels
             ]
-        }))
+        })))
 
+    # Heartbeats keep a quiet book from looking like a dead connection
     async def subscribe_orderbook_feed(self, pair):
-        await self.subscribe(CoinbaseAPI.convert_pair(pair), 'level2')
+        await self.subscribe(pair, 'level2', 'heartbeat')
+
+    async def subscribe_orderbook_feeds(self, pairs):
+        await self.subscribe(pairs, 'level2', 'heartbeat')
 
-    # Make pair an input, only sub to user channel
+    @staticmethod
+    def product_id(pair):
+        return CoinbaseAPI.convert_pair(pair)
+
+    # Takes either pair or pairs, only sub to user channel
     async def subscribe_user_feed(self, auth_data, **kwargs):
-        if not 'pair' in kwargs:
-            raise ValueError('"pair" keyword argument required.')
+        if not 'pair' in kwargs and not 'pairs' in kwargs:
+            raise ValueError('"pair" or "pairs" keyword argument required.')
+
+        pairs = tuple(kwargs.get('pairs', [ kwargs.get('pair') ]))
+        # Signed afresh on every (re)subscribe
+        await self._subscribe(('user', pairs), lambda: self._subscribe_user_feed(auth_data, pairs))
 
+    async def _subscribe_user_feed(self, auth_data, pairs):
         timestamp = str(int(time.time()))
         message = timestamp + 'GET' + '/users/self/verify'
         hmac_key = base64.b64decode(auth_data['coinbase']['api_secret'])
@@ -357,7 +472,7 @@ class CoinbaseWebsocket():
         await self.ws.send(json.dumps({
             'type': 'subscribe',
             "product_ids": [
-                CoinbaseAPI.convert_pair(kwargs['pair'])
+                CoinbaseAPI.convert_pair(pair) for pair in pairs
             ],
             'channels': ['user'],
             'signature': signature_b64,
@@ -366,25 +481,6 @@ class CoinbaseWebsocket():
             'timestamp': timestamp
         }))
 
-    async def _queue_events(self):
-        try:
-            async for event in self.ws:
-                if self.iterate:
-                    self.queue.put_nowait(wrappers.CoinbaseWebsocketWrapper.parse(json.loads(event)))
-                    #await asyncio.sleep(0)
-        except asyncio.CancelledError:
-            raise
-
+    # level2 updates carry no sequence numbers, so book_sync passes them through unchecked
     def __init__(self, ws):
-        #self.ws = await websockets.connect(WEBSOCKET)
-        self.ws = ws
-        self.queue = asyncio.Queue()
-        self.queue_event_task = asyncio.create_task(self._queue_events())
-        self.iterate = True
-
-    def __aiter__(self):
-        #self.iterate = True
-        return self
-
-    async def __anext__(self):
-        return await self.queue.get()
+        super().__init__(ws)
@@ -1,11 +1,11 @@
 import time
-import hmac
 import base64
 import hashlib
 import urllib
 
 import requests
 from api import common
+from api import exchange
 from api import ob as simpleob
 
 class KrakenAPI():
@@ -19,6 +19,7 @@ class KrakenAPI():
         })
         self.api_key = auth_data['kraken']['api_key']
         self.api_secret = auth_data['kraken']['api_secret']
+        self.signer = exchange.Signer(base64.b64decode(self.api_secret), hashlib.sha512)
 
     def _api_signature(self, endpoint, req_data, nonce):
         postdata = urllib.parse.urlencode(req_data)
@@ -26,9 +27,7 @@ class KrakenAPI():
         encoded = (str(nonce) + postdata).encode()
         message = endpoint.encode() + hashlib.sha256(encoded).digest()
 
-        signature = hmac.new(base64.b64decode(self.api_secret),
-                             message, hashlib.sha512)
-        sigdigest = base64.b64encode(signature.digest())
+        sigdigest = base64.b64encode(self.signer.digest(message))
         return sigdigest
 
     def _post_request(self, endpoint, data={}):
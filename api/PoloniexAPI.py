@@ -1,7 +1,6 @@
 import asyncio
 import json
 import time
-import hmac
 import re
 from urllib.parse import urlencode
 import logging
@@ -9,10 +8,10 @@ from decimal import Decimal
 
 import requests
 import websockets
-import pandas as pd
 
 from api import common
 from api import wrappers
+from api import exchange
 
 POLONIEX_PAIRS = {
     177: 'BTC_ARDR',
@@ -127,35 +126,43 @@ class PoloniexAuth(requests.auth.AuthBase):
 
     def __init__(self, auth_data):
         self.api_key = auth_data['poloniex']['api_key']
-        self.api_secret = auth_data['poloniex']['api_secret']
+        self.signer = exchange.Signer(auth_data['poloniex']['api_secret'].encode(), 'sha512')
 
     def _sign_data(self, data):
-        sig = hmac.new(self.api_secret.encode(), data.encode(), 'sha512')
-        return sig.hexdigest()
+        return self.signer.hexdigest(data.encode())
 
-    def __call__(self, request):
+    def sign(self, body):
+        ''' (body with a nonce, headers) for a url encoded request body '''
         nonce = int(time.time()*1000)
-        request.body += f'&nonce={nonce}'
-        sig = self._sign_data(request.body)
-        request.headers.update({ 'Key': self.api_key, 'Sign': sig })
+        body += f'&nonce={nonce}'
+        return body, { 'Key': self.api_key, 'Sign': self._sign_data(body) }
+
+    def __call__(self, request):
+        request.body, headers = self.sign(request.body)
+        request.headers.update(headers)
         return request
 
-class PoloniexAPI():
+class PoloniexAPI(exchange.ExchangeAPI):
     ENDPOINT = 'https://poloniex.com/tradingApi'
     EXCHANGE = 'poloniex'
+    # Same host as the trading api, and answers quickly (with an error)
+    PING_URL = 'https://poloniex.com/public'
 
-    def __init__(self, auth_data):
+    def __init__(self, auth_data, pool_size=exchange.POOL_SIZE):
+        super().__init__(pool_size)
         self.auth = PoloniexAuth(auth_data)
+        # (pair, side, post only, IOC, FOK) -> serialized invariant part of the order body
+        self.templates = {}
 
     def _auth_request(self, path, data={}):
         data['command'] = path
-        resp = requests.post(f'{self.ENDPOINT}', data=data, auth=self.auth)
+        resp = self.session.post(f'{self.ENDPOINT}', data=data, auth=self.auth)
         resp.raise_for_status()
         return resp.json()
 
     def _public_request(self, path, params={}):
         params['command'] = path
-        resp = requests.get('https://poloniex.com/public', params=params)
+        resp = self.session.get('https://poloniex.com/public', params=params)
         resp.raise_for_status()
         return resp.json()
 
@@ -173,31 +180,61 @@ class PoloniexAPI():
             products.append(common.ProductInfo(POLONIEX_PAIRS[currencies[currency]['id']], base, quote, Decimal(10)**-8, Decimal(10)**-8, Decimal(1)))
         return products
 
+    def get_orderbook(self, pair, depth=None):
+        params = {
+            'currencyPair': self.convert_pair(pair),
+            'depth': depth if depth else 'all'
+        }
+
+        ob = self._public_request('returnOrderBook', params=params)
+        # Amounts come back as numbers, prices as strings
+        return {
+            'bids': [ (price, str(quantity)) for price, quantity in ob['bids'] ],
+            'asks': [ (price, str(quantity)) for price, quantity in ob['asks'] ],
+            'sequence': ob['seq']
+        }
+
     def get_wallet_balance(self, asset):
         balance = [ Decimal(balance) for _asset, balance in self._auth_request('returnBalances').items() if _asset == asset ][0]
         return common.Wallet(asset, balance)
 
-    def _order(self, pair, side, price, quantity, **kwargs):
-        data = {
-            'currencyPair': self.convert_pair(pair),
-            'rate': price,
-            'amount': quantity
-        }
+    def _order_template(self, pair, side, post_only, ioc, fok):
+        key = (pair, side, post_only, ioc, fok)
+        template = self.templates.get(key)
+        if template is None:
+            data = {
+                'command': side,
+                'currencyPair': self.convert_pair(pair)
+            }
+
+            if post_only:
+                data['postOnly'] = '1'
 
-        if 'post_only' in kwargs:
-            data['postOnly'] = '1'
+            if ioc:
+                data['immediateOrCancel'] = '1'
 
-        if 'IOC' in kwargs:
-            data['immediateOrCancel'] = '1'
+            if fok:
+                data['fillOrKill'] = '1'
 
-        if 'FOK' in kwargs:
-            data['fillOrKill'] = '1'
+            template = self.templates[key] = urlencode(data)
+        return template
 
-        resp = self._auth_request(side, data=data)
+    # The url encoded order body, less the nonce. Only price and quantity are formatted per order
+    def _order_body(self, pair, side, price, quantity, **kwargs):
+        template = self._order_template(pair, side, 'post_only' in kwargs, 'IOC' in kwargs, 'FOK' in kwargs)
+        return f'{template}&rate={price}&amount={quantity}'
+
+    @staticmethod
+    def _parse_order(resp, side, price, quantity):
         if 'error' in resp:
             raise common.ExchangeException('poloniex', resp['error'])
         return common.Order(resp['orderNumber'], 'limit', side, Decimal(quantity), price=Decimal(price))
 
+    def _order(self, pair, side, price, quantity, **kwargs):
+        resp = self.session.post(self.ENDPOINT, data=self._order_body(pair, side, price, quantity, **kwargs), headers=exchange.FORM_HEADERS, auth=self.auth)
+        resp.raise_for_status()
+        return self._parse_order(resp.json(), side, price, quantity)
+
     def limit_buy_order(self, pair, price, quantity, **kwargs):
         return self._order(pair, 'buy', price, quantity, **kwargs)
 
@@ -226,7 +263,21 @@ class PoloniexAPI():
         quote, base = pair.split('/')
         return base + '_' + quote
 
-class PoloniexWebsocket():
+class PoloniexAsyncAPI(PoloniexAPI, exchange.AsyncExchangeAPI):
+    ''' Async order gateway, see exchange.AsyncExchangeAPI. Everything but orders stays blocking '''
+
+    async def _auth_post(self, body):
+        body, headers = self.auth.sign(body)
+        return await self._request('POST', self.ENDPOINT, data=body, headers={ **headers, **exchange.FORM_HEADERS })
+
+    async def _order(self, pair, side, price, quantity, **kwargs):
+        resp = await self._auth_post(self._order_body(pair, side, price, quantity, **kwargs))
+        return self._parse_order(resp, side, price, quantity)
+
+    async def cancel_order(self, order_id, **kwargs):
+        return await self._auth_post(urlencode({ 'command': 'cancelOrder', 'orderNumber': order_id }))
+
+class PoloniexWebsocket(exchange.ExchangeWebsocket):
     WEBSOCKET = 'wss://api2.poloniex.com'
     EXCHANGE = 'poloniex'
     
@@ -235,26 +286,18 @@ class PoloniexWebsocket():
     DAILY_VOL_CHANNEL = 1003
     HEARTBEAT_CHANNEL = 1010
 
+    PARSERS = {
+        'account': 'parse_order',
+        'orderbook': 'parse_orderbook'
+    }
+
+    # Heartbeats are sent every second when there's nothing else
+    STALE_TIMEOUT = 10
+
     def __init__(self, ws):
-        self.ws = ws
-        self.queue = asyncio.Queue()
-        self.queue_event_task = asyncio.create_task(self._queue_events())
         # order_id: (price,remaining_quantity)
         self.orders = {}
-
-    async def _queue_events(self):
-        try:
-            async for event in self.ws:
-                # May return a list, so add each event separately to the queue
-                #for parsed_event in wrappers.PoloniexWebsocketWrapper.parse(json.loads(event)):
-                for parsed_event in self.parse(json.loads(event)):
-                    if type(parsed_event) == list:
-                        for subevent in parsed_event:
-                            self.queue.put_nowait(subevent)
-                    else:
-                        self.queue.put_nowait(parsed_event)
-        except asyncio.CancelledError:
-            raise
+        super().__init__(ws)
 
     @staticmethod
     async def connect():
@@ -262,18 +305,16 @@ class PoloniexWebsocket():
         return PoloniexWebsocket(ws)
 
     async def subscribe(self, channel):
-        await self.ws.send(json.dumps({
+        await self._subscribe(channel, lambda: self.ws.send(json.dumps({
             'command': 'subscribe',
             'channel': channel
-        }))
-
-    def __aiter__(self):
-        return self
-
-    async def __anext__(self):
-        return await self.queue.get()
+        })))
 
     async def subscribe_user_feed(self, auth_data, **kwargs):
+        # Signed afresh on every (re)subscribe
+        await self._subscribe(self.ACCOUNT_CHANNEL, lambda: self._subscribe_user_feed(auth_data))
+
+    async def _subscribe_user_feed(self, auth_data):
         auth = PoloniexAuth(auth_data)
         data = f'nonce={int(time.time()*1000)}'
 
@@ -289,15 +330,19 @@ class PoloniexWebsocket():
         pair = PoloniexAPI.convert_pair(pair)
         await self.subscribe(pair)
 
-    def parse(self, data):
+    # Book messages are sent on the pair's channel id, which POLONIEX_PAIRS names
+    @staticmethod
+    def product_id(pair):
+        return PoloniexAPI.convert_pair(pair)
+
+    def message_type(self, data):
         #print(data)
-        if data[0] == 1000 and len(data) > 2:
-            return self.parse_order(data)
+        if data[0] == self.ACCOUNT_CHANNEL and len(data) > 2:
+            return 'account'
         #elif re.fullmatch('[A-Z]+_[A-Z]+', str(data[0])):
         elif data[0] in POLONIEX_PAIRS:
-            return self.parse_orderbook(data)
-        else:
-            return []
+            return 'orderbook'
+        return None
 
     def parse_orderbook(self, data):
         # poloniex is a little bit tricky, because it can sometimes reset the orderbook.
@@ -307,20 +352,23 @@ class PoloniexWebsocket():
         ASKS = 0
         updates = []
         ob_updates = []
+        product = POLONIEX_PAIRS.get(data[0])
         for update in data[2]:
             update_type = update[0]
 
             if update_type == 'i':
-                ob = pd.Series({
-                    'bids': pd.DataFrame(update[1]['orderBook'][BIDS].items(), columns=['price', 'quantity']),
-                    'asks': pd.DataFrame(update[1]['orderBook'][ASKS].items(), columns=['price', 'quantity'])
-                })
-                updates.append(common.OrderbookSnapshotEvent('poloniex', ob))
+                ob = {
+                    'bids': update[1]['orderBook'][BIDS].items(),
+                    'asks': update[1]['orderBook'][ASKS].items(),
+                    'sequence': data[1]
+                }
+                updates.append(common.OrderbookSnapshotEvent('poloniex', ob, product))
             elif update_type == 'o':
                 _, side, price, quantity = update
                 ob_updates.append([ 'bids' if side == BIDS else 'asks', price, quantity ])
 
-        updates.append(common.OrderbookEvent('poloniex', ob_updates))
+        # Every message on a book channel is numbered, even those only carrying trades
+        updates.append(common.OrderbookEvent('poloniex', ob_updates, data[1], product=product))
         return updates
 
     def parse_order(self, data):
@@ -7,30 +7,69 @@ CurrencyInfo = namedtuple('CurrencyInfo', 'name id min_size min_withdrawal max_p
 BookEntry = namedtuple('BookEntry', 'price quantity')
 
 class ExchangeException(Exception):
-    def __init__(self, exchange, reason):
+    # status is the HTTP status of the response, where there was one
+    def __init__(self, exchange, reason, status=None):
         self.exchange = exchange
         self.reason = reason
+        self.status = status
+
+class LazyDecimal():
+    '''
+    Event field holding the raw wire value (a decimal string, or a Decimal) in the slot _<name>,
+    converted to a Decimal only on first access. Most events are dropped unread, so most never pay
+    for it. Tick counts must be converted first (TickScale.decimal), as they aren't the value itself.
+    '''
+
+    def __set_name__(self, owner, name):
+        self.slot = owner.__dict__['_' + name]
+
+    def __get__(self, event, owner=None):
+        if event is None:
+            return self
+        value = self.slot.__get__(event)
+        if value is None or type(value) is Decimal:
+            return value
+        value = Decimal(value)
+        self.slot.__set__(event, value)
+        return value
+
+    def __set__(self, event, value):
+        self.slot.__set__(event, value)
 
 class Event():
-    def __init__(self, event_type, exchange):
-        self.event_type = event_type
+    # Type tag, compare events with event.event_type
+    __slots__ = ('exchange',)
+    event_type = None
+
+    def __init__(self, exchange):
         self.exchange = exchange
 
-    def __eq__(self, other):
-        return isinstance(other, Event) and self.event_type == other.event_type
+# For event types without a class of their own, ex: Binance account updates
+class GenericEvent(Event):
+    __slots__ = ('event_type',)
+
+    def __init__(self, event_type, exchange):
+        super().__init__(exchange)
+        self.event_type = event_type
 
 class SubscriptionsEvent(Event):
+    __slots__ = ('msg',)
+    event_type = 'subscriptions'
+
     def __init__(self, exchange, msg=None):
-        super().__init__('subscriptions', exchange)
+        super().__init__(exchange)
         self.msg = msg
 
 class HeartBeatEvent(Event):
-    def __init__(self, exchange):
-        super().__init__('heartbeat', exchange)
+    __slots__ = ()
+    event_type = 'heartbeat'
 
 class MatchEvent(Event):
+    __slots__ = ('price', 'volume', 'side', 'ordertype', 'maker_id', 'taker_id')
+    event_type = 'match'
+
     def __init__(self, exchange, price, volume, side, ordertype=None, maker_id=None, taker_id=None):
-        super().__init__('match', exchange)
+        super().__init__(exchange)
         self.price = price
         self.volume = volume
         self.side = side
@@ -38,21 +77,50 @@ class MatchEvent(Event):
         self.maker_id = maker_id
         self.taker_id = taker_id
 
+# product is the exchange's id for the book's pair, as sent in the frame (see ExchangeWebsocket.product_id)
 class OrderbookSnapshotEvent(Event):
-    def __init__(self, exchange, snapshot):
-        super().__init__('orderbook_snapshot', exchange)
+    __slots__ = ('snapshot', 'product')
+    event_type = 'orderbook_snapshot'
+
+    def __init__(self, exchange, snapshot, product=None):
+        super().__init__(exchange)
         self.snapshot = snapshot
+        self.product = product
 
 class OrderbookEvent(Event):
-    def __init__(self, exchange, update, sequence=None, timestamp=None):
-        super().__init__('orderbook_update', exchange)
+    # first_sequence is set by exchanges which number updates as a range (first_sequence, sequence]
+    # checksum is set by exchanges which send the expected book checksum after the update (see Orderbook.checksum)
+    __slots__ = ('update', 'sequence', 'first_sequence', 'timestamp', 'checksum', 'product')
+    event_type = 'orderbook_update'
+
+    def __init__(self, exchange, update, sequence=None, timestamp=None, first_sequence=None, checksum=None, product=None):
+        super().__init__(exchange)
         self.update = update
         self.sequence = sequence
+        self.first_sequence = first_sequence
+        self.timestamp = timestamp
+        self.checksum = checksum
+        self.product = product
+
+# Top of book, emitted by trade.BookFeed only when it changes
+class BBOEvent(Event):
+    __slots__ = ('bid_price', 'bid_quantity', 'ask_price', 'ask_quantity', 'timestamp')
+    event_type = 'bbo'
+
+    def __init__(self, exchange, bid_price, bid_quantity, ask_price, ask_quantity, timestamp=None):
+        super().__init__(exchange)
+        self.bid_price = bid_price
+        self.bid_quantity = bid_quantity
+        self.ask_price = ask_price
+        self.ask_quantity = ask_quantity
         self.timestamp = timestamp
 
 class OrderEvent(Event):
+    __slots__ = ('id', 'quantity', 'price', 'status', 'leq', 'lep')
+    event_type = 'order'
+
     def __init__(self, exchange, leq=0, lep=0, **order):
-        super().__init__('order', exchange)
+        super().__init__(exchange)
         self.id = order['id']
         self.quantity = order['quantity']
         self.price = order['price']
@@ -60,41 +128,86 @@ class OrderEvent(Event):
         self.leq = leq
         self.lep = lep
 
+# price and quantity below are LazyDecimals, set from the wire strings
+
 class OrderReceivedEvent(Event):
-    def __init__(self, exchange, order_id, price, quantity=None, order_type=None, timestamp=None, side=None):
-        super().__init__('order_received', exchange)
+    __slots__ = ('id', 'order_type', '_quantity', '_price', 'side', 'timestamp', 'sequence')
+    event_type = 'order_received'
+
+    # Initial desired order quantity
+    quantity = LazyDecimal()
+    price = LazyDecimal()
+
+    def __init__(self, exchange, order_id, price, quantity=None, order_type=None, timestamp=None, side=None, sequence=None):
+        super().__init__(exchange)
         self.id = str(order_id)
         self.order_type = order_type
-        # Initial desired order quantity
-        self.quantity = Decimal(quantity)
-        self.price = Decimal(price)
+        self._quantity = quantity
+        self._price = price
         self.side = side
         self.timestamp = timestamp
+        self.sequence = sequence
 
 class OrderMatchEvent(Event):
+    # order_id is the resting (maker) order, taker_id the order that took it, where the exchange reports both
+    __slots__ = ('id', 'taker_id', '_price', 'side', '_quantity', 'sequence', 'timestamp')
+    event_type = 'order_match'
+
+    price = LazyDecimal()
+    # Quantity traded
+    quantity = LazyDecimal()
+
+    def __init__(self, exchange, order_id, price, quantity, side=None, sequence=None, timestamp=None, taker_id=None):
+        super().__init__(exchange)
+        self.id = str(order_id)
+        self.taker_id = taker_id
+        self._price = price
+        self.side = side
+        self._quantity = quantity
+        self.sequence = sequence
+        self.timestamp = timestamp
+
+class OrderChangeEvent(Event):
+    __slots__ = ('id', '_price', '_quantity', 'side', 'sequence', 'timestamp')
+    event_type = 'order_change'
+
+    # None for market orders, which never rest on the book
+    price = LazyDecimal()
+    # New size on the books
+    quantity = LazyDecimal()
+
     def __init__(self, exchange, order_id, price, quantity, side=None, sequence=None, timestamp=None):
-        super().__init__('order_match', exchange)
+        super().__init__(exchange)
         self.id = str(order_id)
-        self.price = Decimal(price)
+        self._price = price
+        self._quantity = quantity
         self.side = side
-        # Quantity traded
-        self.quantity = Decimal(quantity)
         self.sequence = sequence
+        self.timestamp = timestamp
 
 class OrderOpenEvent(Event):
+    __slots__ = ('id', '_price', '_quantity', 'side', 'sequence', 'timestamp')
+    event_type = 'order_open'
+
+    price = LazyDecimal()
+    # Initial size on the books. May differ from received quantity if partially filled
+    quantity = LazyDecimal()
+
     def __init__(self, exchange, order_id, price, quantity, side=None, sequence=None, timestamp=None):
-        super().__init__('order_open', exchange)
+        super().__init__(exchange)
         self.id = str(order_id)
-        self.price = Decimal(price)
-        # Initial size on the books. May differ from received quantity if partially filled
-        self.quantity = Decimal(quantity)
+        self._price = price
+        self._quantity = quantity
         self.side = side
         self.sequence = sequence
         self.timestamp = timestamp
 
 class OrderDoneEvent(Event):
-    def __init__(self, exchange, order_id, reason, side=None, price=None, quantity=None, timestamp=None, remaining_size=None):
-        super().__init__('order_done', exchange)
+    __slots__ = ('id', 'reason', 'side', 'price', 'quantity', 'timestamp', 'remaining_size', 'sequence')
+    event_type = 'order_done'
+
+    def __init__(self, exchange, order_id, reason, side=None, price=None, quantity=None, timestamp=None, remaining_size=None, sequence=None):
+        super().__init__(exchange)
         self.id = str(order_id)
         self.reason = reason
         self.side = side
@@ -102,6 +215,7 @@ class OrderDoneEvent(Event):
         self.quantity = quantity
         self.timestamp = timestamp
         self.remaining_size = remaining_size
+        self.sequence = sequence
 
 class OrderException(Exception):
     def __init__(self, errors):
@@ -1,4 +1,19 @@
 import asyncio
+import hmac
+import logging
+import random
+import time
+
+import aiohttp
+import requests
+import websockets
+
+from api import common
+from api.feed import BookSync, FeedQueue, ProductFeed
+from util import fastjson
+from util.metrics import Metrics
+
+_log = logging.getLogger(__name__)
 
 class PostOnlyException(Exception):
     pass
@@ -6,10 +21,332 @@ class PostOnlyException(Exception):
 class UnknownOrderException(Exception):
     pass
 
+# Connections kept open per exchange api
+POOL_SIZE = 4
+
+def pooled_session(pool_size=POOL_SIZE):
+    ''' requests.Session reusing up to pool_size keep-alive connections per host '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+class Signer():
+    '''
+    HMAC with a fixed secret. The keyed state is computed once, and each signature starts from a
+    copy of it rather than rekeying.
+    '''
+
+    def __init__(self, key, digest):
+        self.keyed = hmac.new(key, digestmod=digest)
+
+    def sign(self, msg):
+        signature = self.keyed.copy()
+        signature.update(msg)
+        return signature
+
+    def hexdigest(self, msg):
+        return self.sign(msg).hexdigest()
+
+    def digest(self, msg):
+        return self.sign(msg).digest()
+
+# For pre-serialized url encoded bodies
+FORM_HEADERS = { 'Content-Type': 'application/x-www-form-urlencoded' }
+
 class ExchangeAPI():
+    '''
+    Base for the REST apis. Requests go through self.session, a pooled keep-alive session, so they
+    skip the TCP and TLS handshakes of a fresh connection. Exchanges drop idle connections after a
+    while, so long running bots should also run keep_warm() as a task, which pings PING_URL (any cheap
+    endpoint on the api's host) every KEEP_WARM_INTERVAL seconds.
+    '''
+
+    EXCHANGE = None
+    PING_URL = None
+    KEEP_WARM_INTERVAL = 15
+
+    def __init__(self, pool_size=POOL_SIZE):
+        self.pool_size = pool_size
+        self.session = pooled_session(pool_size)
+
     def get_orderbook(self, pair):
         raise NotImplementedError()
 
+    def ping(self):
+        # Any response will do, the connection is what's being kept open
+        self.session.get(self.PING_URL, timeout=10).close()
+
+    async def _ping(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.ping)
+
+    async def keep_warm(self, interval=None):
+        while True:
+            try:
+                await self._ping()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                _log.warning(f'{self.EXCHANGE} keep warm ping failed: {e}')
+            await asyncio.sleep(interval or self.KEEP_WARM_INTERVAL)
+
+class AsyncExchangeAPI(ExchangeAPI):
+    '''
+    Base for the async order gateways (ex: BinanceAPI.BinanceAsyncAPI). Their order methods have the
+    same names as the blocking api's, but return awaitables sent over an aiohttp session, so orders
+    in flight don't stall the event loop and orders on different venues overlap. keep_warm() pings
+    over both sessions.
+
+    The aiohttp session is opened on first use, since it must be created within the event loop.
+    '''
+
+    async_session = None
+
+    def _async_session(self):
+        if self.async_session is None or self.async_session.closed:
+            # aiohttp closes idle connections after keepalive_timeout, so it must outlast the ping interval
+            connector = aiohttp.TCPConnector(limit_per_host=self.pool_size, keepalive_timeout=4 * self.KEEP_WARM_INTERVAL)
+            self.async_session = aiohttp.ClientSession(connector=connector)
+        return self.async_session
+
+    async def _request(self, method, url, **kwargs):
+        async with self._async_session().request(method, url, **kwargs) as resp:
+            body = await resp.read()
+            if resp.status >= 400:
+                raise common.ExchangeException(self.EXCHANGE, body.decode(), resp.status)
+            return fastjson.loads(body)
+
+    async def _ping(self):
+        async def ping():
+            async with self._async_session().get(self.PING_URL) as resp:
+                await resp.read()
+
+        await asyncio.gather(super()._ping(), ping())
+
+    async def close(self):
+        if self.async_session:
+            await self.async_session.close()
+        self.session.close()
+
 class ExchangeWebsocket():
+    '''
+    Base for exchange websockets. A single ingestion loop reads frames off self.ws, decodes (with
+    util.fastjson) and parses each exactly once, and queues the frame's events as one batch (through
+    book_sync, which checks orderbook sequencing) onto a bounded FeedQueue. Iterating the websocket
+    yields the events one at a time.
+
+    Subclasses set EXCHANGE, and PARSERS, a table of message type -> name of the method parsing it,
+    with message_type() picking the type out of a decoded frame. Parse methods may return a single
+    event, or a (possibly nested) list of them. Frames of unknown types are dropped.
+
+    The connection is supervised: when it closes, or no frame (heartbeats included) arrives for
+    STALE_TIMEOUT seconds, a 'disconnected' event is queued (consumers should stop trusting the book)
+    and the socket is reopened with open(), with jittered exponential backoff. Subscriptions made
+    through _subscribe() are then replayed, and the book rebuilt: from a REST snapshot if book_sync
+    has a fetch, otherwise from the snapshot the exchange sends on subscribing. Time to reconnect is
+    recorded in the 'reconnect' timing, and dropped connections in the 'reconnects' counter.
+
+    One connection can carry any number of products. Book events of a product registered with
+    product_feed() are routed (by the product id parsed from the frame) to that ProductFeed, with its
+    own queue and book_sync; everything else stays on the websocket's.
+    '''
+
+    EXCHANGE = None
+    PARSERS = {}
+
+    # See FeedQueue, can be changed on self.queue
+    QUEUE_SIZE = 1000
+    QUEUE_POLICY = FeedQueue.CONFLATE
+
+    WEBSOCKET = None
+    # Seconds without a frame before the connection is considered dead, None to never time out
+    STALE_TIMEOUT = 30
+    # Reconnect backoff, in seconds
+    RECONNECT_DELAY = 0.5
+    MAX_RECONNECT_DELAY = 30
+
+    def __init__(self, ws=None):
+        self.ws = ws
+        self.metrics = Metrics()
+        self.queue = FeedQueue(self.metrics, self.QUEUE_SIZE, self.QUEUE_POLICY, on_drop=lambda: self.book_sync.invalidate())
+        self.book_sync = BookSync(self.EXCHANGE, self.queue.put, self.metrics, reconnect=self.drop)
+        # Events of the batch currently being iterated
+        self.batch = []
+        self.iterating = True
+        # Set while self.ws is usable
+        self.connected = asyncio.Event()
+        if ws:
+            self.connected.set()
+        # Subscription key -> coroutine function resending it, replayed on reconnect
+        self.subscriptions = {}
+        self.last_frame = time.perf_counter()
+        self.closing = False
+        # product id -> ProductFeed
+        self.products = {}
+        self.queue_event_task = asyncio.create_task(self._queue_events())
+        self.watch_task = asyncio.create_task(self._watch()) if self.STALE_TIMEOUT else None
+
     def subscribe_orderbook_feed(self, pair):
         raise NotImplementedError()
+
+    async def subscribe_orderbook_feeds(self, pairs):
+        ''' Subscribes to several books, in as few requests as the exchange allows '''
+        for pair in pairs:
+            await self.subscribe_orderbook_feed(pair)
+
+    @staticmethod
+    def product_id(pair):
+        ''' The id frames carry for pair's book '''
+        raise NotImplementedError()
+
+    def product_feed(self, pair):
+        ''' The feed pair's book events are routed to, created on first use '''
+        product = self.product_id(pair)
+        if product not in self.products:
+            self.products[product] = ProductFeed(self.EXCHANGE, product, self.QUEUE_SIZE, self.QUEUE_POLICY, reconnect=self.drop)
+        return self.products[product]
+
+    def _route(self, events):
+        ''' Hands events to their product's book_sync, returning the feeds (with queues) they went to '''
+        if not self.products:
+            self.book_sync.process(events)
+            return (self,)
+
+        batches = {}
+        for event in events:
+            feed = self.products.get(getattr(event, 'product', None), self)
+            batches.setdefault(feed, []).append(event)
+        for feed, batch in batches.items():
+            feed.book_sync.process(batch)
+        return batches
+
+    async def open(self):
+        ''' Opens a new connection, for reconnecting '''
+        return await websockets.connect(self.WEBSOCKET)
+
+    async def _subscribe(self, key, send):
+        ''' Sends a subscription, remembering it under key to be sent again after reconnecting '''
+        self.subscriptions[key] = send
+        await send()
+
+    async def resubscribe(self):
+        for send in list(self.subscriptions.values()):
+            await send()
+
+    async def close(self):
+        self.closing = True
+        for task in [ self.queue_event_task, self.watch_task ]:
+            if task:
+                task.cancel()
+        if self.ws:
+            await self.ws.close()
+
+    def decode(self, frame):
+        return fastjson.loads(frame)
+
+    def message_type(self, data):
+        raise NotImplementedError()
+
+    def parse(self, data):
+        parser = self.PARSERS.get(self.message_type(data))
+        return getattr(self, parser)(data) if parser else []
+
+    @staticmethod
+    def _flatten(events):
+        if type(events) != list:
+            return [] if events is None else [ events ]
+        return [ event for subevents in events for event in ExchangeWebsocket._flatten(subevents) ]
+
+    async def _queue_events(self):
+        while True:
+            await self.connected.wait()
+            ws = self.ws
+            try:
+                # Frames arrive as bytes where possible, skipping the decode to str
+                async for frame in fastjson.frames(ws):
+                    start = self.last_frame = time.perf_counter()
+                    if self.iterating:
+                        try:
+                            events = self._flatten(self.parse(self.decode(frame)))
+                            self.metrics.record('parse', time.perf_counter() - start)
+                            feeds = self._route(events)
+                        except Exception:
+                            # A frame we can't handle shouldn't take the feed down with it
+                            _log.exception(f'{self.EXCHANGE} failed to process frame: {frame[:200]!r}')
+                            self.metrics.incr('frame_errors')
+                            continue
+                        # Backpressure, under the block policy
+                        for feed in feeds:
+                            await feed.queue.wait_writable()
+            except asyncio.CancelledError:
+                raise
+            except websockets.ConnectionClosed:
+                _log.warning(f'{self.EXCHANGE} connection closed')
+            except Exception:
+                # Anything else, ex: a transport error, is handled like a dropped connection
+                _log.exception(f'{self.EXCHANGE} ingest failed, reconnecting')
+
+            # Unless the socket has already been replaced
+            if self.ws is ws and not self.closing:
+                await self._reconnect()
+
+    async def _reconnect(self):
+        self.connected.clear()
+        self.metrics.incr('reconnects')
+        feeds = [ self, *self.products.values() ]
+        for feed in feeds:
+            feed.queue.put([ common.GenericEvent('disconnected', self.EXCHANGE) ])
+
+        delay = self.RECONNECT_DELAY
+        with self.metrics.timer('reconnect'):
+            while True:
+                try:
+                    self.ws = await self.open()
+                    await self.resubscribe()
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    _log.error(f'{self.EXCHANGE} reconnect failed: {e}')
+                    # Jittered, so a venue wide outage doesn't get every client back at once
+                    await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                    delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+
+        _log.info(f'{self.EXCHANGE} reconnected')
+        # Updates were missed while disconnected
+        for feed in feeds:
+            feed.book_sync.reset()
+            if feed.book_sync.fetch:
+                feed.book_sync.resync()
+        self.last_frame = time.perf_counter()
+        self.connected.set()
+
+    def drop(self):
+        '''
+        Drops the connection, which _queue_events then reopens and resubscribes. Also how books without
+        a REST fetch are rebuilt (see BookSync.invalidate). Does nothing while already reconnecting.
+        '''
+        ws = self.ws
+        if self.connected.is_set() and hasattr(ws, 'transport'):
+            # Rather than a close handshake the other end may never answer
+            ws.transport.abort()
+
+    async def _watch(self):
+        ''' Drops the connection once it goes quiet for STALE_TIMEOUT, which _queue_events then reopens '''
+        while True:
+            await asyncio.sleep(self.STALE_TIMEOUT / 4)
+            if self.connected.is_set() and time.perf_counter() - self.last_frame > self.STALE_TIMEOUT:
+                _log.warning(f'{self.EXCHANGE} no messages for {self.STALE_TIMEOUT}s, dropping connection')
+                self.metrics.incr('stale')
+                self.drop()
+                self.last_frame = time.perf_counter()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.batch:
+            self.batch = await self.queue.get()
+            self.batch.reverse()
+        return self.batch.pop()
@@ -0,0 +1,274 @@
+import asyncio
+import logging
+from collections import deque
+
+from api import common
+from util.metrics import Metrics
+
+_log = logging.getLogger(__name__)
+
+class BookSync():
+    '''
+    Tracks orderbook update sequence continuity for a websocket. Each frame's parsed events are passed
+    through process(), which emits them as a single batch (onto the websocket's queue) in book order.
+
+    When a gap is detected, orderbook updates are buffered while a fresh snapshot is fetched with
+    fetch (a blocking get_orderbook call, run in an executor). An OrderbookSnapshotEvent is then
+    emitted, followed by the buffered updates newer than the snapshot. Consumers should reset their
+    book on any orderbook_snapshot event. Other events are never held back.
+
+    Updates may carry a first_sequence (ex: Binance U/u ranges); otherwise the update's own sequence
+    must be exactly one past the last. Updates without a sequence pass through unchecked, and without
+    a fetch gaps are only counted. A book invalidated without a fetch is rebuilt by reconnect, which
+    reopens the connection for the snapshot the exchange sends on subscribing.
+
+    Each book needs its own BookSync, so product is set when the websocket carries several (see ProductFeed).
+    '''
+
+    RETRY_DELAY = 1
+
+    def __init__(self, exchange, emit, metrics, product=None, reconnect=None):
+        self.exchange = exchange
+        self.product = product
+        self.emit = emit
+        self.metrics = metrics
+        # Set by whoever owns the REST api for the feed, ex: trade.create_feed
+        self.fetch = None
+        self.reconnect = reconnect
+        self.sequence = None
+        # Holds updates while a resync is in progress
+        self.buffer = None
+        self.task = None
+
+    @property
+    def syncing(self):
+        return self.buffer is not None
+
+    def process(self, events):
+        batch = [ event for event in events if self._accept(event) ]
+        if batch:
+            self.emit(batch)
+
+    def _accept(self, event):
+        ''' Returns whether event can be emitted now, otherwise it's buffered or dropped '''
+        if event.event_type == 'orderbook_snapshot':
+            # The stream itself reset the book (ex: poloniex), so any pending resync is moot
+            self._cancel()
+            self.sequence = event.snapshot.get('sequence')
+        elif event.event_type != 'orderbook_update' or event.sequence is None:
+            pass
+        elif self.syncing:
+            self.buffer.append(event)
+            return False
+        elif self.sequence is None:
+            self.sequence = event.sequence
+        elif event.sequence <= self.sequence:
+            # Already reflected in the book
+            self.metrics.incr('stale_updates')
+            return False
+        elif (event.first_sequence if event.first_sequence is not None else event.sequence) > self.sequence + 1:
+            _log.warning(f'{self.exchange} {self.product or ""} orderbook gap after sequence {self.sequence}')
+            self.metrics.incr('sequence_gaps')
+            if self.fetch:
+                self.resync()
+                self.buffer.append(event)
+                return False
+            self.sequence = event.sequence
+        else:
+            self.sequence = event.sequence
+
+        return True
+
+    def resync(self):
+        ''' Buffers orderbook updates and rebuilds from a fresh snapshot. Does nothing without a fetch '''
+        if self.syncing:
+            return
+        if self.fetch is None:
+            # Updates would only pile up in the buffer, with no snapshot ever coming to release them
+            _log.warning(f'{self.exchange} {self.product or ""} orderbook invalidated without a way to resync')
+            return
+
+        self.buffer = []
+        self.metrics.incr('resyncs')
+        self.task = asyncio.create_task(self._resync())
+
+    async def _resync(self):
+        with self.metrics.timer('resync'):
+            while True:
+                try:
+                    snapshot = await asyncio.get_event_loop().run_in_executor(None, self.fetch)
+                    break
+                except Exception as e:
+                    _log.error(f'{self.exchange} {self.product or ""} snapshot request failed: {e}')
+                    await asyncio.sleep(self.RETRY_DELAY)
+
+        buffer, self.buffer, self.task = self.buffer, None, None
+        self.sequence = snapshot['sequence']
+
+        # Replay the buffer through the sequence checks, so anything the snapshot already covers is dropped,
+        # and a snapshot older than the buffer simply resyncs again
+        self.emit([ common.OrderbookSnapshotEvent(self.exchange, snapshot, self.product), *[ event for event in buffer if self._accept(event) ] ])
+
+    def _cancel(self):
+        if self.task:
+            self.task.cancel()
+        self.buffer, self.task = None, None
+
+    def reset(self):
+        ''' Forgets the sequence, ex: after reconnecting to a feed that restarts it '''
+        self._cancel()
+        self.sequence = None
+
+    def invalidate(self):
+        '''
+        The consumer's book can no longer be trusted (ex: updates were dropped). Without a fetch, the
+        connection is dropped, so the book is marked invalid by the 'disconnected' event until the
+        snapshot sent on resubscribing.
+        '''
+        if self.fetch is None and self.reconnect:
+            _log.warning(f'{self.exchange} {self.product or ""} orderbook invalidated, reconnecting for a snapshot')
+            self.reconnect()
+        else:
+            self.resync()
+
+class FeedQueue():
+    '''
+    Bounded queue of event batches between a websocket and its consumer, holding at most maxsize
+    events. What happens when the consumer falls behind depends on the policy:
+
+    block: the websocket stops reading frames until there's room (see wait_writable)
+    drop_oldest: the oldest orderbook events are dropped, and on_drop called (to resync the book)
+    conflate: consecutive orderbook updates for the same book are merged into a single delta
+
+    Order and other events are never dropped, so a queue full of them may exceed maxsize. Queue depth
+    is tracked in the 'queue_depth' gauge, along with 'conflated' and 'dropped' event counters.
+    '''
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    CONFLATE = 'conflate'
+
+    BOOK_EVENTS = ('orderbook_update', 'orderbook_snapshot')
+
+    def __init__(self, metrics, maxsize=1000, policy=CONFLATE, on_drop=None):
+        self.metrics = metrics
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_drop = on_drop
+        self.batches = deque()
+        # Number of events queued
+        self.size = 0
+        # When what's left after conflating or dropping still overflows, wait for it to double
+        # before trying again, rather than rescanning the queue on every put
+        self.limit = maxsize
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def put(self, batch):
+        self.batches.append(batch)
+        self.size += len(batch)
+        self.readable.set()
+
+        if self.maxsize and self.size > self.limit:
+            if self.policy == self.CONFLATE:
+                self._conflate()
+            elif self.policy == self.DROP_OLDEST:
+                self._drop()
+            self.limit = max(self.maxsize, 2 * self.size) if self.policy != self.BLOCK else self.maxsize
+            if self.size > self.maxsize:
+                self.writable.clear()
+
+        self.metrics.gauge('queue_depth', self.size)
+
+    async def get(self):
+        while not self.batches:
+            self.readable.clear()
+            await self.readable.wait()
+
+        batch = self.batches.popleft()
+        self.size -= len(batch)
+        self.metrics.gauge('queue_depth', self.size)
+        if self.size <= self.maxsize:
+            self.limit = self.maxsize
+            self.writable.set()
+        return batch
+
+    async def wait_writable(self):
+        if self.policy == self.BLOCK:
+            await self.writable.wait()
+
+    def __len__(self):
+        return self.size
+
+    def _conflate(self):
+        events = []
+        for batch in self.batches:
+            for event in batch:
+                last = events[-1] if events else None
+                if event.event_type == 'orderbook_update' and last is not None and last.event_type == 'orderbook_update' \
+                        and self._book(last) == self._book(event):
+                    events[-1] = self._merge(last, event)
+                else:
+                    events.append(event)
+
+        self.metrics.incr('conflated', self.size - len(events))
+        self.batches = deque([ events ])
+        self.size = len(events)
+
+    def _drop(self):
+        dropped = 0
+        batches = deque()
+        for batch in self.batches:
+            if self.size > self.maxsize:
+                kept = [ event for event in batch if event.event_type not in self.BOOK_EVENTS ]
+                dropped += len(batch) - len(kept)
+                self.size -= len(batch) - len(kept)
+                batch = kept
+            if batch:
+                batches.append(batch)
+
+        self.batches = batches
+        if dropped:
+            self.metrics.incr('dropped', dropped)
+            if self.on_drop:
+                self.on_drop()
+
+    @staticmethod
+    def _book(event):
+        return (event.exchange, event.product)
+
+    @staticmethod
+    def _merge(first, second):
+        ''' A single update equivalent to applying first, then second '''
+        levels = { (row[0], row[1]): row for row in first.update }
+        for row in second.update:
+            levels[(row[0], row[1])] = row
+
+        return common.OrderbookEvent(first.exchange, list(levels.values()), second.sequence, timestamp=second.timestamp,
+                first_sequence=first.first_sequence if first.first_sequence is not None else first.sequence, checksum=second.checksum,
+            product=first.product)
+
+class ProductFeed():
+    '''
+    One product's share of a websocket carrying several (see ExchangeWebsocket.product_feed). Its
+    book events are routed here, with their own queue, sequencing and metrics, and iterated the
+    same way as the websocket. Everything else (ex: orders) stays on the websocket.
+    '''
+
+    def __init__(self, exchange, product, maxsize=1000, policy=FeedQueue.CONFLATE, reconnect=None):
+        self.exchange = exchange
+        self.product = product
+        self.metrics = Metrics()
+        self.queue = FeedQueue(self.metrics, maxsize, policy, on_drop=lambda: self.book_sync.invalidate())
+        self.book_sync = BookSync(exchange, self.queue.put, self.metrics, product, reconnect)
+        self.batch = []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.batch:
+            self.batch = await self.queue.get()
+            self.batch.reverse()
+        return self.batch.pop()
@@ -0,0 +1,316 @@
+'''
+Optional deployment mode running each exchange's websocket, parsing and Orderbook in a worker
+process of its own, so ingest scales across cores instead of sharing the strategy's event loop
+(and its blocking REST calls).
+
+Each worker publishes compact fixed width records (see RECORD) into a util.ring.Ring, which the
+strategy process reads with IngestReader, much as it would merge trade.BookFeeds:
+
+    reader = ingest.start({ 'poloniex': ('ETH/USDC', quote_precision, base_precision), ... })
+    async for event in reader:
+        book = reader.books[event.exchange]
+
+Worker books run in tick mode, so bbo events and reader.books hold ticks (convert with the book's
+decimal_price/decimal_quantity), while order events are converted back to Decimals. Only what
+strategies use is carried: sequences and taker ids are not.
+'''
+import asyncio
+import logging
+import multiprocessing
+import struct
+from collections import deque
+from decimal import ROUND_DOWN
+
+from api import common
+from api import trade
+from api.ob import TickScale
+from util.ring import Ring
+
+_log = logging.getLogger(__name__)
+
+# kind, side, level, count, valid, timestamp, price, quantity, price2, quantity2, order id
+#
+# bbo: price/quantity are the best bid, price2/quantity2 the best ask
+# depth: one level of a side, level of count (count 0 for an empty side). A side's levels are
+#        always written together, after any update changing them (and before its bbo)
+# order events: price and quantity, with the remaining size in quantity2 for order_done, whose
+#        reason is DONE_REASONS[level]. count is the ORDER_TYPES index of an order_received, whose
+#        quantity is in quote currency for a market order (Coinbase sends its funds), in FUNDS ticks
+RECORD = struct.Struct('<BBBB?3xqqqqq40s')
+
+BBO = 1
+DEPTH = 2
+DISCONNECTED = 3
+ORDER_KINDS = {
+    'order_received': 4,
+    'order_open': 5,
+    'order_match': 6,
+    'order_change': 7,
+    'order_done': 8
+}
+
+SIDES = (None, 'buy', 'sell', 'bids', 'asks')
+ORDER_TYPES = (None, 'limit', 'market')
+DONE_REASONS = ('filled', 'cancelled', 'canceled', 'killed')
+# Stands in for None in integer fields
+NONE = -1 << 63
+# Market order funds carry more decimals than the quote precision (ex: after fees), rounded to these
+FUNDS = TickScale('0.00000001')
+
+DEPTH_LEVELS = 5
+SLOTS = 1 << 14
+
+def start(exchanges, depth=DEPTH_LEVELS, slots=SLOTS):
+    '''
+    Starts a worker process per exchange, given as exchange -> (pair, quote_precision, base_precision),
+    returning the IngestReader for them all. depth is the number of levels per side published.
+    '''
+    # A fork would inherit the caller's event loop
+    context = multiprocessing.get_context('spawn')
+    rings, processes, scales = {}, {}, {}
+    for exchange, (pair, quote_precision, base_precision) in exchanges.items():
+        rings[exchange] = Ring(RECORD, slots)
+        scales[exchange] = (quote_precision, base_precision)
+        processes[exchange] = context.Process(target=_worker, name=f'ingest-{exchange}', daemon=True,
+            args=(exchange, pair, rings[exchange].name, slots, quote_precision, base_precision, depth))
+        processes[exchange].start()
+
+    return IngestReader(rings, scales, processes)
+
+def _worker(exchange, pair, ring_name, slots, quote_precision, base_precision, depth):
+    ring = Ring(RECORD, slots, name=ring_name)
+    try:
+        asyncio.run(_ingest(exchange, pair, ring, quote_precision, base_precision, depth))
+    finally:
+        ring.close()
+
+async def _ingest(exchange, pair, ring, quote_precision, base_precision, depth):
+    feed = (await trade.create_feed(exchange, pair, quote_precision, base_precision))[exchange]
+    writer = RecordWriter(ring, feed['ob'], depth)
+    # Updates too, since depth can change without the bbo moving
+    async for event in trade.BookFeed(feed['ws'], feed['ob'], updates=True):
+        await writer.publish(event)
+
+class RecordWriter():
+    '''
+    Worker side: encodes the events of a BookFeed (with updates=True) over ob into records. Depth is
+    published after each update that changes the top levels. When the ring is full, market data is
+    dropped (counted in dropped, the next update or bbo corrects it) while order events wait for room.
+    '''
+
+    RETRY_DELAY = 0.0005
+
+    def __init__(self, ring, ob, depth=DEPTH_LEVELS):
+        self.ring = ring
+        self.ob = ob
+        self.depth = depth
+        # side -> levels last published
+        self.published = { 'bids': None, 'asks': None }
+        self.dropped = 0
+
+    async def publish(self, event):
+        if event.event_type == 'orderbook_update':
+            records = self._depth_records()
+            if records:
+                self._put_market(records)
+        elif event.event_type == 'bbo':
+            # Snapshots only come through as a bbo, so depth is checked here too
+            self._put_market(self._depth_records() + [ (BBO, 0, 0, 0, self.ob.valid, event.timestamp or 0,
+                *self._level(event.bid_price, event.bid_quantity), *self._level(event.ask_price, event.ask_quantity), b'') ])
+        elif event.event_type == 'disconnected':
+            await self._put([ (DISCONNECTED, 0, 0, 0, False, 0, 0, 0, 0, 0, b'') ])
+        elif event.event_type in ORDER_KINDS:
+            await self._put([ self._order_record(event) ])
+
+    def _put_market(self, records):
+        if not self.ring.put_many(records):
+            self.dropped += 1
+            # Resend the depth with the next update or bbo
+            self.published = { 'bids': None, 'asks': None }
+
+    async def _put(self, records):
+        while not self.ring.put_many(records):
+            await asyncio.sleep(self.RETRY_DELAY)
+
+    @staticmethod
+    def _level(price, quantity):
+        return (NONE, NONE) if price is None else (price, quantity)
+
+    def _depth_records(self):
+        records = []
+        if not self.depth:
+            return records
+
+        for side in ('bids', 'asks'):
+            levels = self.ob.top_levels(side, self.depth)
+            if levels == self.published[side]:
+                continue
+            self.published[side] = levels
+            side_id = SIDES.index(side)
+            records.extend([ (DEPTH, side_id, level, len(levels), self.ob.valid, 0, price, quantity, 0, 0, b'')
+                for level, (price, quantity) in enumerate(levels) ] or [ (DEPTH, side_id, 0, 0, self.ob.valid, 0, 0, 0, 0, 0, b'') ])
+        return records
+
+    def _ticks(self, scale, value):
+        return NONE if value is None else scale(value)
+
+    def _order_record(self, event):
+        quotetype, basetype = self.ob.quotetype, self.ob.basetype
+        reason = DONE_REASONS.index(event.reason) if event.event_type == 'order_done' and event.reason in DONE_REASONS else 255
+        remaining = getattr(event, 'remaining_size', None)
+        order_type = getattr(event, 'order_type', None)
+        order_type = ORDER_TYPES.index(order_type) if order_type in ORDER_TYPES else 0
+        if order_type == ORDER_TYPES.index('market') and event.quantity is not None:
+            quantity = FUNDS(event.quantity.quantize(FUNDS.precision, rounding=ROUND_DOWN))
+        else:
+            quantity = self._ticks(basetype, event.quantity)
+        return (ORDER_KINDS[event.event_type], SIDES.index(event.side) if event.side in SIDES else 0, reason, order_type, True,
+            event.timestamp or 0, self._ticks(quotetype, event.price), quantity, 0,
+            self._ticks(basetype, remaining), event.id.encode()[:40])
+
+class DepthBook():
+    '''
+    Strategy side copy of the top levels of a worker's book, as published, with the read only part of
+    the Orderbook api. valid follows the worker's book. Depth queries only see the published levels, so
+    size_to counts no further, and vwap and price_for_size are None for sizes needing deeper levels.
+    '''
+
+    def __init__(self, quote_precision, base_precision):
+        self.ticks = True
+        self.quotetype, self.basetype = TickScale(quote_precision), TickScale(base_precision)
+        # side -> [(price, quantity)], from the touch outward
+        self.levels = { 'bids': [], 'asks': [] }
+        # Levels of a side read so far, until all of them have been
+        self.pending = { 'bids': [], 'asks': [] }
+        self.valid = False
+
+    def best_bid(self):
+        return self.levels['bids'][0]
+
+    def best_ask(self):
+        return self.levels['asks'][0]
+
+    def top_levels(self, side, n):
+        return self.levels[side][:n]
+
+    def size_to(self, side, price):
+        ''' Quantity available on side at price or better '''
+        total = 0
+        for level_price, quantity in self.levels[side]:
+            if (level_price < price if side == 'bids' else level_price > price):
+                break
+            total += quantity
+        return total
+
+    def _fill(self, side, quantity):
+        ''' (worst price, notional) taking quantity from side, or None if the side is too shallow '''
+        filled, notional = 0, 0
+        for price, size in self.levels[side]:
+            if filled + size >= quantity:
+                return (price, notional + (quantity - filled) * price)
+            filled += size
+            notional += price * size
+        return None
+
+    def price_for_size(self, side, quantity):
+        ''' Worst price reached taking quantity from side, or None if the side is too shallow '''
+        fill = self._fill(side, quantity)
+        return None if fill is None else fill[0]
+
+    def vwap(self, side, quantity):
+        ''' Average price (as float ticks) taking quantity from side, or None if the side is too shallow '''
+        fill = self._fill(side, quantity)
+        return None if fill is None else fill[1] / quantity
+
+    def decimal_price(self, price):
+        return self.quotetype.decimal(price)
+
+    def decimal_quantity(self, quantity):
+        return self.basetype.decimal(quantity)
+
+class IngestReader():
+    '''
+    Strategy side: polls every worker's ring, keeping books (exchange -> DepthBook) up to date, and
+    yields bbo, order and 'disconnected' events. As in async_util.merge, order events read in the same
+    poll jump ahead of market data. Raises ExchangeException if a worker dies.
+    '''
+
+    POLL_INTERVAL = 0.0005
+
+    def __init__(self, rings, scales, processes=None):
+        self.rings = rings
+        self.processes = processes or {}
+        self.books = { exchange: DepthBook(*scales[exchange]) for exchange in rings }
+        self.orders = deque()
+        self.market = deque()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.orders and not self.market:
+            for exchange, ring in self.rings.items():
+                for record in ring.drain():
+                    self._read(exchange, record)
+
+            if not self.orders and not self.market:
+                for exchange, process in self.processes.items():
+                    if process.exitcode is not None:
+                        raise common.ExchangeException(exchange, f'Ingest worker exited with code {process.exitcode}')
+                await asyncio.sleep(self.POLL_INTERVAL)
+
+        return (self.orders or self.market).popleft()
+
+    def _read(self, exchange, record):
+        kind, side, level, count, valid, timestamp, price, quantity, price2, quantity2, order_id = record
+        book = self.books[exchange]
+        timestamp = timestamp or None
+
+        if kind == BBO:
+            book.valid = valid
+            self.market.append(common.BBOEvent(exchange, *self._level(price, quantity), *self._level(price2, quantity2), timestamp=timestamp))
+        elif kind == DEPTH:
+            side = SIDES[side]
+            if count:
+                book.pending[side].append((price, quantity))
+            if level + 1 >= count:
+                book.levels[side], book.pending[side] = book.pending[side], []
+        elif kind == DISCONNECTED:
+            book.valid = False
+            self.market.append(common.GenericEvent('disconnected', exchange))
+        else:
+            self.orders.append(self._order_event(exchange, book, kind, SIDES[side], level, count, timestamp, price, quantity, quantity2,
+                order_id.rstrip(b'\0').decode()))
+
+    @staticmethod
+    def _level(price, quantity):
+        return (None, None) if price == NONE else (price, quantity)
+
+    @staticmethod
+    def _order_event(exchange, book, kind, side, reason, order_type, timestamp, price, quantity, remaining, order_id):
+        order_type = ORDER_TYPES[order_type] if order_type < len(ORDER_TYPES) else None
+        price = None if price == NONE else book.decimal_price(price)
+        if quantity == NONE:
+            quantity = None
+        elif kind == ORDER_KINDS['order_received'] and order_type == 'market':
+            quantity = FUNDS.decimal(quantity)
+        else:
+            quantity = book.decimal_quantity(quantity)
+        if kind == ORDER_KINDS['order_received']:
+            return common.OrderReceivedEvent(exchange, order_id, price, quantity=quantity, order_type=order_type, timestamp=timestamp, side=side)
+        elif kind == ORDER_KINDS['order_open']:
+            return common.OrderOpenEvent(exchange, order_id, price, quantity, side=side, timestamp=timestamp)
+        elif kind == ORDER_KINDS['order_match']:
+            return common.OrderMatchEvent(exchange, order_id, price, quantity, side=side, timestamp=timestamp)
+        elif kind == ORDER_KINDS['order_change']:
+            return common.OrderChangeEvent(exchange, order_id, price, quantity, side=side, timestamp=timestamp)
+        return common.OrderDoneEvent(exchange, order_id, DONE_REASONS[reason] if reason < len(DONE_REASONS) else None, side=side,
+            price=price, quantity=quantity, timestamp=timestamp, remaining_size=None if remaining == NONE else book.decimal_quantity(remaining))
+
+    def close(self):
+        ''' Stops the workers and frees the rings '''
+        for process in self.processes.values():
+            process.terminate()
+            process.join()
+        for ring in self.rings.values():
+            ring.close()
@@ -6,6 +6,8 @@ from collections import namedtuple
 import requests
 import aiohttp
 
+from api import common
+
 API = 'https://trade.ledgerx.com/api'
 SWAP = 'day_ahead_swap'
 OPTION = 'options_contract'
@@ -171,6 +173,9 @@ class LedgerXAPI():
         #resp = self.session.post(f'{API}/orders', data=data)
         async with self.session.post(f'{API}/orders', data=data) as resp:
             body = await resp.json()
+            # A rejected order, which orders.Leg may resend
+            if resp.status >= 400 or 'data' not in body:
+                raise common.ExchangeException('ledgerx', body, resp.status)
             return body['data']['mid']
         #resp.raise_for_status()
         #return resp.json()['data']['mid']
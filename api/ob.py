@@ -1,118 +1,501 @@
 import sys
-import heapq
-import time
+import zlib
+from bisect import bisect_left, bisect_right, insort
 from decimal import Decimal
-from collections import namedtuple, Counter
 
 import numpy as np
-import pandas as pd
 
-# Have to override all comparison operators, etc..
-class NormalizedQuantity():
-    pass
+class TickScale():
+    '''
+    Fixed point representation for a given precision, ex: Decimal('0.01'). Calling the scale converts
+    a wire string (or Decimal) into an integer count of ticks, and decimal() converts ticks back into
+    a Decimal, which should only be necessary at the REST order boundary.
+
+    Ticks are powers of ten, so a precision such as 0.05 is represented in units of 0.01. Values
+    finer than the precision raise ValueError rather than lose digits, so books must be given the
+    precision the exchange sends (ex: Coinbase sizes carry 8 decimals, finer than base_increment).
+    '''
+
+    def __init__(self, precision):
+        self.precision = Decimal(precision).normalize()
+        self.digits = max(-self.precision.as_tuple().exponent, 0)
+
+    def __call__(self, value):
+        if type(value) is not str:
+            value = str(value)
+
+        if 'E' in value or 'e' in value:
+            ticks = Decimal(value).scaleb(self.digits)
+            if ticks != ticks.to_integral_value():
+                raise ValueError(f'{value} is finer than the tick precision {self.precision}')
+            return int(ticks)
+
+        # Trailing zeros past our precision are only padding, any other digit would be lost
+        whole, _, frac = value.partition('.')
+        if frac[self.digits:].rstrip('0'):
+            raise ValueError(f'{value} is finer than the tick precision {self.precision}')
+        return int(whole + frac[:self.digits].ljust(self.digits, '0'))
+
+    def decimal(self, ticks):
+        return Decimal(ticks).scaleb(-self.digits)
 
 class Orderbook():
-    OrderbookEntry = namedtuple('OrderbookEntry', 'price time quantity')
-
-    def __init__(self, snapshot, quote_prec, base_prec):
-        # Set datatype to ticks class
-        pass
-
-    def __init__(self, snapshot):
-        self.quotetype, self.basetype = Decimal, Decimal
-        # Utilize named tuples to make things a little more readable
-        self.orderbook = {
-            'asks': [ (Decimal(ask.price), time.time_ns(), Decimal(ask.quantity)) for ask in snapshot['asks'].itertuples() ],
-            'bids': [ (-Decimal(bid.price), time.time_ns(), Decimal(bid.quantity)) for bid in snapshot['bids'].itertuples() ]
-        }
-
-        heapq.heapify(self.orderbook['asks'])
-        heapq.heapify(self.orderbook['bids'])
-
-        self.entry_count = {
-            'asks': Counter([ ask[0] for ask in self.orderbook['asks'] ]),
-            'bids': Counter([ bid[0] for bid in self.orderbook['bids'] ])
-        }
-
-    # How is it possible for this to endlessly recurse?
-    def _heap_peek(self, side):
-        heap = self.orderbook[side]
-        while True:
-            level = heap[0]   # Get the oldest entry at this price level
-
-            # Lazy delete all old entries at this price level
-            while self.entry_count[side][level[0]] > 1:
-                heapq.heappop(heap)
-                #print(f'Removing old entry: {heapq.heappop(heap)}')
-                self.entry_count[side].subtract([level[0]])
-
-            level = heap[0] # Newest entry in heap
-            if level[2] == 0:
-                del self.entry_count[side][level[0]]
-                #print(f'Deleting dead entry: {heapq.heappop(heap)}')
-                # Possible a deletion may be sent for an item no longer in the book?
-                dead = heapq.heappop(heap)
-                #print(f'Deleting dead entry: {dead}')
-                continue
-                #return self._heap_peek(side)
-
-            return level
-
-    # Any fast way to check for entries..? May need to back via a dictionary
+    '''
+    Aggregated (L2) orderbook. Each side keeps one entry per price level in a hashtable,
+    alongside a sorted index of its price keys. Keys are ordered such that the best level
+    is always the last item of the index (bids are keyed by price, asks by -price), so
+    reading the BBO is O(1), and changes near the touch only shift the tail of the index.
+
+    If quote_prec and base_prec are given (typically ProductInfo.quote_precision and base_precision),
+    the book runs in tick mode: prices and quantities are stored as scaled ints rather than Decimals.
+    decimal_price() and decimal_quantity() convert values read from the book back for placing orders.
+
+    If max_depth is given, each side is bounded to that many levels from the touch; levels pushed past it
+    are evicted from the far end as updates arrive. Note a bounded book may briefly hold fewer than max_depth
+    levels after a deletion, until the exchange sends the level that takes its place.
+
+    If checksum_depth is given, the book maintains a Kraken style CRC32 of the top checksum_depth levels
+    for verify_checksum(). Levels must then keep the exchange's string formatting, so in tick mode the
+    precisions must match the number of decimals the exchange sends.
+
+    valid is cleared (ex: by trade.BookFeed) while the book can't be trusted, such as while its feed
+    is reconnecting, and set again by the next reset.
+    '''
+
+    def __init__(self, snapshot, quote_prec=None, base_prec=None, max_depth=None, checksum_depth=None):
+        self.ticks = quote_prec is not None and base_prec is not None
+        if self.ticks:
+            self.quotetype, self.basetype = TickScale(quote_prec), TickScale(base_prec)
+        else:
+            self.quotetype, self.basetype = Decimal, Decimal
+        self.max_depth = max_depth
+        self.checksum_depth = checksum_depth
+        self.reset(snapshot)
+
+    def reset(self, snapshot):
+        ''' Replaces the contents of the book with snapshot, keeping its tick and depth settings '''
+        # side -> price -> quantity
+        self.levels = { 'bids': {}, 'asks': {} }
+        # side -> sorted list of price keys, best level last
+        self.index = { 'bids': [], 'asks': [] }
+        # Cached checksum, None when the top of the book has changed since it was computed
+        self._checksum = None
+        # side -> cumulative depth from the touch outward: (-key, cumulative quantity, cumulative notional) per level.
+        # Only extended as deep as queries have needed, and cut back to the levels above any change.
+        self._depth = { 'bids': ([], [], []), 'asks': ([], [], []) }
+        self.valid = True
+
+        # Snapshot rows are [price, quantity, ...] as parsed off the wire; extra fields (order ids, times) are ignored.
+        # The levels are filled first and the index sorted once, rather than inserting each row into it
+        for side in ('bids', 'asks'):
+            levels = self.levels[side]
+            for price, quantity, *_ in snapshot[side]:
+                price, quantity = self.quotetype(price), self.basetype(quantity)
+                if quantity:
+                    levels[price] = quantity
+                else:
+                    levels.pop(price, None)
+            self.index[side] = sorted(self._key(side, price) for price in levels)
+        self._truncate(self.max_depth)
+
+    @staticmethod
+    def _key(side, price):
+        return price if side == 'bids' else -price
+
+    def _set_level(self, side, price, quantity):
+        levels = self.levels[side]
+
+        if quantity == 0:
+            # Possible a deletion may be sent for an item no longer in the book
+            if levels.pop(price, None) is not None:
+                index = self.index[side]
+                del index[bisect_left(index, self._key(side, price))]
+        else:
+            if price not in levels:
+                insort(self.index[side], self._key(side, price))
+            levels[price] = quantity
+
+        # Cumulative depth at and beyond the changed level is stale
+        keys = self._depth[side][0]
+        if keys and -self._key(side, price) <= keys[-1]:
+            index = self.index[side]
+            self._cut_depth(side, len(index) - bisect_right(index, self._key(side, price)))
+
+        # Only changes within the checksummed levels invalidate the checksum
+        if self.checksum_depth and self._checksum is not None:
+            index = self.index[side]
+            if len(index) <= self.checksum_depth or self._key(side, price) >= index[-self.checksum_depth]:
+                self._checksum = None
+
+    def _truncate(self, max_depth):
+        if not max_depth:
+            return
+
+        for side in ('bids', 'asks'):
+            index, levels = self.index[side], self.levels[side]
+            excess = len(index) - max_depth
+            if excess > 0:
+                # The far end of the book is the head of the index
+                for key in index[:excess]:
+                    del levels[self._key(side, key)]
+                del index[:excess]
+                self._cut_depth(side, len(index))
+                if self.checksum_depth and max_depth <= self.checksum_depth:
+                    self._checksum = None
+
+    def _top(self):
+        bids, asks = self.index['bids'], self.index['asks']
+        bid = (bids[-1], self.levels['bids'][bids[-1]]) if bids else None
+        ask = (asks[-1], self.levels['asks'][-asks[-1]]) if asks else None
+        return bid, ask
+
+    # Update format: [ [side, price, quantity]+ ], where a quantity of 0 removes the level
+    # max_depth overrides the depth the book was created with
+    # Returns whether the BBO (price or quantity of either side) changed
     def update(self, update, max_depth=None):
+        top = self._top()
         for side, price, quantity in update:
-            price = -Decimal(price) if side == 'bids' else Decimal(price)
-            quantity = Decimal(quantity)
+            self._set_level(side, self.quotetype(price), self.basetype(quantity))
+        self._truncate(max_depth or self.max_depth)
+        return self._top() != top
+
+    def _cut_depth(self, side, levels):
+        for cache in self._depth[side]:
+            del cache[levels:]
+
+    def _extend_depth(self, side):
+        ''' Adds the next level to side's cumulative depth, returning False if the book is exhausted '''
+        keys, quantities, notionals = self._depth[side]
+        index = self.index[side]
+        if len(keys) == len(index):
+            return False
+
+        key = index[-1 - len(keys)]
+        price = self._key(side, key)
+        quantity = self.levels[side][price]
+        keys.append(-key)
+        quantities.append(quantities[-1] + quantity if quantities else quantity)
+        notionals.append(notionals[-1] + price * quantity if notionals else price * quantity)
+        return True
+
+    def top_levels(self, side, n):
+        ''' The top n (price, quantity) levels of side, from the touch outward '''
+        levels = self.levels[side]
+        return [ (self._key(side, key), levels[self._key(side, key)]) for key in reversed(self.index[side][-n:]) ]
+
+    def size_to(self, side, price):
+        ''' Quantity available on side at price or better '''
+        keys, quantities, _ = self._depth[side]
+        limit = -self._key(side, price)
+        while (not keys or keys[-1] <= limit) and self._extend_depth(side):
+            pass
+
+        levels = bisect_right(keys, limit)
+        return quantities[levels - 1] if levels else 0
+
+    def _fill_level(self, side, quantity):
+        keys, quantities, _ = self._depth[side]
+        while (not quantities or quantities[-1] < quantity) and self._extend_depth(side):
+            pass
+
+        level = bisect_left(quantities, quantity)
+        return level if level < len(quantities) else None
+
+    def price_for_size(self, side, quantity):
+        ''' Worst price reached taking quantity from side, or None if the side is too shallow '''
+        level = self._fill_level(side, quantity)
+        return None if level is None else self._key(side, -self._depth[side][0][level])
+
+    def vwap(self, side, quantity):
+        '''
+        Average price taking quantity from side, or None if the side is too shallow. In tick mode
+        this is a float number of ticks.
+        '''
+        level = self._fill_level(side, quantity)
+        if level is None:
+            return None
 
-            self.entry_count[side].update([price])
-            heapq.heappush(self.orderbook[side], (price, time.time_ns(), quantity))
+        keys, quantities, notionals = self._depth[side]
+        filled, notional = (quantities[level - 1], notionals[level - 1]) if level else (0, 0)
+        return (notional + (quantity - filled) * self._key(side, -keys[level])) / quantity
+
+    @staticmethod
+    def _checksum_fragment(value):
+        # Decimals in fixed point, as str() turns small ones (ex: 0.00000050) into exponent notation. Ticks are ints
+        text = str(value) if type(value) is int else format(value, 'f')
+        return text.replace('.', '').lstrip('0')
+
+    def checksum(self):
+        '''
+        CRC32 of the top checksum_depth levels, in the format of Kraken's book feed: asks from the best price
+        up, then bids from the best price down, each level as its price then quantity with the decimal point
+        and leading zeros removed. Recomputed only when one of those levels has changed.
+        '''
+        if self._checksum is None:
+            fragments = []
+            for side in ('asks', 'bids'):
+                levels = self.levels[side]
+                for key in reversed(self.index[side][-self.checksum_depth:]):
+                    price = self._key(side, key)
+                    fragments.append(self._checksum_fragment(price))
+                    fragments.append(self._checksum_fragment(levels[price]))
+            self._checksum = zlib.crc32(''.join(fragments).encode())
+
+        return self._checksum
+
+    # Books created without a checksum_depth aren't checksummed, so always pass
+    def verify_checksum(self, checksum):
+        return not self.checksum_depth or self.checksum() == int(checksum)
 
     def best_bid(self):
-        level = self._heap_peek('bids')
-        return (-level[0], level[2])
+        price = self.index['bids'][-1]
+        return (price, self.levels['bids'][price])
 
     def best_ask(self):
-        level = self._heap_peek('asks')
-        return (level[0], level[2])
+        price = -self.index['asks'][-1]
+        return (price, self.levels['asks'][price])
+
+    def decimal_price(self, price):
+        return self.quotetype.decimal(price) if self.ticks else price
+
+    def decimal_quantity(self, quantity):
+        return self.basetype.decimal(quantity) if self.ticks else quantity
+
+class ArrayOrderbook():
+    '''
+    Aggregated (L2) orderbook backed by contiguous NumPy arrays, for keeping full depth books
+    on many pairs without per-level python objects. Each side is a pair of int64 arrays (keys
+    and quantities, in ticks), sorted with the best level last as in Orderbook, and an entire
+    OrderbookEvent.update batch is applied in a single vectorized pass.
+
+    Wire strings are parsed as float64 and rounded to ticks, which is exact while values stay
+    below 2**53 ticks. As with TickScale, values finer than the precision raise ValueError.
+    max_depth bounds each side the same way as Orderbook.
+    '''
+
+    def __init__(self, snapshot, quote_prec, base_prec, max_depth=None):
+        self.ticks = True
+        self.max_depth = max_depth
+        self.quotetype, self.basetype = TickScale(quote_prec), TickScale(base_prec)
+        self.reset(snapshot)
+
+    def reset(self, snapshot):
+        ''' Replaces the contents of the book with snapshot, keeping its tick and depth settings '''
+        self.keys = { 'bids': np.empty(0, dtype=np.int64), 'asks': np.empty(0, dtype=np.int64) }
+        self.quantities = { 'bids': np.empty(0, dtype=np.int64), 'asks': np.empty(0, dtype=np.int64) }
+
+        for side in ('bids', 'asks'):
+            rows = [ row[:2] for row in snapshot[side] ]
+            if rows:
+                prices, quantities = zip(*rows)
+                keys = self._to_ticks(prices, self.quotetype)
+                self._apply(side, keys if side == 'bids' else -keys, self._to_ticks(quantities, self.basetype))
+        self._truncate(self.max_depth)
+        self.valid = True
 
-# I don't think sorting is necessary with min()
-def drop_price_level(ob, side, level):
-    drop_row = ob[side][ob[side]['price'] == level]
-    if drop_row.empty: 
-        return
-    ob[side] = ob[side].drop(drop_row.index)
+    @staticmethod
+    def _to_ticks(values, scale):
+        scaled = np.asarray(values, dtype=np.float64) * 10.0**scale.digits
+        ticks = np.rint(scaled)
+        # Only float error is expected between the two, anything more is a digit past the precision
+        if not np.allclose(scaled, ticks, rtol=1e-12, atol=0):
+            raise ValueError(f'Values finer than the tick precision {scale.precision}')
+        return ticks.astype(np.int64)
 
-def add_price_level(ob, side, level, quantity):
-    ob[side] = ob[side].append(pd.Series([level, quantity],
-        index=['price', 'quantity']),
-            ignore_index=True)
+    def _apply(self, side, keys, quantities):
+        if len(keys) == 0:
+            return
 
-def change_price_level(ob, side, level, new_quantity):
-    ob[side]['quantity'][ob[side]['price'] == level] = new_quantity
+        # Only the last update to a given level within the batch matters
+        keys, last = np.unique(keys[::-1], return_index=True)
+        quantities = quantities[::-1][last]
 
+        book_keys, book_quantities = self.keys[side], self.quantities[side].copy()
+        pos = np.searchsorted(book_keys, keys)
+        found = pos < len(book_keys)
+        found[found] = book_keys[pos[found]] == keys[found]
+
+        book_quantities[pos[found]] = quantities[found]
+
+        new = ~found & (quantities > 0)
+        book_keys = np.insert(book_keys, pos[new], keys[new])
+        book_quantities = np.insert(book_quantities, pos[new], quantities[new])
+
+        live = book_quantities > 0
+        self.keys[side], self.quantities[side] = book_keys[live], book_quantities[live]
+
+    def _truncate(self, max_depth):
+        if not max_depth:
+            return
+
+        for side in ('bids', 'asks'):
+            if len(self.keys[side]) > max_depth:
+                self.keys[side] = self.keys[side][-max_depth:]
+                self.quantities[side] = self.quantities[side][-max_depth:]
+
+    def _top(self):
+        return tuple((int(self.keys[side][-1]), int(self.quantities[side][-1])) if len(self.keys[side]) else None
+            for side in ('bids', 'asks'))
+
+    # Update format: [ [side, price, quantity]+ ], where a quantity of 0 removes the level
+    # Returns whether the BBO (price or quantity of either side) changed
+    def update(self, update, max_depth=None):
+        if not update:
+            return False
+
+        top = self._top()
+        sides, prices, quantities = zip(*update)
+        bids = np.asarray(sides) == 'bids'
+        prices = self._to_ticks(prices, self.quotetype)
+        quantities = self._to_ticks(quantities, self.basetype)
+
+        self._apply('bids', prices[bids], quantities[bids])
+        self._apply('asks', -prices[~bids], quantities[~bids])
+        self._truncate(max_depth or self.max_depth)
+        return self._top() != top
+
+    def best_bid(self):
+        return (int(self.keys['bids'][-1]), int(self.quantities['bids'][-1]))
+
+    def best_ask(self):
+        return (int(-self.keys['asks'][-1]), int(self.quantities['asks'][-1]))
+
+    def depth(self, side, levels=None):
+        ''' Returns (prices, quantities) arrays for side, ordered from the touch outward '''
+        keys, quantities = self.keys[side][::-1], self.quantities[side][::-1]
+        if levels is not None:
+            keys, quantities = keys[:levels], quantities[:levels]
+
+        return (keys if side == 'bids' else -keys, quantities)
+
+    def cumulative_size(self, side, levels=None):
+        ''' Quantity available on side up to and including each level, from the touch outward '''
+        return np.cumsum(self.depth(side, levels)[1])
+
+    def price_for_size(self, side, size):
+        ''' Worst price reached when taking size (in ticks) from side, or None if the side is too shallow '''
+        prices, quantities = self.depth(side)
+        level = np.searchsorted(np.cumsum(quantities), size)
+        return int(prices[level]) if level < len(prices) else None
+
+    def size_to(self, side, price):
+        ''' Quantity available on side at price (in ticks) or better '''
+        prices, quantities = self.depth(side)
+        return int(quantities[prices >= price if side == 'bids' else prices <= price].sum())
+
+    def vwap(self, side, size):
+        ''' Average price (as float ticks) taking size from side, or None if the side is too shallow '''
+        prices, quantities = self.depth(side)
+        cumulative = np.cumsum(quantities)
+        level = np.searchsorted(cumulative, size)
+        if level >= len(prices):
+            return None
+
+        filled = int(cumulative[level - 1]) if level else 0
+        notional = int(np.dot(prices[:level], quantities[:level])) + (size - filled) * int(prices[level])
+        return notional / size
+
+    def decimal_price(self, price):
+        return self.quotetype.decimal(price)
+
+    def decimal_quantity(self, quantity):
+        return self.basetype.decimal(quantity)
+
+class ConsolidatedBook():
+    '''
+    Best bid and ask across several venues' books, adjusted for each venue's taker fee: a bid is what selling
+    into it nets (price * (1 - fee)), an ask what buying from it costs (price * (1 + fee)). Fed with each venue's
+    top of book (see update_bbo, which takes the BBOEvents trade.BookFeed emits), so the consolidated best is
+    kept incrementally; only a venue losing the best price forces a rescan of the venues.
+
+    Venues' prices must be in the same units, so books in tick mode need matching quote precisions.
+    '''
+
+    def __init__(self, fees):
+        # venue -> taker fee
+        self.fees = fees
+        # venue -> (adjusted price, price, quantity), per side
+        self.bids = {}
+        self.asks = {}
+        self.best = { 'bids': None, 'asks': None }
+
+    def update(self, venue, bid_price, bid_quantity, ask_price, ask_quantity):
+        '''
+        Sets venue's top of book, where a price of None is an empty side. Returns whether the consolidated
+        best bid or ask changed.
+        '''
+        fee = self.fees[venue]
+        before = (self.best_bid(), self.best_ask())
+        self._set('bids', venue, None if bid_price is None else (bid_price * (1 - fee), bid_price, bid_quantity),
+            lambda new, best: new > best)
+        self._set('asks', venue, None if ask_price is None else (ask_price * (1 + fee), ask_price, ask_quantity),
+            lambda new, best: new < best)
+        return (self.best_bid(), self.best_ask()) != before
+
+    def update_bbo(self, event):
+        return self.update(event.exchange, event.bid_price, event.bid_quantity, event.ask_price, event.ask_quantity)
+
+    def _set(self, side, venue, level, better):
+        levels = self.bids if side == 'bids' else self.asks
+        if level is None:
+            levels.pop(venue, None)
+        else:
+            levels[venue] = level
+        best = self.best[side]
+
+        if level is not None and (best is None or better(level[0], levels[best][0])):
+            self.best[side] = venue
+        elif best == venue:
+            # The best venue may have worsened or emptied, so find the best again
+            self.best[side] = None
+            for other, (price, _, _) in levels.items():
+                if self.best[side] is None or better(price, levels[self.best[side]][0]):
+                    self.best[side] = other
+
+    def _best(self, side):
+        venue = self.best[side]
+        if venue is None:
+            return None
+        return (venue, *(self.bids if side == 'bids' else self.asks)[venue])
+
+    def best_bid(self):
+        ''' (venue, fee adjusted price, price, quantity) of the best bid across venues '''
+        return self._best('bids')
+
+    def best_ask(self):
+        ''' (venue, fee adjusted price, price, quantity) of the best ask across venues '''
+        return self._best('asks')
+
+    def crossed(self):
+        ''' Whether buying the best ask and selling into the best bid profits after taker fees on both '''
+        bid, ask = self.best_bid(), self.best_ask()
+        return bid is not None and ask is not None and bid[1] > ask[1]
+
+    def cross(self):
+        ''' (buy venue, sell venue, edge per unit, quantity) if crossed, else None '''
+        if not self.crossed():
+            return None
+
+        bid, ask = self.best_bid(), self.best_ask()
+        return (ask[0], bid[0], bid[1] - ask[1], min(bid[3], ask[3]))
+
+# Snapshots are plain dicts of { 'bids': [ [price, quantity, ...]+ ], 'asks': [...] }, optionally with a 'sequence',
+# straight from the parsed JSON. Orderbook (and ArrayOrderbook) build directly from this format.
+
+# Legacy string BBO accessors for arb/cross, which round the values themselves
 def get_best_bid(ob):
-    max_price = max(ob['bids']['price'].array, key=lambda k: round(float(k), precision(k)))
-    bid = ob['bids'][ob['bids']['price'] == max_price]
-    return (bid['price'].array[0], bid['quantity'].array[0])
+    price, quantity = ob.best_bid()
+    return (str(price), str(quantity))
 
 def get_best_ask(ob):
-    min_price = min(ob['asks']['price'].array, key=lambda k: round(float(k), precision(k)))
-    ask = ob['asks'][ob['asks']['price'] == min_price]
-    return (ask['price'].array[0], ask['quantity'].array[0])
+    price, quantity = ob.best_ask()
+    return (str(price), str(quantity))
 
 def convert_coinbase_ob(snapshot):
-    ob = pd.Series({
-        'bids': pd.DataFrame(snapshot['bids'], columns=['price','quantity']),
-        'asks': pd.DataFrame(snapshot['asks'], columns=['price','quantity'])})
-    return ob
+    return { 'bids': snapshot['bids'], 'asks': snapshot['asks'] }
 
 def convert_kraken_ob(snapshot):
-    ob = pd.Series({
-        'bids': pd.DataFrame(snapshot[1]['bs'], columns=['price','quantity', 'time']),
-        'asks': pd.DataFrame(snapshot[1]['as'], columns=['price','quantity', 'time'])})
-    ob['bids'] = ob['bids'].drop(columns='time')
-    ob['asks'] = ob['asks'].drop(columns='time')
-    return ob
+    return { 'bids': snapshot[1]['bs'], 'asks': snapshot[1]['as'] }
 
 def convert_kraken_update(update):
     updates = []
@@ -124,35 +507,17 @@ def convert_kraken_update(update):
             updates.extend(list(map(lambda k: ['asks', k[0], k[1]], change['a'])))
     return updates
 
+# The checksum of the book after applying update, or None if it carries none
+def convert_kraken_checksum(update):
+    for change in filter(lambda k: type(k) == dict, update):
+        if 'c' in change:
+            return change['c']
+    return None
+
 def convert_coinbase_update(update):
     update = update['changes']
     return list(map(lambda k: ['bids' if k[0] == 'buy' else 'asks', k[1], k[2]], update))
 
-# Updates are in the form [ [side, price, quantity]+ ]
-def apply_ob_update(ob, update, max_depth=None):
-    ob = ob.copy()
-    for side, price, quantity in update:
-        if float(quantity) == 0:
-            drop_price_level(ob, side, price)
-        elif price in ob[side]['price'].array:
-            change_price_level(ob, side, price, quantity)
-        else:
-            add_price_level(ob, side, price, quantity)
-
-    # If the length of the book is too large after application of our updates,
-    # then just sort the book, and purge the appropriate items (min or max) until
-    # a proper depth is reached again.
-    # This is a naive approach, but should work for now.
-    if max_depth:
-        while True:
-            if len(ob['bids']) > max_depth:
-                drop_price_level(ob, 'bids', ob['bids']['price'].min())
-            elif len(ob['asks']) > max_depth:
-                drop_price_level(ob, 'asks', ob['asks']['price'].max())
-            else: 
-                break
-    return ob
-
 def precision(num):
     try:
         return len(num[num.index('.'):])
@@ -16,8 +16,15 @@
 # Some order updates will depend on the state of the OB alongside current order state. Recommended simply to
 # init with a reference to the OB
 
+import asyncio
+import logging
+import time
 from decimal import Decimal
 
+from api import common
+
+_log = logging.getLogger(__name__)
+
 class PegBestOrder():
     '''
     This type of order pegs the order at the best price on the desired orderbook side.
@@ -123,3 +130,89 @@ class IOCOrder():
                 pass
             elif update_event.reason == 'filled':
                 pass
+
+def rejected(error):
+    '''
+    Whether error is the exchange refusing an order outright, so resending it can't fill twice. Anything
+    else (timeouts, dropped connections, server errors) may have reached the book.
+    '''
+    return isinstance(error, common.ExchangeException) and (error.status is None or error.status < 500)
+
+class Leg():
+    '''
+    One order of a multi-leg dispatch (see dispatch_legs). send is a coroutine function placing the
+    order, resent up to retries more times if it fails with an error retry_if accepts: by default only
+    rejections, since a timed out order may still fill. Idempotent requests such as cancels can retry
+    anything else instead. unwind is an optional coroutine function taking send's result and undoing it
+    (ex: trading the position back out), for unwind_legs.
+
+    A position taken outside the dispatch (ex: the maker fill being hedged) can be given as a leg with
+    no send, so unwind_legs flattens it along with the rest.
+
+    After dispatch, result or error is set, along with latency, the seconds until the exchange answered
+    the last attempt.
+    '''
+
+    def __init__(self, name, send=None, unwind=None, retries=0, retry_if=rejected):
+        self.name = name
+        self.send = send
+        self.unwind = unwind
+        self.retries = retries
+        self.retry_if = retry_if
+        self.result = None
+        self.error = None
+        self.latency = None
+        self.unwound = False
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.latency is None:
+            return self.name
+        return f'{self.name} ({self.latency * 1000:.1f}ms{"" if self.ok else f", failed: {self.error}"})'
+
+async def dispatch_legs(legs):
+    '''
+    Sends every leg at once and waits for all of their acknowledgements, so the last leg out isn't
+    left exposed for the round trips of the ones before it. Failed legs are resent (again all at once)
+    while they have retries left and their error is one they retry. Returns the legs.
+
+    Legs that went through are kept, since a partial hedge beats none. Any leg still failing is left
+    to the caller, which may retry it or flatten everything with unwind_legs.
+    '''
+    async def send(leg):
+        start = time.perf_counter()
+        try:
+            leg.result, leg.error = await leg.send(), None
+        except Exception as e:
+            leg.error = e
+        leg.latency = time.perf_counter() - start
+
+    pending = [ leg for leg in legs if leg.send ]
+    attempt = 0
+    while pending:
+        await asyncio.gather(*[ send(leg) for leg in pending ])
+        attempt += 1
+        pending = [ leg for leg in pending if not leg.ok and leg.retries >= attempt and leg.retry_if(leg.error) ]
+        if pending:
+            _log.warning(f'Retrying legs: {", ".join(str(leg) for leg in pending)}')
+
+    _log.info(f'Dispatched legs: {", ".join(str(leg) for leg in legs)}')
+    return legs
+
+async def unwind_legs(legs):
+    '''
+    Reverses (concurrently) every leg that went through and has an unwind, ex: the hedges and the
+    fill they were hedging, when a hedge can't be placed. An unwind that fails is logged.
+    '''
+    await asyncio.gather(*[ _unwind(leg) for leg in legs if leg.ok and leg.unwind ])
+    return legs
+
+async def _unwind(leg):
+    try:
+        await leg.unwind(leg.result)
+        leg.unwound = True
+    except Exception as e:
+        _log.error(f'Failed to unwind leg {leg.name}: {e}')
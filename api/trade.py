@@ -1,8 +1,6 @@
 import asyncio
 from functools import reduce
 
-import pandas as pd
-
 from api import common
 from api import ob as simpleob
 from api import CoinbaseAPI as coinbase
@@ -10,60 +8,173 @@ from api import BinanceAPI as binance
 from api import PoloniexAPI as poloniex
 from util import util
 
+_EXCHANGES = {
+    'coinbase': {
+        'ws': coinbase.CoinbaseWebsocket.connect,
+        'api': coinbase.CoinbaseAPI
+    },
+    'binance_us': {
+        'ws': binance.BinanceWebsocket.connect,
+        'api': binance.BinanceAPI
+    },
+    'poloniex': {
+        'ws': poloniex.PoloniexWebsocket.connect,
+        'api': poloniex.PoloniexAPI
+    }
+}
+
+def _snapshot_fetch(api, pair, depth):
+    ''' Lets the websocket rebuild the book from REST whenever it detects a sequence gap '''
+    if api.EXCHANGE == 'binance_us':
+        return lambda: api.get_orderbook(pair, limit=depth)
+    elif api.EXCHANGE == 'poloniex':
+        return lambda: api.get_orderbook(pair, depth)
+    return None
+
 '''
 Creates a trade feed for a given websocket. Subscribes to user feed and
 orderbook update feed. Returns the up-to-date orderbook.
+
+Passing quote and base precisions creates the orderbook in tick mode. They must be as fine
+as the values the exchange sends (see ob.TickScale), which may be finer than the pair's increments.
+Passing depth bounds the orderbook to that many levels per side, and requests
+no more than needed in REST snapshots.
+
+The websocket resyncs the book on sequence gaps and reconnects by emitting a fresh
+orderbook_snapshot event, so consumers should reset the orderbook whenever one arrives.
 '''
-async def create_feed(exchange, pair):
+async def create_feed(exchange, pair, quote_precision=None, base_precision=None, depth=None):
     auth_data = util.read_auth_file('auth.json')
-    mapping = {
-        'coinbase': {
-            'ws': coinbase.CoinbaseWebsocket.connect,
-            'api': coinbase.CoinbaseAPI
-        },
-        'binance_us': {
-            'ws': binance.BinanceWebsocket.connect,
-            'api': binance.BinanceAPI
-        },
-        'poloniex': {
-            'ws': poloniex.PoloniexWebsocket.connect,
-            'api': poloniex.PoloniexAPI
-        }
-    }
-    exws = await mapping[exchange]['ws']()
-    api = mapping[exchange]['api'](auth_data)
+    exws = await _EXCHANGES[exchange]['ws']()
+    api = _EXCHANGES[exchange]['api'](auth_data)
     #pair = api.convert_pair(pair)
 
     await exws.subscribe_user_feed(auth_data, pair=pair)
     await exws.subscribe_orderbook_feed(pair)
 
+    exws.book_sync.fetch = _snapshot_fetch(api, pair, depth)
+
     # Exchanges that don't send snapshots
     if api.EXCHANGE in ['binance_us']:
-        ob = await asyncio.get_event_loop().run_in_executor(None, lambda: api.get_orderbook(pair))
-
-        while not exws.queue.empty():
-            event = await exws.queue.get()
-            if event.event_type == 'orderbook_update' and event.sequence > ob['sequence']:
-                #print('Applying OB update')
-                # Apply only if the sequence number is after the orderbook's sequence number
-                simpleob.apply_ob_update(ob, event.update)
-        return {
-            exchange: {
-                'ob': simpleob.Orderbook(ob),
-                'ws': exws
+        exws.book_sync.resync()
+
+    # Updates following the snapshot are left on the queue, already sequenced
+    async for event in exws:
+        if event.event_type == 'orderbook_snapshot':
+            return {
+                exchange: {
+                    'ob': simpleob.Orderbook(event.snapshot, quote_precision, base_precision, max_depth=depth),
+                    'ws': exws
+                }
             }
-        }
 
-    else:
-        async for event in exws:
+'''
+Creates feeds for several pairs over a single websocket to exchange. Each pair's book events are
+routed to its own api.feed.ProductFeed, while orders and everything else stay on the websocket:
+
+    { 'ws': websocket, 'books': { pair: { 'ob': Orderbook, 'feed': ProductFeed } } }
+
+Iterate a BookFeed(feed, ob) per pair, merged with the websocket for order events. precisions
+optionally maps pair -> (quote_precision, base_precision) for tick mode books.
+'''
+async def create_exchange_feed(exchange, pairs, precisions=None, depth=None):
+    auth_data = util.read_auth_file('auth.json')
+    exws = await _EXCHANGES[exchange]['ws']()
+    api = _EXCHANGES[exchange]['api'](auth_data)
+    precisions = precisions or {}
+
+    # Registered before subscribing, so no book events land on the websocket's own queue
+    feeds = { pair: exws.product_feed(pair) for pair in pairs }
+    await exws.subscribe_user_feed(auth_data, pairs=pairs)
+    await exws.subscribe_orderbook_feeds(pairs)
+
+    for pair, feed in feeds.items():
+        feed.book_sync.fetch = _snapshot_fetch(api, pair, depth)
+        if api.EXCHANGE in ['binance_us']:
+            feed.book_sync.resync()
+
+    async def first_snapshot(feed):
+        async for event in feed:
             if event.event_type == 'orderbook_snapshot':
-                return {
-                    exchange: {
-                        'ob': simpleob.Orderbook(event.snapshot),
-                        'ws': exws
-                    }
-                }
+                return event
+
+    snapshots = await asyncio.gather(*[ first_snapshot(feed) for feed in feeds.values() ])
+    return {
+        'ws': exws,
+        'books': {
+            pair: {
+                'ob': simpleob.Orderbook(snapshot.snapshot, *precisions.get(pair, (None, None)), max_depth=depth),
+                'feed': feeds[pair]
+            }
+            for pair, snapshot in zip(feeds, snapshots)
+        }
+    }
 
 async def create_feeds(exchanges):
     data = await asyncio.gather(*[ create_feed(exchange, exchanges[exchange]) for exchange in exchanges ])
     return reduce(lambda x,y: { **x, **y }, data)
+
+class BookFeed():
+    '''
+    Wraps a websocket and the orderbook it maintains. Iterating applies orderbook events to the book,
+    and yields a BBOEvent only when the top of the book changes, so consumers can skip deep-book updates
+    entirely. An empty side has a price and quantity of None. All other events (orders, etc) pass through
+    unchanged.
+
+    The book is marked invalid (ob.valid) from a disconnect or failed checksum until the snapshot rebuilding it.
+
+    Pass updates=True to also receive the raw orderbook_update events, after they're applied.
+    '''
+
+    def __init__(self, ws, ob, updates=False):
+        self.ws = ws
+        self.ob = ob
+        self.updates = updates
+        # BBO change held back while its update is yielded first
+        self.pending = None
+
+    def __aiter__(self):
+        return self
+
+    @staticmethod
+    def _best(best):
+        # A side may be empty, ex: after a thin reset
+        try:
+            return best()
+        except IndexError:
+            return (None, None)
+
+    def _bbo_event(self, event):
+        bid_price, bid_quantity = self._best(self.ob.best_bid)
+        ask_price, ask_quantity = self._best(self.ob.best_ask)
+        return common.BBOEvent(event.exchange, bid_price, bid_quantity, ask_price, ask_quantity, timestamp=getattr(event, 'timestamp', None))
+
+    async def __anext__(self):
+        if self.pending:
+            event, self.pending = self.pending, None
+            return event
+
+        while True:
+            event = await self.ws.__anext__()
+
+            if event.event_type == 'orderbook_update':
+                changed = self.ob.update(event.update)
+                if event.checksum is not None and not self.ob.verify_checksum(event.checksum):
+                    self.ob.valid = False
+                    self.ws.book_sync.invalidate()
+                    continue
+
+                if self.updates:
+                    self.pending = self._bbo_event(event) if changed else None
+                    return event
+                elif changed:
+                    return self._bbo_event(event)
+            elif event.event_type == 'orderbook_snapshot':
+                # Sent when the feed resyncs the book (or poloniex resets it)
+                self.ob.reset(event.snapshot)
+                return self._bbo_event(event)
+            elif event.event_type == 'disconnected':
+                self.ob.valid = False
+                return event
+            else:
+                return event
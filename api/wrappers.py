@@ -1,10 +1,9 @@
 from decimal import Decimal
-import datetime
 
 from api import common
 from api import ob as simpleob
 from api import exchange
-import pandas as pd
+from util import timestamps
 
 class BinanceWebsocketWrapper():
     @staticmethod
@@ -12,8 +11,8 @@ class BinanceWebsocketWrapper():
         parsers = {
             'depthUpdate': BinanceWebsocketWrapper.parse_orderbook_update,
             'executionReport': BinanceWebsocketWrapper.parse_order,
-            'outboundAccountInfo': lambda e: common.Event('account_info', 'binance'),
-            'outboundAccountPosition': lambda e: common.Event('account_position', 'binance')
+            'outboundAccountInfo': lambda e: common.GenericEvent('account_info', 'binance'),
+            'outboundAccountPosition': lambda e: common.GenericEvent('account_position', 'binance')
         }
 
         return parsers[data['e']](data)
@@ -25,7 +24,8 @@ class BinanceWebsocketWrapper():
         updates.extend(list(map(lambda bid: ['bids', *bid], data['b'])))
         updates.extend(list(map(lambda ask: ['asks', *ask], data['a'])))
 
-        return common.OrderbookEvent('binance_us', updates, data['U'])
+        return common.OrderbookEvent('binance_us', updates, data['u'], timestamp=timestamps.ms_to_ns(data['E']), first_sequence=data['U'],
+            product=data['s'].lower())
 
     @staticmethod
     def parse_order(data):
@@ -53,6 +53,7 @@ class CoinbaseWebsocketWrapper():
             'open': CoinbaseWebsocketWrapper.parse_order,   # Remaining are order update events
             'done': CoinbaseWebsocketWrapper.parse_order,
             'match': CoinbaseWebsocketWrapper.parse_order,
+            'change': CoinbaseWebsocketWrapper.parse_order,
             'heartbeat': CoinbaseWebsocketWrapper.parse_heartbeat,
             'subscriptions': CoinbaseWebsocketWrapper.parse_subscriptions,
             'l2update': CoinbaseWebsocketWrapper.parse_orderbook_update,
@@ -71,51 +72,52 @@ class CoinbaseWebsocketWrapper():
     @staticmethod
     def parse_order(data):
         if 'time' in data:
-            data['time'] = datetime.datetime.strptime(data['time'], '%Y-%m-%dT%H:%M:%S.%fZ').timestamp()
+            data['time'] = timestamps.iso_to_ns(data['time'])
         if data['type'] == 'received':
             if data['order_type'] == 'limit':
-                return common.OrderReceivedEvent('coinbase', data['order_id'], data['price'], quantity=data['size'], order_type='limit', timestamp=data['time'], side=data['side'])
+                return common.OrderReceivedEvent('coinbase', data['order_id'], data['price'], quantity=data['size'], order_type='limit', timestamp=data['time'], side=data['side'], sequence=data.get('sequence'))
             elif data['order_type'] == 'market':
                 # Unsure if I really want to set this as price..
                 quantity = data['funds'] if 'funds' in data else 0
-                return common.OrderReceivedEvent('coinbase', data['order_id'], 0, quantity=quantity, order_type='market', timestamp=data['time'], side=data['side'])
+                return common.OrderReceivedEvent('coinbase', data['order_id'], 0, quantity=quantity, order_type='market', timestamp=data['time'], side=data['side'], sequence=data.get('sequence'))
         elif data['type'] == 'open':
             return common.OrderOpenEvent('coinbase', data['order_id'], data['price'], data['remaining_size'], side=data['side'], sequence=data['sequence'], timestamp=data['time'])
         elif data['type'] == 'done':
-            return common.OrderDoneEvent('coinbase', data['order_id'], data['reason'], timestamp=data['time'], side=data['side'], remaining_size=Decimal(data['remaining_size']), price=Decimal(data['price']))
+            # Market orders carry no price or remaining size
+            price = Decimal(data['price']) if 'price' in data else None
+            remaining_size = Decimal(data['remaining_size']) if 'remaining_size' in data else None
+            return common.OrderDoneEvent('coinbase', data['order_id'], data['reason'], timestamp=data['time'], side=data['side'], remaining_size=remaining_size, price=price, sequence=data.get('sequence'))
         elif data['type'] == 'match':
-            return common.OrderMatchEvent('coinbase', data['trade_id'], data['price'], data['size'], sequence=data['sequence'], timestamp=data['time'])
+            # side is the maker's side
+            return common.OrderMatchEvent('coinbase', data['maker_order_id'], data['price'], data['size'], side=data['side'], sequence=data['sequence'], timestamp=data['time'], taker_id=data['taker_order_id'])
+        elif data['type'] == 'change':
+            return common.OrderChangeEvent('coinbase', data['order_id'], data.get('price'), data.get('new_size', 0), side=data['side'], sequence=data['sequence'], timestamp=data['time'])
 
         raise ValueError(f'Unknown order type: {data["type"]}')
 
-    @staticmethod
-    def cb_time_to_timestamp(time):
-        return datetime.datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%fZ').timestamp()
+    # Timestamps are int ns, see util.timestamps
+    cb_time_to_timestamp = staticmethod(timestamps.iso_to_ns)
 
     @staticmethod
     def parse_orderbook_update(data):
         if data['type'] == 'l2update':
-            return common.OrderbookEvent('coinbase', simpleob.convert_coinbase_update(data), timestamp=CoinbaseWebsocketWrapper.cb_time_to_timestamp(data['time']))
+            return common.OrderbookEvent('coinbase', simpleob.convert_coinbase_update(data), timestamp=CoinbaseWebsocketWrapper.cb_time_to_timestamp(data['time']),
+                product=data['product_id'])
 
         raise ValueError(f'Unknown orderbook update type: {data["type"]}')
 
     @staticmethod
     def parse_orderbook_snapshot(data):
         if data['type'] == 'snapshot':
-            return common.OrderbookSnapshotEvent('coinbase', simpleob.convert_coinbase_ob(data))
+            return common.OrderbookSnapshotEvent('coinbase', simpleob.convert_coinbase_ob(data), data['product_id'])
 
         raise ValueError(f'Unknown orderbook snapshot type: {data["type"]}')
 
 class CoinbaseAPIWrapper():
     @staticmethod
     def parse_get_orderbook(data):
-        #data['bids'] = [ entry for entry in data['bids'] ]
-        #data['asks'] = [ entry for entry in data['asks'] ]
-
-        ob = pd.Series({
-            'bids': pd.DataFrame(data['bids'], columns=['price','quantity', 'order_id']),
-            'asks': pd.DataFrame(data['asks'], columns=['price','quantity', 'order_id'])})
-        return ob
+        # Rows are [price, quantity, order_id]
+        return { 'bids': data['bids'], 'asks': data['asks'], 'sequence': data['sequence'] }
 
 '''
 class PoloniexWebsocketWrapper():
@@ -1,34 +1,118 @@
 import asyncio
 import json
+import time
+from collections import deque
 
 import websockets
 
-# Create tasks, continue running until all of them have finished..?
-# Actually, this should implement an async generator class
-# Would be if we could make a class that overloads the '|' operator to
-# merge streams together
+from util.metrics import Metrics
+
 class merge():
-    def __init__(self, *agens):
-        self.queue = asyncio.Queue()
-        self.tasks = []
+    '''
+    Merges async iterables into one, yielding priority events (by default our own order events)
+    ahead of everything else, which is yielded in arrival order. Ends with StopAsyncIteration once
+    every source has finished, and raises the first exception a source raises.
+
+    Each source is pumped by a task into a shared deque. The consumer only waits (on a single Event)
+    when both deques are empty, so a burst of events costs one wakeup, not one per event.
+
+    Only one other event per source is held at a time: a newer bbo replaces a waiting one, and
+    anything else waits for the consumer to take it before the source is read further. So a slow
+    consumer leaves the backlog in the sources (ex: a websocket's FeedQueue, where it's bounded and
+    conflated), rather than here. Priority events are always taken, so only jump what's been read.
+
+    Per-source event counts and queue wait times are recorded in metrics, as <name>.events and
+    <name>.wait, and replaced bbos as <name>.conflated.
+    '''
+
+    ORDER_EVENTS = frozenset([ 'order', 'order_received', 'order_open', 'order_match', 'order_change', 'order_done' ])
+
+    def __init__(self, *agens, names=None, priority=None, metrics=None):
         self.agens = agens
+        self.names = names or [ str(i) for i in range(len(agens)) ]
+        self.priority = priority or merge.is_order_event
+        self.metrics = metrics or Metrics()
+        self.tasks = []
+        # (source name, enqueue time, event)
+        self.high = deque()
+        self.low = deque()
+        # source name -> its entry in low, while not yet consumed
+        self.pending = {}
+        # source name -> Event set when its pending entry is consumed
+        self.consumed = {}
+        self.ready = asyncio.Event()
+        self.active = 0
+        self.error = None
+
+    @staticmethod
+    def is_order_event(event):
+        return getattr(event, 'event_type', None) in merge.ORDER_EVENTS
 
-    async def _queue_events(self, agen):
-        async for event in agen:
-            self.queue.put_nowait(event)
-            #await asyncio.sleep(0)
+    @staticmethod
+    def is_bbo(event):
+        return getattr(event, 'event_type', None) == 'bbo'
+
+    async def _queue_events(self, name, agen):
+        try:
+            consumed = self.consumed[name] = asyncio.Event()
+            async for event in agen:
+                if self.priority(event):
+                    self.high.append((name, time.perf_counter(), event))
+                else:
+                    entry = self.pending.get(name)
+                    # Sources needn't be Event streams (ex: raw websockets in test())
+                    if entry is not None and merge.is_bbo(event) and merge.is_bbo(entry[2]):
+                        # Only the latest top of book matters
+                        entry[2] = event
+                        self.metrics.incr(f'{name}.conflated')
+                        continue
+                    while name in self.pending:
+                        consumed.clear()
+                        await consumed.wait()
+                    self.pending[name] = [ name, time.perf_counter(), event ]
+                    self.low.append(self.pending[name])
+                self.ready.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+        finally:
+            self.active -= 1
+            self.ready.set()
 
-    # This seems to be where we should set up our tasks..
     def __aiter__(self):
-        self.tasks = [ asyncio.create_task(self._queue_events(gen)) for gen in self.agens ]
+        if not self.tasks:
+            self.active = len(self.agens)
+            self.tasks = [ asyncio.create_task(self._queue_events(name, agen)) for name, agen in zip(self.names, self.agens) ]
         return self
 
-    # Needs to return an awaitable..
     async def __anext__(self):
-        if all([ task.done() for task in self.tasks ]):
-            raise StopAsyncIteration()
-        else:
-            return await self.queue.get()
+        while True:
+            if self.error is not None:
+                await self.aclose()
+                raise self.error
+
+            queue = self.high or self.low
+            if queue:
+                name, enqueued, event = queue.popleft()
+                if queue is self.low:
+                    del self.pending[name]
+                    self.consumed[name].set()
+                self.metrics.incr(f'{name}.events')
+                self.metrics.record(f'{name}.wait', time.perf_counter() - enqueued)
+                return event
+
+            if self.active == 0:
+                raise StopAsyncIteration()
+
+            self.ready.clear()
+            await self.ready.wait()
+
+    async def aclose(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
 
 async def test():
     ws1 = await websockets.connect('wss://ws-feed.pro.coinbase.com')
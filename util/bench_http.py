@@ -0,0 +1,108 @@
+'''
+HTTPS request latency against a local stand-in exchange server, comparing:
+
+    fresh: a new connection per request (module level requests calls)
+    pooled: an exchange.pooled_session
+    idle: the pooled session's first request after the server has dropped its idle connection
+    warm: the same, with ExchangeAPI.keep_warm pinging in the background
+
+    python -m util.bench_http [requests]
+
+The server closes connections idle for IDLE_TIMEOUT seconds, like exchanges do (for much longer).
+Needs openssl for a self signed certificate.
+'''
+import asyncio
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from api import exchange
+
+IDLE_TIMEOUT = 1
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = IDLE_TIMEOUT
+    # Headers and body are written separately, which would otherwise wait on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = b'{"serverTime":0}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(certfile, keyfile):
+    server = ThreadingHTTPServer(('localhost', 0), StandInHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_cert(directory):
+    certfile, keyfile = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+        '-addext', 'subjectAltName=DNS:localhost', '-keyout', keyfile, '-out', certfile], check=True, capture_output=True)
+    return certfile, keyfile
+
+def timed(request):
+    start = time.perf_counter()
+    request().close()
+    return time.perf_counter() - start
+
+class StandInAPI(exchange.ExchangeAPI):
+    EXCHANGE = 'stand_in'
+
+async def after_idle(api, url, warm):
+    ''' Latency of a request made after the connection has sat idle past the server's timeout '''
+    task = asyncio.create_task(api.keep_warm(IDLE_TIMEOUT / 4)) if warm else None
+    api.session.get(url).close()
+    await asyncio.sleep(IDLE_TIMEOUT * 2)
+    seconds = await asyncio.get_event_loop().run_in_executor(None, timed, lambda: api.session.get(url))
+    if task:
+        task.cancel()
+    return seconds
+
+def report(name, samples):
+    samples = sorted(samples)
+    print(f'{name:<8} median {statistics.median(samples) * 1e3:7.2f}ms  p90 {samples[int(len(samples) * .9)] * 1e3:7.2f}ms  ({len(samples)} requests)')
+
+def main(count):
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = make_cert(directory)
+        server = serve(certfile, keyfile)
+        url = f'https://localhost:{server.server_address[1]}/api/v3/time'
+
+        report('fresh', [ timed(lambda: requests.get(url, verify=certfile)) for _ in range(count) ])
+
+        session = exchange.pooled_session()
+        session.verify = certfile
+        # Otherwise REQUESTS_CA_BUNDLE overrides verify
+        session.trust_env = False
+        report('pooled', [ timed(lambda: session.get(url)) for _ in range(count) ])
+
+        for warm in [False, True]:
+            api = StandInAPI()
+            api.PING_URL = url
+            api.session.verify = certfile
+            api.session.trust_env = False
+            report('warm' if warm else 'idle', [ asyncio.run(after_idle(api, url, warm)) for _ in range(max(1, count // 20)) ])
+
+        server.shutdown()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,62 @@
+'''
+Compares the installed JSON decoders (see util.fastjson) on websocket frames from each exchange.
+
+    python -m util.bench_json [exchange=frames.txt ...]
+
+Recorded frames are read one per line, ex: websocat output for a subscribed feed. Without any,
+a sample of typical frames per exchange is used. Frames are decoded from bytes, as ingestion does.
+'''
+import sys
+import timeit
+
+from util import fastjson
+
+SAMPLE_FRAMES = {
+    'binance_us': [
+        '{"stream":"btcusd@depth@100ms","data":{"e":"depthUpdate","E":1612000000000,"s":"BTCUSD","U":1000001,"u":1000012,'
+        '"b":[["33001.1200","0.01500000"],["33000.0000","0.00000000"],["32998.5000","1.20000000"]],'
+        '"a":[["33002.3400","0.25000000"],["33003.0000","0.00000000"],["33010.0000","2.00000000"]]}}',
+        '{"e":"executionReport","E":1612000000000,"s":"BTCUSD","c":"web_abc","S":"BUY","o":"LIMIT","f":"GTC",'
+        '"q":"0.01000000","p":"33000.00000000","P":"0.00000000","F":"0.00000000","g":-1,"C":"","x":"TRADE","X":"FILLED",'
+        '"r":"NONE","i":123456,"l":"0.01000000","z":"0.01000000","L":"33000.00000000","n":"0.00001000","N":"BTC",'
+        '"T":1612000000000,"t":7890,"I":1234,"w":false,"m":true,"M":true,"O":1612000000000,"Z":"330.00000000",'
+        '"Y":"330.00000000","Q":"0.00000000"}'
+    ],
+    'coinbase': [
+        '{"type":"l2update","product_id":"BTC-USD","changes":[["buy","33001.12","0.01500000"]],"time":"2021-01-30T10:00:00.123456Z"}',
+        '{"type":"match","trade_id":10,"sequence":50,"maker_order_id":"ac928c66-ca53-498f-9c13-a110027a60e8",'
+        '"taker_order_id":"132fb6ae-456b-4654-b4e0-d681ac05cea1","time":"2021-01-30T10:00:00.123456Z","product_id":"BTC-USD",'
+        '"size":"5.23512","price":"400.23","side":"sell"}',
+        '{"type":"heartbeat","sequence":90,"last_trade_id":20,"product_id":"BTC-USD","time":"2021-01-30T10:00:00.123456Z"}'
+    ],
+    'poloniex': [
+        '[121,123456789,[["o",0,"33001.12000000","0.01500000"],["o",1,"33002.34000000","0.00000000"],'
+        '["t","4200",1,"33002.34000000","0.25000000",1612000000,"1612000000123"]]]',
+        '[1000,"",[["p",1234567,28,"33000.00000000","0.01000000","0","clientId"],["b",28,"e","-330.00000000"]]]'
+    ]
+}
+
+def load(path):
+    with open(path, 'rb') as f:
+        return [ line.rstrip(b'\n') for line in f if line.strip() ]
+
+def bench(frames, loads, number):
+    return min(timeit.repeat(lambda: [ loads(frame) for frame in frames ], number=number, repeat=5)) / (number * len(frames))
+
+def main(args):
+    if args:
+        recorded = dict(arg.split('=', 1) for arg in args)
+        exchanges = { exchange: load(path) for exchange, path in recorded.items() }
+    else:
+        exchanges = { exchange: [ frame.encode() for frame in frames ] for exchange, frames in SAMPLE_FRAMES.items() }
+
+    print(f'default decoder: {fastjson.backend}')
+    for exchange, frames in exchanges.items():
+        number = max(1, 20000 // len(frames))
+        baseline = bench(frames, fastjson.DECODERS['json'], number)
+        for name, loads in fastjson.DECODERS.items():
+            seconds = bench(frames, loads, number)
+            print(f'{exchange:<12} {name:<8} {seconds * 1e6:8.2f}us/frame  {baseline / seconds:5.2f}x')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
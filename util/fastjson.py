@@ -0,0 +1,68 @@
+'''
+JSON decoding for websocket frames. loads() uses the fastest installed backend (orjson, then ujson),
+falling back to the stdlib json module. Every backend accepts bytes as well as str, so frames can be
+received raw (see recv) and never decoded to str first.
+
+Backends can be switched with use(), or by setting the JSON_DECODER environment variable.
+'''
+import json
+import os
+
+import websockets
+
+DECODERS = { 'json': json.loads }
+
+try:
+    import orjson
+    DECODERS['orjson'] = orjson.loads
+except ImportError:
+    pass
+
+try:
+    import ujson
+    DECODERS['ujson'] = ujson.loads
+except ImportError:
+    pass
+
+PREFERENCE = ['orjson', 'ujson', 'json']
+
+# Whether recv() asks for undecoded frames; cleared if the websockets version can't do it
+raw = True
+
+def use(name=None):
+    ''' Switches loads() to the named backend, or the fastest installed one '''
+    global loads, backend
+    if name is None:
+        name = next(name for name in PREFERENCE if name in DECODERS)
+    elif name not in DECODERS:
+        raise ValueError(f'JSON decoder {name} is not installed (have {", ".join(DECODERS)})')
+
+    backend = name
+    loads = DECODERS[name]
+
+use(os.environ.get('JSON_DECODER'))
+
+async def recv(ws):
+    ''' Receives the next frame from ws, as bytes when the websockets version supports it '''
+    global raw
+    if raw:
+        try:
+            return await ws.recv(decode=False)
+        except TypeError:
+            # Legacy protocol, recv() always decodes text frames
+            raw = False
+    return await ws.recv()
+
+async def frames(ws):
+    ''' Iterates the frames of ws (like async for) using recv() '''
+    if not hasattr(ws, 'recv'):
+        # Anything else iterable, ex: recorded frames
+        async for frame in ws:
+            yield frame
+        return
+
+    try:
+        while True:
+            yield await recv(ws)
+    except websockets.ConnectionClosedOK:
+        return
@@ -0,0 +1,59 @@
+import time
+from collections import defaultdict
+
+class Metrics():
+    '''
+    Counters, gauges and timings for feed health (resyncs, gaps, drops, queue depth, etc). Timings
+    keep a running count, total and max rather than samples, so recording is O(1) and memory never grows.
+    '''
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        # name -> [count, total seconds, max seconds]
+        self.timings = {}
+        # name -> [current, max]
+        self.gauges = {}
+
+    def incr(self, name, amount=1):
+        self.counters[name] += amount
+
+    def record(self, name, seconds):
+        timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+    def gauge(self, name, value):
+        gauge = self.gauges.get(name)
+        if gauge is None:
+            self.gauges[name] = [value, value]
+        else:
+            gauge[0] = value
+            if value > gauge[1]:
+                gauge[1] = value
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def snapshot(self):
+        return {
+            'counters': dict(self.counters),
+            'gauges': { name: { 'value': value, 'max': peak } for name, (value, peak) in self.gauges.items() },
+            'timings': { name: { 'count': count, 'total': total, 'mean': total / count, 'max': worst }
+                for name, (count, total, worst) in self.timings.items() }
+        }
+
+class Timer():
+    ''' Context manager recording the duration of its block into a Metrics timing '''
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+        return False
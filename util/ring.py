@@ -0,0 +1,96 @@
+'''
+Single producer, single consumer ring buffer of fixed width records in shared memory, for passing
+events between processes without pickling. Records are a struct.Struct, packed straight into the
+shared buffer by put() and unpacked out of it by get()/drain().
+
+The header holds the write and read counters, on separate cache lines so the two processes don't
+contend for one. Each side only ever stores its own counter, and a record is published by storing
+the write counter after packing it. Each store is a single memoryview write made in program order,
+which is enough for the reader never to see a half written record on x86 (total store ordering).
+'''
+import struct
+from multiprocessing import shared_memory
+
+_COUNTER = struct.Struct('<Q')
+_WRITE = 0
+_READ = 64
+_HEADER = 128
+
+class Ring():
+    '''
+    Creates a new ring of slots records (a power of two), or attaches to an existing one by name,
+    which must be given the same record and slots. Only one process may put, and one get.
+    '''
+
+    def __init__(self, record, slots=1 << 14, name=None):
+        if slots & (slots - 1):
+            raise ValueError(f'Ring slots must be a power of two, not {slots}')
+
+        self.record = record if isinstance(record, struct.Struct) else struct.Struct(record)
+        self.slots = slots
+        self.mask = slots - 1
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=_HEADER + slots * self.record.size if self.owner else 0)
+        self.buf = self.shm.buf
+        if self.owner:
+            _COUNTER.pack_into(self.buf, _WRITE, 0)
+            _COUNTER.pack_into(self.buf, _READ, 0)
+
+        # Each side's own counter, and its last look at the other's, which is only re-read when the
+        # ring looks full (writer) or empty (reader)
+        self.write = self.write_seen = _COUNTER.unpack_from(self.buf, _WRITE)[0]
+        self.read = self.read_seen = _COUNTER.unpack_from(self.buf, _READ)[0]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __len__(self):
+        return _COUNTER.unpack_from(self.buf, _WRITE)[0] - _COUNTER.unpack_from(self.buf, _READ)[0]
+
+    def put(self, *fields):
+        ''' Writes a record, returning False (writing nothing) when the ring is full '''
+        return self.put_many([ fields ])
+
+    def put_many(self, records):
+        ''' Writes every record (a tuple of fields) or, if they don't all fit, none of them '''
+        if self.write + len(records) - self.read_seen > self.slots:
+            self.read_seen = _COUNTER.unpack_from(self.buf, _READ)[0]
+            if self.write + len(records) - self.read_seen > self.slots:
+                return False
+
+        pack, buf, size = self.record.pack_into, self.buf, self.record.size
+        for fields in records:
+            pack(buf, _HEADER + (self.write & self.mask) * size, *fields)
+            self.write += 1
+        _COUNTER.pack_into(buf, _WRITE, self.write)
+        return True
+
+    def get(self):
+        ''' The oldest record's fields, or None when the ring is empty '''
+        if self.read == self.write_seen:
+            self.write_seen = _COUNTER.unpack_from(self.buf, _WRITE)[0]
+            if self.read == self.write_seen:
+                return None
+
+        fields = self.record.unpack_from(self.buf, _HEADER + (self.read & self.mask) * self.record.size)
+        self.read += 1
+        _COUNTER.pack_into(self.buf, _READ, self.read)
+        return fields
+
+    def drain(self):
+        ''' Every record written so far, freeing their slots at once '''
+        self.write_seen = _COUNTER.unpack_from(self.buf, _WRITE)[0]
+        unpack, buf, size = self.record.unpack_from, self.buf, self.record.size
+        records = [ unpack(buf, _HEADER + (read & self.mask) * size) for read in range(self.read, self.write_seen) ]
+        if records:
+            self.read = self.write_seen
+            _COUNTER.pack_into(buf, _READ, self.read)
+        return records
+
+    def close(self):
+        ''' Detaches from the ring, and frees it if this side created it '''
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,34 @@
+'''
+Event timestamps are int nanoseconds since the epoch (UTC), so latency math never needs floats or
+datetimes. Compare against time.time_ns().
+'''
+import calendar
+import time
+
+NS = 1000000000
+
+# date prefix -> ns at its midnight. Timestamps within a feed share the date, so this stays tiny
+_midnights = {}
+
+def iso_to_ns(timestamp):
+    '''
+    Fixed format parser for ISO-8601 UTC timestamps like Coinbase's, 2021-01-30T10:00:00.123456Z.
+    The fraction is optional and may have any number of digits.
+    '''
+    date = timestamp[:10]
+    midnight = _midnights.get(date)
+    if midnight is None:
+        if len(_midnights) > 8:
+            _midnights.clear()
+        midnight = _midnights[date] = calendar.timegm((int(date[:4]), int(date[5:7]), int(date[8:10]), 0, 0, 0)) * NS
+
+    seconds = int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+    fraction = timestamp[20:-1]
+    return midnight + seconds * NS + (int(fraction[:9].ljust(9, '0')) if fraction else 0)
+
+def ms_to_ns(ms):
+    ''' Ex: Binance event times '''
+    return ms * 1000000
+
+def now_ns():
+    return time.time_ns()